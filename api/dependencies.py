@@ -7,6 +7,7 @@ handling user sessions.
 
 import time
 import jwt
+from fastapi import Depends
 from starlette.requests import Request
 from api.user import User
 from api.exceptions import ExpiredAccessToken, InvalidAccessToken
@@ -45,3 +46,16 @@ def retrieve_user(request: Request) -> User:
         return User(username=decoded.get("preferred_username"), access_token=access_token)
     except jwt.InvalidTokenError as inv_token_error:
         raise InvalidAccessToken from inv_token_error
+
+
+def retrieve_identified_user(user: User = Depends(retrieve_user)) -> User:
+    """
+    Retrieves the user like retrieve_user(), requiring its token to name it, e.g. to own the jobs it submits
+
+    :param user: User retrieved from the access token.
+    :return: User object containing username and access token.
+    :raises HTTPException: Thrown with a 401 status code if the access token has no username.
+    """
+    if not user.username:
+        raise InvalidAccessToken
+    return user
@@ -131,3 +131,126 @@ class NoConversionFound(SentryReportedException):
 
     def __init__(self):
         super().__init__(status_code=404, detail="The NWB file didn't contain a 'conversion'.")
+
+
+class TooManyPanelsException(HTTPException):
+    """Exception raised when a simulation grid would have more panels than the limit"""
+
+    def __init__(self, max_panels: int):
+        super().__init__(status_code=422, detail=f"The grid has more than {max_panels} panels, select its locations")
+
+
+# Soma reconstruction
+
+
+class SomaMeshNotFoundException(HTTPException):
+    """Exception raised when NeuroMorphoVis did not export the soma mesh"""
+
+    def __init__(self):
+        super().__init__(status_code=404, detail="OBJ file not found after processing.")
+
+
+class InvalidSomaException(HTTPException):
+    """Exception raised when the soma of a SWC file cannot be approximated"""
+
+    def __init__(self, detail: str):
+        super().__init__(status_code=422, detail=detail)
+
+
+class PayloadTooLargeException(HTTPException):
+    """Exception raised when an uploaded file exceeds the size limit"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(status_code=413, detail=f"The uploaded file exceeds the limit of {max_bytes} bytes")
+
+
+class InvalidUploadException(HTTPException):
+    """Exception raised when an upload is not a multipart body with the expected file"""
+
+    def __init__(self, detail: str):
+        super().__init__(status_code=422, detail=detail)
+
+
+class TileNotFoundException(HTTPException):
+    """
+    Exception raised when a tile is out of the pyramid of a morphology
+    """
+
+    def __init__(self):
+        super().__init__(status_code=404, detail="The tile is out of the pyramid of the morphology")
+
+
+class JobNotFoundException(HTTPException):
+    """Exception raised when a soma reconstruction job does not exist or expired"""
+
+    def __init__(self):
+        super().__init__(status_code=404, detail="The job does not exist or expired")
+
+
+class JobNotFinishedException(HTTPException):
+    """Exception raised when the result of a soma reconstruction job is not available"""
+
+    def __init__(self, status: str):
+        super().__init__(status_code=409, detail=f"The job has no result, its status is '{status}'")
+
+
+# Rendering
+
+
+class RendererUnavailableException(HTTPException):
+    """Exception raised when no renderer got free in time to generate the image"""
+
+    def __init__(self):
+        super().__init__(status_code=503, detail="No renderer is available, please retry later")
+
+
+class SpriteSheetTooLargeException(HTTPException):
+    """Exception raised when a sprite sheet would be wider or higher than the limit"""
+
+    def __init__(self, max_size: int):
+        super().__init__(
+            status_code=422, detail=f"The sprite sheet is larger than {max_size} pixels, use fewer columns or cells"
+        )
+
+
+# Admission control
+
+
+class QueueFullException(HTTPException):
+    """Exception raised when too many requests are already waiting to be processed"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail="Too many requests are waiting to be processed, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class QueueTimeoutException(HTTPException):
+    """Exception raised when a request waited too long to be processed"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail="The service is overloaded, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+# Cancellation
+
+
+class DeadlineExceededException(HTTPException):
+    """Exception raised when a request was not processed within its time budget"""
+
+    def __init__(self):
+        super().__init__(status_code=504, detail="The request could not be processed in time")
+
+
+class RequestCancelledException(HTTPException):
+    """Exception raised to stop the work of a request whose client disconnected"""
+
+    def __init__(self):
+        # 499 Client Closed Request, only seen in the logs since the client is gone
+        super().__init__(status_code=499, detail="The client closed the request")
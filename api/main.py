@@ -9,7 +9,14 @@ import sentry_sdk
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from fastapi import APIRouter, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from api.router import generate, swc, health
+from api.services.kaleido_pool import kaleido_pool
+from api.services.render_executor import render_executor
+from api.services.soma import blender_pool
+from api.services.soma_jobs import soma_job_workers
+from api.services.storage import storage_collector
+from api.models.enums import SimulationPlotEngine
 from api.settings import settings
 
 tags_metadata = [
@@ -44,7 +51,20 @@ async def lifespan(app: FastAPI):
             profiles_sample_rate=settings.sentry_profiles_sample_rate,
             environment=settings.environment,
         )
+    # Chromium is never started when simulation plots are rendered with matplotlib
+    if settings.simulation_plot_engine == SimulationPlotEngine.PLOTLY and kaleido_pool.size > 0:
+        await run_in_threadpool(kaleido_pool.start)
+    await run_in_threadpool(render_executor.start)
+    await run_in_threadpool(blender_pool.start)
+    soma_job_workers.start()
+    storage_collector.start()
     yield
+    # Shutdown code
+    storage_collector.stop()
+    await run_in_threadpool(soma_job_workers.stop)
+    blender_pool.stop()
+    render_executor.stop()
+    kaleido_pool.stop()
 
 
 app = FastAPI(
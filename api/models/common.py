@@ -2,9 +2,15 @@
 Model module defining models related to images
 """
 
-from typing import List, Literal, Optional
+from typing import Annotated, Any, List, Literal, Optional
+import numpy as np
 from fastapi import Query
-from pydantic import BaseModel
+from numpy.typing import NDArray
+from pydantic import BaseModel, Field, PlainSerializer, PlainValidator, model_validator
+from api.models.enums import BatchItemType
+
+# Thumbnails generated by a batch request at most
+BATCH_MAX_ITEMS = 200
 
 
 class ImageGenerationInput(BaseModel):
@@ -30,16 +36,92 @@ class SimulationGenerationInput(BaseModel):
     h: Optional[int] = None
 
 
+class SimulationGridInput(BaseModel):
+    """
+    The input format for the generation of a grid of simulation plots
+    """
+
+    content_url: str
+    locations: Optional[str] = Field(None, description="Comma-separated recorded locations to include, all if not set")
+    include_stimulus: bool = True
+    columns: Optional[int] = Query(None, ge=1, le=10)
+    w: Optional[int] = Query(None, ge=10, le=4000)
+    h: Optional[int] = Query(None, ge=10, le=4000)
+
+    @property
+    def location_list(self) -> Optional[List[str]]:
+        """
+        The list of the requested locations, None for all of them
+        """
+        if self.locations is None:
+            return None
+        return [location.strip() for location in self.locations.split(",") if location.strip()]
+
+
+class TraceDataInput(BaseModel):
+    """
+    The input format for trace data generation
+    """
+
+    content_url: str
+    max_points: int = Query(2000, ge=4, le=100000)
+
+
+class SimulationDataInput(BaseModel):
+    """
+    The input format for simulation data generation
+    """
+
+    content_url: str
+    target: PlotTarget
+    max_points: int = Query(2000, ge=4, le=100000)
+
+
+class MorphologyTileInput(BaseModel):
+    """
+    The input format for the tile pyramid of a morphology
+    """
+
+    content_url: str
+
+
+def to_float_array(value: Any) -> NDArray[np.float64]:
+    """
+    Converts a sequence of numbers into a contiguous float64 array in a single vectorized step,
+    instead of validating every sample as a Python float. Missing values (null) become NaN.
+    """
+    try:
+        array = np.ascontiguousarray(value, dtype=np.float64)
+    except (TypeError, ValueError) as exc:
+        raise ValueError("must be a sequence of numbers") from exc
+    if array.ndim != 1:
+        raise ValueError("must be a one-dimensional sequence of numbers")
+    return array
+
+
+FloatArray = Annotated[NDArray[np.float64], PlainValidator(to_float_array), PlainSerializer(lambda a: a.tolist())]
+
+
 class PlotData(BaseModel):
     """
     Plotly data format
     """
 
-    x: List[float]
-    y: List[float]
+    x: FloatArray
+    y: FloatArray
     type: str = "scatter"
     name: str
 
+    @model_validator(mode="after")
+    def trim_to_common_length(self) -> "PlotData":
+        """
+        Plotly ignores the extra points when x and y have different lengths, do the same once here
+        """
+        length = min(len(self.x), len(self.y))
+        self.x = self.x[:length]
+        self.y = self.y[:length]
+        return self
+
 
 class SimulationConfigurationFile(BaseModel):
     """
@@ -50,6 +132,49 @@ class SimulationConfigurationFile(BaseModel):
     simulation: dict[str, List[PlotData]]
 
 
+class BatchItem(BaseModel):
+    """
+    A thumbnail of a batch, with the parameters of its endpoint
+    """
+
+    type: BatchItemType
+    content_url: str
+    dpi: Optional[int] = Field(None, ge=10, le=600)
+    target: Optional[PlotTarget] = None
+    w: Optional[int] = None
+    h: Optional[int] = None
+
+    @model_validator(mode="after")
+    def check_target(self) -> "BatchItem":
+        """
+        The simulation plots need a target
+        """
+        if self.type == BatchItemType.SIMULATION_PLOT and self.target is None:
+            raise ValueError("target is required for a simulation-plot")
+        return self
+
+
+class BatchInput(BaseModel):
+    """
+    The input format for the generation of a batch of thumbnails
+    """
+
+    items: List[BatchItem] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+
+
+class SpriteSheetInput(BaseModel):
+    """
+    The input format for the generation of a sprite sheet of thumbnails
+    """
+
+    items: List[BatchItem] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+    cell_width: int = Field(128, ge=16, le=512)
+    cell_height: int = Field(128, ge=16, le=512)
+    columns: Optional[int] = Field(
+        None, ge=1, le=64, description="Columns of the grid, as square as possible if not set"
+    )
+
+
 class ErrorMessage(BaseModel):
     """
     Model of an error message
@@ -15,6 +15,22 @@ class MetaType(Enum):
     SWEEP = "sweep"
 
 
+class Lane(str, Enum):
+    """
+    Defines the kinds of work that are queued and executed separately
+
+    MORPHOLOGY: morphology thumbnails
+    TRACE: electrophysiology trace thumbnails and data
+    SIMULATION: simulation plots and data
+    SOMA: soma meshes reconstructed with NeuroMorphoVis/Blender
+    """
+
+    MORPHOLOGY = "morphology"
+    TRACE = "trace"
+    SIMULATION = "simulation"
+    SOMA = "soma"
+
+
 class Environment(str, Enum):
     """
     Defines the different environments that the application can be deployed in
@@ -29,3 +45,104 @@ class Environment(str, Enum):
     DEVELOPMENT = "development"
     STAGING = "staging"
     PRODUCTION = "production"
+
+
+class SimulationPlotEngine(str, Enum):
+    """
+    Defines the engines that can render the simulation plots
+
+    PLOTLY: plotly figures exported to PNG with Kaleido (needs Chromium)
+    MATPLOTLIB: matplotlib figures with the same layout, without Chromium
+    """
+
+    PLOTLY = "plotly"
+    MATPLOTLIB = "matplotlib"
+
+
+class JobStatus(str, Enum):
+    """
+    Defines the states of a soma reconstruction job
+
+    PENDING: waiting for a worker
+    RUNNING: being processed by a worker
+    SUCCEEDED: the mesh is available until the job expires
+    FAILED: the reconstruction failed, the error is available until the job expires
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    @property
+    def finished(self) -> bool:
+        """
+        Whether the job reached a final state
+        """
+        return self in (JobStatus.SUCCEEDED, JobStatus.FAILED)
+
+
+class SomaQuality(str, Enum):
+    """
+    Defines the quality/speed presets of the soma reconstruction, which set the length of the soft
+    body simulation and the subdivision level of the mesh
+
+    PREVIEW: a quarter of the simulation and a coarse mesh, for interactive previews
+    STANDARD: the NeuroMorphoVis defaults
+    HIGH: a longer simulation and a finer mesh
+    """
+
+    PREVIEW = "preview"
+    STANDARD = "standard"
+    HIGH = "high"
+
+
+class SomaApproximationFormat(str, Enum):
+    """
+    Defines the formats of the soma approximated without Blender
+
+    GLB: a binary glTF mesh
+    PNG: an image of the profile of the soma in the XY plane
+    """
+
+    GLB = "glb"
+    PNG = "png"
+
+
+class BatchItemType(str, Enum):
+    """
+    Defines the thumbnails that can be generated in a batch, named after their endpoints
+
+    MORPHOLOGY_IMAGE: the preview image of a morphology
+    TRACE_IMAGE: the preview image of an electrophysiology trace
+    SIMULATION_PLOT: the preview image of a simulation plot
+    """
+
+    MORPHOLOGY_IMAGE = "morphology-image"
+    TRACE_IMAGE = "trace-image"
+    SIMULATION_PLOT = "simulation-plot"
+
+    @property
+    def lane(self) -> Lane:
+        """
+        The lane the thumbnail is generated in
+        """
+        return {
+            BatchItemType.MORPHOLOGY_IMAGE: Lane.MORPHOLOGY,
+            BatchItemType.TRACE_IMAGE: Lane.TRACE,
+            BatchItemType.SIMULATION_PLOT: Lane.SIMULATION,
+        }[self]
+
+
+class BatchFormat(str, Enum):
+    """
+    Defines the formats of the response of a batch of thumbnails
+
+    ZIP: an archive of the images and of a manifest, sent once all the items are finished
+    NDJSON: a JSON line per item with its base64 encoded image, streamed as the items are finished
+    MULTIPART: a multipart/mixed part per item with its image, streamed as the items are finished
+    """
+
+    ZIP = "zip"
+    NDJSON = "ndjson"
+    MULTIPART = "multipart"
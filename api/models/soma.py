@@ -0,0 +1,65 @@
+"""
+Model module defining models related to soma reconstruction
+"""
+
+from datetime import datetime
+from typing import Optional
+from fastapi import Query
+from pydantic import BaseModel, Field
+from api.models.enums import JobStatus, SomaQuality
+
+
+class SomaExportOptions(BaseModel):
+    """
+    The size and level of detail of the exported GLB soma mesh, at full resolution and without Draco
+    compression by default
+    """
+
+    max_triangles: Optional[int] = Query(
+        None, ge=100, le=1_000_000, description="Triangle budget of the mesh, reached by decimating it"
+    )
+    # Viewers need a Draco decoder for the compressed meshes
+    draco_compression_level: Optional[int] = Query(
+        None, ge=0, le=10, description="Draco compression level (enables Draco compression)"
+    )
+    draco_position_quantization: Optional[int] = Query(
+        None, ge=8, le=30, description="Bits of the Draco quantized positions (enables Draco compression)"
+    )
+
+    def to_json(self) -> str:
+        """
+        Returns the options that are set, as the JSON object read by the NMV scripts
+        """
+        return self.model_dump_json(exclude_none=True)
+
+
+class SomaJobInput(BaseModel):
+    """
+    The SWC file and the quality preset of a soma reconstruction job
+    """
+
+    content_url: str = Query(..., description="URL of the SWC file to process")
+    quality: SomaQuality = Query(SomaQuality.STANDARD, description="Quality/speed preset of the reconstruction")
+
+
+class SomaJob(BaseModel):
+    """
+    The state of a soma reconstruction job
+    """
+
+    id: str
+    status: JobStatus
+    quality: SomaQuality
+    export: SomaExportOptions = SomaExportOptions()
+    created_at: datetime
+    updated_at: datetime
+    # Set once the job is finished, after which its result is deleted
+    expires_at: Optional[datetime] = None
+    error: Optional[str] = None
+    # Internal: the user who submitted the job (the only one to see it), the URL of its SWC file (which
+    # the user must still be able to read), the number of times it was claimed, and its result, which
+    # is downloaded from the result endpoint
+    submitter: Optional[str] = Field(default=None, exclude=True)
+    content_url: Optional[str] = Field(default=None, exclude=True)
+    attempts: int = Field(default=0, exclude=True)
+    mesh_path: Optional[str] = Field(default=None, exclude=True)
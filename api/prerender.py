@@ -0,0 +1,318 @@
+"""
+Module: prerender.py
+
+Command-line entry point pre-rendering thumbnails into the render cache, e.g. after a deploy or a
+flush of the cache, so that the users do not pay for the first renders of the popular resources:
+
+    python -m api.prerender --token "$ACCESS_TOKEN" --urls thumbnails.txt
+    python -m api.prerender --token "$ACCESS_TOKEN" --access-log /var/log/nginx/access.log --limit 1000
+
+The thumbnails are given as lines "TYPE CONTENT_URL [PARAMETER=VALUE ...]" (e.g. "morphology-image
+https://... dpi=72"), or replayed from the successful /generate requests of access logs, the most
+requested first. They are rendered with a render worker per core, the downloads from Nexus are
+rate limited, the finished thumbnails are recorded in a state file so that an interrupted run
+resumes where it stopped, and the progress and the throughput are logged periodically.
+"""
+
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+from urllib.parse import parse_qsl
+
+from pydantic import ValidationError
+
+from api.models.common import BatchItem
+from api.models.enums import BatchItemType, SimulationPlotEngine
+from api.services.batch import generate_batch_image
+from api.services.kaleido_pool import kaleido_pool
+from api.services.render_cache import render_cache
+from api.services.render_executor import render_executor
+from api.settings import settings
+from api.utils.logger import logger
+
+# Successful thumbnail requests of an access log (nginx combined or uvicorn format)
+ACCESS_LOG_REQUEST = re.compile(
+    r'"GET \S*/generate/(?P<type>'
+    + "|".join(item_type.value for item_type in BatchItemType)
+    + r')\?(?P<query>\S+) HTTP/[\d.]+"\s+(?P<status>\d{3})'
+)
+ACCESS_TOKEN_VARIABLE = "NEXUS_ACCESS_TOKEN"
+
+
+def read_url_list(lines: Iterable[str]) -> List[BatchItem]:
+    """
+    Returns the thumbnails of lines "TYPE CONTENT_URL [PARAMETER=VALUE ...]", ignoring the empty lines
+    and the comments (#)
+
+    Raises:
+        ValueError: If a line is malformed.
+    """
+    items = []
+    for number, line in enumerate(lines, start=1):
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        try:
+            parameters = dict(field.split("=", 1) for field in fields[2:])
+            items.append(BatchItem(type=fields[0], content_url=fields[1], **parameters))
+        except (IndexError, ValueError) as exc:
+            raise ValueError(f"Line {number} is not 'TYPE CONTENT_URL [PARAMETER=VALUE ...]': {line.strip()}") from exc
+    return items
+
+
+def read_access_log(lines: Iterable[str], limit: Optional[int] = None) -> List[BatchItem]:
+    """
+    Returns the thumbnails successfully requested in access logs, the most requested first
+
+    Parameters:
+        - lines (Iterable[str]): The lines of the access logs.
+        - limit (int | None): The number of thumbnails to return, all of them if not set.
+    """
+    requests_count: Counter = Counter()
+    for line in lines:
+        match = ACCESS_LOG_REQUEST.search(line)
+        if match is None or match["status"] != "200":
+            continue
+        parameters = tuple(sorted(parse_qsl(match["query"])))
+        requests_count[(match["type"], parameters)] += 1
+
+    items = []
+    for (item_type, parameters), _ in requests_count.most_common():
+        try:
+            items.append(BatchItem(type=item_type, **dict(parameters)))
+        except (TypeError, ValidationError):
+            # Unexpected parameters, the request would not be the same
+            continue
+        if limit is not None and len(items) >= limit:
+            break
+    return items
+
+
+def item_key(item: BatchItem) -> str:
+    """
+    Returns the key identifying a thumbnail in the state file
+    """
+    return item.model_dump_json(exclude_none=True)
+
+
+def read_state(path: Optional[Path]) -> Set[str]:
+    """
+    Returns the keys of the thumbnails rendered by the previous runs
+    """
+    if path is None or not path.exists():
+        return set()
+    with path.open(encoding="utf-8") as file:
+        return {line.rstrip("\n") for line in file if line.strip()}
+
+
+class RateLimiter:
+    """
+    Spaces the calls of the threads at a maximum rate
+    """
+
+    def __init__(self, rate: float) -> None:
+        """
+        Parameters:
+            - rate (float): The number of calls per second, 0 for no limit.
+        """
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next_call = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Waits for the turn of the call
+        """
+        if self.interval == 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            call_at = max(self._next_call, now)
+            self._next_call = call_at + self.interval
+        time.sleep(call_at - now)
+
+
+class PrerenderProgress:
+    """
+    Counters of a pre-rendering run, shared by its threads
+    """
+
+    def __init__(self, total: int, skipped: int = 0) -> None:
+        """
+        Parameters:
+            - total (int): The number of thumbnails to render.
+            - skipped (int): The number of thumbnails rendered by the previous runs.
+        """
+        self.total = total
+        self.skipped = skipped
+        self.rendered = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> int:
+        """
+        The number of thumbnails rendered or failed
+        """
+        return self.rendered + self.failed
+
+    def record(self, success: bool) -> None:
+        """
+        Counts a finished thumbnail
+        """
+        with self._lock:
+            if success:
+                self.rendered += 1
+            else:
+                self.failed += 1
+
+    def report(self) -> str:
+        """
+        Returns the progress, the throughput and the estimated remaining time of the run
+        """
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        throughput = self.finished / elapsed
+        remaining = (self.total - self.finished) / throughput if throughput > 0 else float("inf")
+        return (
+            f"{self.finished}/{self.total} thumbnails ({self.rendered} rendered, {self.failed} failed, "
+            f"{self.skipped} already rendered), {throughput:.1f}/s, {remaining:.0f}s remaining"
+        )
+
+
+def prerender(  # pylint: disable=too-many-arguments,too-many-locals
+    items: List[BatchItem],
+    access_token: str,
+    workers: int,
+    rate: float,
+    state_path: Optional[Path] = None,
+    report_interval: float = 10.0,
+) -> PrerenderProgress:
+    """
+    Renders thumbnails into the render cache
+
+    Parameters:
+        - items (list): The thumbnails to render.
+        - access_token (str): The access token the contents are downloaded with.
+        - workers (int): The number of render workers, 0 to render in the downloading threads.
+        - rate (float): The number of downloads from Nexus per second, 0 for no limit.
+        - state_path (Path | None): The file recording the rendered thumbnails, to resume an interrupted run.
+        - report_interval (float): The number of seconds between two progress reports.
+    Returns:
+        The counters of the run
+    """
+    done = read_state(state_path)
+    pending: Dict[str, BatchItem] = {}
+    for item in items:
+        key = item_key(item)
+        if key not in done:
+            pending[key] = item
+    progress = PrerenderProgress(total=len(pending), skipped=len(items) - len(pending))
+    limiter = RateLimiter(rate)
+    state_lock = threading.Lock()
+    state_file = state_path.open("a", encoding="utf-8") if state_path is not None else None
+
+    def render(key: str, item: BatchItem) -> None:
+        limiter.acquire()
+        try:
+            generate_batch_image(access_token, item)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            logger.warning("Could not render the %s of %s: %s", item.type.value, item.content_url, exc)
+            progress.record(success=False)
+            return
+        progress.record(success=True)
+        if state_file is not None:
+            with state_lock:
+                state_file.write(key + "\n")
+                state_file.flush()
+
+    # Enough downloads in flight to keep every render worker busy
+    threads = max(2 * workers, 4)
+    try:
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="prerender") as executor:
+            futures: Set[Future] = {executor.submit(render, key, item) for key, item in pending.items()}
+            try:
+                while futures:
+                    _, futures = wait(futures, timeout=report_interval)
+                    logger.info("%s", progress.report())
+            except KeyboardInterrupt:
+                # The rendered thumbnails are in the state file, the next run resumes from there
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        if state_file is not None:
+            state_file.close()
+    return progress
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parses the command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m api.prerender", description="Pre-renders thumbnails into the render cache"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--urls", type=Path, help="file of lines 'TYPE CONTENT_URL [PARAMETER=VALUE ...]'")
+    source.add_argument("--access-log", type=Path, nargs="+", help="access logs to replay the thumbnail requests of")
+    parser.add_argument("--limit", type=int, help="number of the most requested thumbnails of the access logs")
+    parser.add_argument(
+        "--token",
+        default=os.environ.get(ACCESS_TOKEN_VARIABLE),
+        help=f"access token the contents are downloaded with (default: ${ACCESS_TOKEN_VARIABLE})",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="render workers (default: cores)")
+    parser.add_argument("--rate", type=float, default=20.0, help="downloads from Nexus per second, 0 for no limit")
+    parser.add_argument("--state", type=Path, help="file recording the rendered thumbnails, to resume a run")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="seconds between two progress reports")
+    arguments = parser.parse_args(argv)
+    if not arguments.token:
+        parser.error(f"an access token is required (--token or ${ACCESS_TOKEN_VARIABLE})")
+    return arguments
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Pre-renders the thumbnails given on the command line
+
+    Returns:
+        The exit status: 1 if thumbnails could not be rendered
+    """
+    arguments = parse_arguments(argv)
+    if render_cache.max_bytes <= 0:
+        logger.error("The render cache is disabled (RENDER_CACHE_MAX_MB=0), there is nothing to pre-render")
+        return 2
+
+    if arguments.urls is not None:
+        with arguments.urls.open(encoding="utf-8") as file:
+            items = read_url_list(file)
+    else:
+        lines: List[str] = []
+        for path in arguments.access_log:
+            with path.open(encoding="utf-8", errors="replace") as file:
+                lines.extend(file)
+        items = read_access_log(lines, arguments.limit)
+    logger.info("Pre-rendering %s thumbnails into %s", len(items), render_cache.directory)
+
+    render_executor.start(arguments.workers)
+    if settings.simulation_plot_engine == SimulationPlotEngine.PLOTLY and kaleido_pool.size > 0:
+        kaleido_pool.start()
+    try:
+        progress = prerender(
+            items, arguments.token, arguments.workers, arguments.rate, arguments.state, arguments.report_interval
+        )
+    finally:
+        render_executor.stop()
+        kaleido_pool.stop()
+    return 1 if progress.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,22 +2,46 @@
 Module: generate.py
 
 This module defines a FastAPI router for handling requests related to morphology images.
-It includes an endpoint to get a preview image of a morphology.
+It includes an endpoint to get a preview image of a morphology, endpoints returning the
+plotted series as compact binary data so that clients can draw them themselves, endpoints
+generating a batch of thumbnails at once, or a sprite sheet of them, and endpoints serving
+large morphologies as deep-zoom tile pyramids.
 """
 
 from http import HTTPStatus as status
-from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer
-from api.services.trace_img import generate_electrophysiology_image
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from api.services.admission import admission_queues
+from api.services.batch import batch_stream_encoder, build_batch_archive, generate_batch, stream_batch
+from api.services.sprite_sheet import compose_sprite_sheet, encode_sprite_sheet, sheet_shape, sprite_item
+from api.services.trace_img import generate_electrophysiology_image, generate_electrophysiology_series
 from api.services.morpho_img import generate_morphology_image
-from api.services.simulation_img import generate_simulation_plots
+from api.services.morpho_tiles import MAX_ZOOM, generate_morphology_tile, generate_morphology_tile_info
+from api.services.simulation_img import (
+    generate_simulation_grid,
+    generate_simulation_plots,
+    generate_simulation_series,
+)
 from api.dependencies import retrieve_user
 from api.models.common import (
+    BatchInput,
     ErrorMessage,
     ImageGenerationInput,
+    MorphologyTileInput,
+    SimulationDataInput,
     SimulationGenerationInput,
+    SimulationGridInput,
+    SpriteSheetInput,
+    TraceDataInput,
 )
+from api.models.enums import BatchFormat, Lane
+from api.settings import settings
 from api.user import User
+from api.utils.cancellation import cancel_on_disconnect
+from api.utils.series import SERIES_MEDIA_TYPE
 
 
 router = APIRouter()
@@ -27,22 +51,93 @@ require_bearer = HTTPBearer()
 @router.get(
     "/morphology-image",
     dependencies=[Depends(require_bearer)],
-    responses={404: {"model": ErrorMessage}, 422: {"model": ErrorMessage}},
+    responses={
+        404: {"model": ErrorMessage},
+        422: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
     response_model=None,
 )
-def get_morphology_image(
-    image_input: ImageGenerationInput = Depends(), user: User = Depends(retrieve_user)
+async def get_morphology_image(
+    request: Request, image_input: ImageGenerationInput = Depends(), user: User = Depends(retrieve_user)
 ) -> Response:
     """
     Endpoint to get a preview image of a morphology.
     Sample Content URL:
     https://bbp.epfl.ch/nexus/v1/files/bbp/mouselight/https%3A%2F%2Fbbp.epfl.ch%2Fnexus%2Fv1%2Fresources%2Fbbp%2Fmouselight%2F_%2F0befd25c-a28a-4916-9a8a-adcd767db118
     """
-    image = generate_morphology_image(
-        access_token=user.access_token,
-        content_url=image_input.content_url,
-        dpi=image_input.dpi,
-    )
+    async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.MORPHOLOGY].admit():
+        image = await run_in_threadpool(
+            generate_morphology_image,
+            access_token=user.access_token,
+            content_url=image_input.content_url,
+            dpi=image_input.dpi,
+        )
+
+    return Response(image, media_type="image/png")
+
+
+@router.get(
+    "/morphology-tiles",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        404: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+)
+async def get_morphology_tile_info(
+    request: Request, tile_input: MorphologyTileInput = Depends(), user: User = Depends(retrieve_user)
+) -> dict:
+    """
+    Endpoint to get the description of the deep-zoom tile pyramid of a morphology: the size of its tiles
+    in pixels, its deepest zoom level, and the origin (minimal x and y) and the side of the square it
+    covers, in microns
+    """
+    async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.MORPHOLOGY].admit():
+        return await run_in_threadpool(
+            generate_morphology_tile_info,
+            access_token=user.access_token,
+            content_url=tile_input.content_url,
+        )
+
+
+@router.get(
+    "/morphology-tiles/{z}/{x}/{y}",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        200: {"content": {"image/png": {}}},
+        404: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+    response_model=None,
+)
+async def get_morphology_tile(  # pylint: disable=too-many-arguments
+    request: Request,
+    z: int = Path(ge=0, le=MAX_ZOOM, description="Zoom level, 0 for the whole morphology in one tile"),
+    x: int = Path(ge=0, description="Column of the tile, from the left"),
+    y: int = Path(ge=0, description="Row of the tile, from the top"),
+    tile_input: MorphologyTileInput = Depends(),
+    user: User = Depends(retrieve_user),
+) -> Response:
+    """
+    Endpoint to get a tile of the deep-zoom tile pyramid of a morphology (see /generate/morphology-tiles),
+    which has 2^z x 2^z tiles at the zoom level z
+    """
+    async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.MORPHOLOGY].admit():
+        image = await run_in_threadpool(
+            generate_morphology_tile,
+            access_token=user.access_token,
+            content_url=tile_input.content_url,
+            z=z,
+            x=x,
+            y=y,
+        )
 
     return Response(image, media_type="image/png")
 
@@ -50,20 +145,29 @@ def get_morphology_image(
 @router.get(
     "/trace-image",
     dependencies=[Depends(require_bearer)],
-    responses={404: {"model": ErrorMessage}},
+    responses={
+        404: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
     response_model=None,
 )
-def get_trace_image(image_input: ImageGenerationInput = Depends(), user: User = Depends(retrieve_user)) -> Response:
+async def get_trace_image(
+    request: Request, image_input: ImageGenerationInput = Depends(), user: User = Depends(retrieve_user)
+) -> Response:
     """
     Endpoint to get a preview image of an electrophysiology trace
     Sample Content URL:
     https://bbp.epfl.ch/nexus/v1/files/public/hippocampus/https%3A%2F%2Fbbp.epfl.ch%2Fneurosciencegraph%2Fdata%2Fb67a2aa6-d132-409b-8de5-49bb306bb251
     """
-    image = generate_electrophysiology_image(
-        access_token=user.access_token,
-        content_url=image_input.content_url,
-        dpi=image_input.dpi,
-    )
+    async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.TRACE].admit():
+        image = await run_in_threadpool(
+            generate_electrophysiology_image,
+            access_token=user.access_token,
+            content_url=image_input.content_url,
+            dpi=image_input.dpi,
+        )
 
     return Response(image, media_type="image/png")
 
@@ -71,24 +175,225 @@ def get_trace_image(image_input: ImageGenerationInput = Depends(), user: User =
 @router.get(
     "/simulation-plot",
     dependencies=[Depends(require_bearer)],
-    responses={404: {"model": ErrorMessage}},
+    responses={
+        404: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
     response_model=None,
 )
-def get_simulation_plot(config: SimulationGenerationInput = Depends(), user: User = Depends(retrieve_user)) -> Response:
+async def get_simulation_plot(
+    request: Request, config: SimulationGenerationInput = Depends(), user: User = Depends(retrieve_user)
+) -> Response:
     """
     Endpoint to get a preview image of an simulation plots
     Sample Content URL:
     https://sbo-nexus-delta.shapes-registry.org/v1/files/cad43d74-f697-48d6-9242-28cb6b4a4956/f9b265b2-22c3-4a92-9ad5-79dff37e39ca/https%3A%2F%2Fopenbrainplatform.org%2Fdata%2Fcad43d74-f697-48d6-9242-28cb6b4a4956%2Ff9b265b2-22c3-4a92-9ad5-79dff37e39ca%2Feadf0aa4-109c-4422-806c-325e5669565a?rev=1
     """
     try:
-        image = generate_simulation_plots(
-            access_token=user.access_token,
-            config=config,
-        )
+        async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.SIMULATION].admit():
+            image = await run_in_threadpool(
+                generate_simulation_plots,
+                access_token=user.access_token,
+                config=config,
+            )
         if image is None:
             raise HTTPException(status_code=status.NOT_FOUND, detail="Simulation results data not found")
         return Response(image, media_type="image/png")
+    except HTTPException:
+        raise
+    except ValueError as exc:
+        raise HTTPException(status.BAD_GATEWAY, "Simulation config file is malformed") from exc
+    except Exception as exc:
+        raise HTTPException(status.INTERNAL_SERVER_ERROR, "Internal server error") from exc
+
+
+@router.get(
+    "/simulation-grid",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        404: {"model": ErrorMessage},
+        422: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+    response_model=None,
+)
+async def get_simulation_grid(
+    request: Request, config: SimulationGridInput = Depends(), user: User = Depends(retrieve_user)
+) -> Response:
+    """
+    Endpoint to get the stimulus and the recorded locations of a simulation as small multiples in one image,
+    up to 36 panels (422 above, the locations can be selected)
+    """
+    try:
+        async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.SIMULATION].admit():
+            image = await run_in_threadpool(
+                generate_simulation_grid,
+                access_token=user.access_token,
+                config=config,
+            )
+        return Response(image, media_type="image/png")
+    except HTTPException:
+        raise
+    except ValueError as exc:
+        raise HTTPException(status.BAD_GATEWAY, "Simulation config file is malformed") from exc
+    except Exception as exc:
+        raise HTTPException(status.INTERNAL_SERVER_ERROR, "Internal server error") from exc
+
+
+@router.get(
+    "/trace-data",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        404: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+    response_model=None,
+)
+async def get_trace_data(
+    request: Request, data_input: TraceDataInput = Depends(), user: User = Depends(retrieve_user)
+) -> Response:
+    """
+    Endpoint to get the sweep shown in the electrophysiology trace preview as decimated float32 series
+    (see api/utils/series.py for the binary format)
+    """
+    async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.TRACE].admit():
+        data = await run_in_threadpool(
+            generate_electrophysiology_series,
+            access_token=user.access_token,
+            content_url=data_input.content_url,
+            max_points=data_input.max_points,
+        )
+
+    return Response(data, media_type=SERIES_MEDIA_TYPE)
+
+
+@router.get(
+    "/simulation-data",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        404: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+    response_model=None,
+)
+async def get_simulation_data(
+    request: Request, config: SimulationDataInput = Depends(), user: User = Depends(retrieve_user)
+) -> Response:
+    """
+    Endpoint to get the series of the simulation plot preview as decimated float32 series
+    (see api/utils/series.py for the binary format)
+    """
+    try:
+        async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.SIMULATION].admit():
+            data = await run_in_threadpool(
+                generate_simulation_series,
+                access_token=user.access_token,
+                config=config,
+            )
+        return Response(data, media_type=SERIES_MEDIA_TYPE)
+    except HTTPException:
+        raise
     except ValueError as exc:
         raise HTTPException(status.BAD_GATEWAY, "Simulation config file is malformed") from exc
     except Exception as exc:
         raise HTTPException(status.INTERNAL_SERVER_ERROR, "Internal server error") from exc
+
+
+@router.post(
+    "/batch",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        200: {"content": {"application/zip": {}, "application/x-ndjson": {}, "multipart/mixed": {}}},
+        422: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+    response_model=None,
+)
+async def get_batch(
+    request: Request,
+    batch: BatchInput,
+    output_format: BatchFormat = Query(
+        BatchFormat.ZIP, alias="format", description="ZIP archive, or NDJSON/multipart stream in completion order"
+    ),
+    user: User = Depends(retrieve_user),
+) -> Response:
+    """
+    Endpoint to get the thumbnails of up to 200 resources at once. Every item takes the parameters
+    of the endpoint of its type, e.g.
+    {"items": [{"type": "morphology-image", "content_url": "...", "dpi": 72},
+    {"type": "simulation-plot", "content_url": "...", "target": "stimulus"}]}
+
+    - zip: an archive of {index}.png images and of a manifest.json giving the status of every item,
+      and the error detail of the failed ones, sent once all the items are finished
+    - ndjson: a line per item with its index, status and base64 encoded image (or error detail),
+      sent as soon as the item is finished
+    - multipart: a multipart/mixed part per item with its image (or JSON error detail), whose
+      Content-ID is the index of the item, sent as soon as the item is finished
+    """
+    if output_format != BatchFormat.ZIP:
+        media_type, encode, end = batch_stream_encoder(output_format)
+        return StreamingResponse(
+            stream_batch(
+                user.access_token,
+                batch.items,
+                settings.batch_concurrency,
+                settings.batch_request_timeout,
+                encode,
+                end,
+            ),
+            media_type=media_type,
+        )
+
+    async with cancel_on_disconnect(request, settings.batch_request_timeout):
+        results = [
+            result async for result in generate_batch(user.access_token, batch.items, settings.batch_concurrency)
+        ]
+
+    return Response(
+        build_batch_archive(results),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="thumbnails.zip"'},
+    )
+
+
+@router.post(
+    "/sprite-sheet",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        200: {"content": {"multipart/form-data": {}}},
+        422: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+    response_model=None,
+)
+async def get_sprite_sheet(request: Request, grid: SpriteSheetInput, user: User = Depends(retrieve_user)) -> Response:
+    """
+    Endpoint to get the thumbnails of up to 200 resources as a single PNG sprite sheet, with cells of a fixed size
+    filled row by row in the order of the items (which take the parameters of the endpoint of their type, as in
+    /generate/batch). The response is a multipart/form-data body with two fields:
+
+    - map: a JSON object with the size of the sheet and of its cells, and the offset (x, y), the status and the
+      error detail (if any) of every cell
+    - image: the PNG sprite sheet, whose failed cells are transparent
+
+    The sheet is at most 8192 pixels wide and high, a larger grid is rejected with a 422.
+    """
+    # Rejected before rendering any of its items
+    sheet_shape(len(grid.items), grid.cell_width, grid.cell_height, grid.columns)
+    items = [sprite_item(item, grid.cell_width, grid.cell_height) for item in grid.items]
+    async with cancel_on_disconnect(request, settings.batch_request_timeout):
+        results = [result async for result in generate_batch(user.access_token, items, settings.batch_concurrency)]
+        image, sprite_map = await run_in_threadpool(
+            compose_sprite_sheet, results, grid.cell_width, grid.cell_height, grid.columns
+        )
+
+    body, media_type = encode_sprite_sheet(image, sprite_map)
+    return Response(body, media_type=media_type)
@@ -1,10 +1,15 @@
 """
 Module: health.py
 
-This module provides a simple health check endpoint for the web server.
+This module provides a simple health check endpoint for the web server, and the metrics
+of the admission queues and of the Kaleido renderer pool (per API worker process) in the
+Prometheus text format.
 """
 
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from api.services.admission import render_metrics
+from api.services.kaleido_pool import kaleido_pool
 
 
 router = APIRouter()
@@ -12,5 +17,13 @@ router = APIRouter()
 
 @router.get("/health")
 async def health():
-    """Simple health check endpoint"""
+    """Simple health check endpoint, degraded when the Kaleido pool is started without any live renderer"""
+    if kaleido_pool.started and kaleido_pool.alive() == 0:
+        return {"status": "DEGRADED", "detail": "No Kaleido renderer is alive"}
     return {"status": "OK"}
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Depth, throughput and waiting time of the admission queues, and live renderers of the Kaleido pool"""
+    return render_metrics()
@@ -2,28 +2,47 @@
 Module: swc.py
 
 This module takes a SWC file of a neuron morphology and processes its
-soma using NeuroMorphoVis simulations. It has two endpoints, one for
-processing a SWC file uploaded by the user and another for fetching a
-SWC file from Nexus Delta and processing it.
+soma using NeuroMorphoVis simulations. The SWC file is fetched from
+Nexus Delta or uploaded, and processed either while the request waits, or as
+a job that is submitted, polled and whose result is downloaded once finished.
+A Blender-free approximation of the soma is also available for previews.
 """
 
-import os
-import subprocess
+import asyncio
+import time
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, Query, Response
 from fastapi.responses import FileResponse
 from fastapi.security import HTTPBearer
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 
-from api.dependencies import retrieve_user
+from api.dependencies import retrieve_identified_user, retrieve_user
+from api.exceptions import JobNotFinishedException, JobNotFoundException
+from api.models.common import ErrorMessage
+from api.models.enums import JobStatus, Lane, SomaApproximationFormat, SomaQuality
+from api.models.soma import SomaExportOptions, SomaJob, SomaJobInput
+from api.services.admission import admission_queues, current_priority
+from api.settings import settings
+from api.user import User
+from api.utils.cancellation import cancel_after, cancel_on_disconnect
 from api.utils.logger import logger
-from api.services.nexus import fetch_file_content
+from api.utils.upload import receive_multipart_file
+from api.services.nexus import check_file_access, fetch_file_content
+from api.services.disk_cache import cache_key, cache_key_of_digest
+from api.services.mesh_cache import mesh_cache
+from api.services.soma_approximation import generate_soma_approximation
+from api.services.soma import reconstruct_soma, reconstruction_options, work_directory
+from api.services.soma_jobs import JOB_POLL_INTERVAL, SWC_FILE_NAME, soma_job_store, soma_job_workers
 
 router = APIRouter()
 require_bearer = HTTPBearer()
 
+# Maximum number of seconds a status request waits for its job, below the proxy timeout
+MAX_JOB_WAIT = 50
+
 
 @router.get(
     "/process-nexus-swc",
@@ -32,56 +51,247 @@ require_bearer = HTTPBearer()
 async def process_soma(
     request: Request,
     content_url: str = Query(..., description="URL of the SWC file to process"),
+    quality: SomaQuality = Query(SomaQuality.STANDARD, description="Quality/speed preset of the reconstruction"),
+    export: SomaExportOptions = Depends(),
 ) -> FileResponse:
     """Process the SWC file fetched from the given URL and return the generated mesh file."""
 
     logger.info("Fetching SWC file from URL: %s", content_url)
     user = retrieve_user(request)
-    file_content = fetch_file_content(user.access_token, content_url)
-
-    temp_file_path = ""
-    try:
-        with NamedTemporaryFile(delete=False, suffix=".swc") as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        logger.info("Temporary SWC file created at: %s", temp_file_path)
-
-        current_directory = Path(__file__).parent
-        output_directory = current_directory.parent.parent / "output"
-        meshes_directory = output_directory / "meshes"
-        meshes_directory.mkdir(exist_ok=True, parents=True)
-
-        script_path = current_directory.parent.parent / "neuromorphovis.py"
-        blender_executable_path = current_directory.parent.parent / "blender/bbp-blender-3.5/blender-bbp/blender"
-
-        logger.info("Running NMV script...")
-        command = [
-            "python",
-            script_path.as_posix(),
-            f"--blender={blender_executable_path.as_posix()}",
-            "--input=file",
-            f"--morphology-file={temp_file_path}",
-            "--export-soma-mesh-blend",
-            "--export-soma-mesh-obj",
-            f"--output-directory={output_directory.as_posix()}",
-        ]
-
-        subprocess.run(command, check=True)
-        logger.info("Completed NMV script execution.")
-
-        target_name = Path(temp_file_path).stem
-        for mesh_file in meshes_directory.iterdir():
-            if mesh_file.suffix == ".glb" and mesh_file.stem.replace("SOMA_MESH_", "") == target_name:
-                return FileResponse(
-                    path=mesh_file,
-                    media_type="model/gltf+json",
-                    filename=mesh_file.name,
-                )
-
-        logger.error("OBJ file not found after processing.")
-        raise HTTPException(status_code=404, detail="OBJ file not found after processing.")
-    finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-            logger.info("Temporary file deleted: %s", temp_file_path)
+
+    async with cancel_on_disconnect(request, settings.soma_request_timeout):
+        file_content = await run_in_threadpool(fetch_file_content, user.access_token, content_url)
+
+        # Cache hits do not wait for a Blender run
+        mesh_key = cache_key(file_content, reconstruction_options(quality, export))
+        cached_mesh = await find_cached_mesh(mesh_key)
+        if cached_mesh is not None:
+            return mesh_response(cached_mesh)
+
+        async with admission_queues[Lane.SOMA].admit():
+            return mesh_response(await process_swc_content(file_content, mesh_key, quality, export))
+
+
+@router.post(
+    "/process-swc",
+    dependencies=[Depends(require_bearer), Depends(retrieve_user)],
+    responses={
+        413: {"model": ErrorMessage},
+        422: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+    # The body is streamed by the handler rather than declared as a parameter
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                        "required": ["file"],
+                    }
+                }
+            },
+        }
+    },
+)
+async def process_uploaded_soma(
+    request: Request,
+    quality: SomaQuality = Query(SomaQuality.STANDARD, description="Quality/speed preset of the reconstruction"),
+    export: SomaExportOptions = Depends(),
+) -> FileResponse:
+    """
+    Process the SWC file uploaded in the 'file' field of a multipart body and return the generated
+    mesh file. The file is streamed to the disk as it is received, within the deadline of the request,
+    and rejected with a 413 above the size limit, or with a 429 before it is received if the soma
+    lane is full.
+    """
+    # Rejected before its body is received, if it could not even wait for its turn
+    admission_queues[Lane.SOMA].reject_if_full()
+
+    async with cancel_after(settings.soma_request_timeout) as deadline:
+        with work_directory() as directory:
+            swc_path = directory / SWC_FILE_NAME
+            content_digest = await receive_multipart_file(request, "file", swc_path, settings.soma_upload_max_bytes)
+            logger.info("Uploaded SWC file received at: %s", swc_path)
+
+            async with cancel_on_disconnect(request, deadline.remaining()):
+                mesh_key = cache_key_of_digest(content_digest, reconstruction_options(quality, export))
+                cached_mesh = await find_cached_mesh(mesh_key)
+                if cached_mesh is not None:
+                    return mesh_response(cached_mesh)
+
+                async with admission_queues[Lane.SOMA].admit():
+                    return mesh_response(await reconstruct_swc_file(swc_path, directory, mesh_key, quality, export))
+            cached_mesh = await find_cached_mesh(mesh_key)
+            if cached_mesh is not None:
+                return mesh_response(cached_mesh)
+
+            async with admission_queues[Lane.SOMA].admit():
+                return mesh_response(await reconstruct_swc_file(swc_path, directory, mesh_key, quality, export))
+
+
+def mesh_response(mesh_file: Path) -> FileResponse:
+    """Returns a response streaming a GLB mesh file from the disk."""
+    return FileResponse(path=mesh_file, media_type="model/gltf+json", filename=mesh_file.name)
+
+
+async def find_cached_mesh(mesh_key: str) -> Optional[Path]:
+    """Returns the cached mesh of a cache key, if any."""
+    cached_mesh = await run_in_threadpool(mesh_cache.get, mesh_key)
+    if cached_mesh is not None:
+        logger.info("Soma mesh found in cache: %s", cached_mesh)
+    return cached_mesh
+
+
+async def process_swc_content(
+    file_content: bytes, mesh_key: str, quality: SomaQuality, export: SomaExportOptions
+) -> Path:
+    """
+    Runs the NMV script on the SWC file content in a working directory of its own, and returns the
+    generated mesh file once added to the mesh cache
+    """
+    with work_directory() as directory:
+        swc_path = directory / SWC_FILE_NAME
+        swc_path.write_bytes(file_content)
+        logger.info("SWC file created at: %s", swc_path)
+        return await reconstruct_swc_file(swc_path, directory, mesh_key, quality, export)
+
+
+async def reconstruct_swc_file(
+    swc_path: Path, directory: Path, mesh_key: str, quality: SomaQuality, export: SomaExportOptions
+) -> Path:
+    """
+    Runs the NMV script on a SWC file of a working directory, and returns the generated mesh file
+    once added to the mesh cache
+    """
+    mesh_file = await run_in_threadpool(reconstruct_soma, swc_path, directory, current_priority(), quality, export)
+    # Hard linked into the cache, so that it survives the working directory
+    return await run_in_threadpool(mesh_cache.put, mesh_key, mesh_file)
+
+
+@router.get(
+    "/approximate-nexus-swc",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        404: {"model": ErrorMessage},
+        422: {"model": ErrorMessage},
+        429: {"model": ErrorMessage},
+        503: {"model": ErrorMessage},
+        504: {"model": ErrorMessage},
+    },
+    response_model=None,
+)
+async def approximate_soma(
+    request: Request,
+    content_url: str = Query(..., description="URL of the SWC file to process"),
+    output_format: SomaApproximationFormat = Query(
+        SomaApproximationFormat.GLB, alias="format", description="GLB mesh or PNG profile"
+    ),
+    dpi: Optional[int] = Query(72, ge=10, le=600, description="Dots Per Inch of the PNG profile"),
+    user: User = Depends(retrieve_user),
+) -> Response:
+    """
+    Approximates the soma of the SWC file fetched from the given URL without Blender, from its soma
+    points and the first point of each neurite, and returns it as a GLB mesh or a PNG profile. Meant
+    for instant previews, while the soft body reconstruction runs as a job.
+    """
+    async with cancel_on_disconnect(request, settings.request_timeout), admission_queues[Lane.MORPHOLOGY].admit():
+        result = await run_in_threadpool(
+            generate_soma_approximation, user.access_token, content_url, output_format, dpi
+        )
+
+    if output_format == SomaApproximationFormat.PNG:
+        return Response(result, media_type="image/png")
+    return Response(result, media_type="model/gltf-binary")
+
+
+@router.post(
+    "/jobs",
+    dependencies=[Depends(require_bearer)],
+    status_code=202,
+    responses={404: {"model": ErrorMessage}, 422: {"model": ErrorMessage}, 429: {"model": ErrorMessage}},
+)
+async def submit_soma_job(
+    request: Request,
+    response: Response,
+    job_input: SomaJobInput = Depends(),
+    export: SomaExportOptions = Depends(),
+    user: User = Depends(retrieve_identified_user),
+) -> SomaJob:
+    """
+    Submits the reconstruction of the soma of the SWC file fetched from the given URL, and returns
+    its job. A job of the same user, SWC content and quality is reused if it is not failed or expired.
+    """
+    async with cancel_on_disconnect(request, settings.request_timeout):
+        file_content = await run_in_threadpool(fetch_file_content, user.access_token, job_input.content_url)
+    job, created = await run_in_threadpool(
+        soma_job_store.submit, file_content, job_input.quality, export, user.username, job_input.content_url
+    )
+    if created:
+        logger.info("Submitted soma job %s for %s", job.id, job_input.content_url)
+        soma_job_workers.wake_up()
+
+    response.headers["Location"] = request.url_for("get_soma_job", job_id=job.id).path
+    return job
+
+
+@router.get(
+    "/jobs/{job_id}",
+    dependencies=[Depends(require_bearer)],
+    responses={401: {"model": ErrorMessage}, 403: {"model": ErrorMessage}, 404: {"model": ErrorMessage}},
+)
+async def get_soma_job(
+    request: Request,
+    job_id: str,
+    wait: float = Query(0, ge=0, le=MAX_JOB_WAIT, description="Seconds to wait for the job to finish (long polling)"),
+    user: User = Depends(retrieve_identified_user),
+) -> SomaJob:
+    """
+    Returns the status of a soma reconstruction job of the user, once it is finished or after waiting
+    for it at most the given number of seconds. The user must still have access to its SWC file.
+    """
+    async with cancel_on_disconnect(request, None):
+        deadline = time.monotonic() + wait
+        job = await run_in_threadpool(soma_job_store.get, job_id, user.username)
+        if job is None:
+            raise JobNotFoundException
+        await run_in_threadpool(check_file_access, user.access_token, job.content_url)
+        while job is not None and not job.status.finished and time.monotonic() < deadline:
+            await asyncio.sleep(min(JOB_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+            job = await run_in_threadpool(soma_job_store.get, job_id, user.username)
+
+    if job is None:
+        raise JobNotFoundException
+    return job
+
+
+@router.get(
+    "/jobs/{job_id}/result",
+    dependencies=[Depends(require_bearer)],
+    responses={
+        401: {"model": ErrorMessage},
+        403: {"model": ErrorMessage},
+        404: {"model": ErrorMessage},
+        409: {"model": ErrorMessage},
+    },
+    response_model=None,
+)
+async def get_soma_job_result(
+    request: Request, job_id: str, user: User = Depends(retrieve_identified_user)
+) -> FileResponse:
+    """
+    Returns the soma mesh reconstructed by a succeeded job of the user, who must still have access to its SWC file
+    """
+    job = await run_in_threadpool(soma_job_store.get, job_id, user.username)
+    if job is None:
+        raise JobNotFoundException
+    async with cancel_on_disconnect(request, settings.request_timeout):
+        await run_in_threadpool(check_file_access, user.access_token, job.content_url)
+    if job.status != JobStatus.SUCCEEDED or job.mesh_path is None:
+        raise JobNotFinishedException(job.status.value)
+
+    return mesh_response(Path(job.mesh_path))
@@ -0,0 +1,226 @@
+"""
+Module: admission.py
+
+This module implements the admission control in front of the generators.
+
+Every lane (kind of work) has a bounded queue: at most `concurrency` requests are processed at the
+same time, at most `max_depth` requests wait for their turn, and none of them waits longer than
+`max_wait` seconds. The lanes are independent, so that e.g. soma reconstructions cannot take the
+capacity of the thumbnails, and the priority of the lane is made current for the admitted work.
+Requests over these limits are answered immediately with a 429/503 and a Retry-After computed from
+the current queue and the average processing time, instead of piling up until the gunicorn timeout
+kills the worker.
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Deque, Dict
+
+from api.exceptions import QueueFullException, QueueTimeoutException
+from api.models.enums import Lane
+from api.services.kaleido_pool import kaleido_pool
+from api.settings import QueueSettings, settings
+
+# Weight of the last processing time in its exponential moving average
+SERVICE_TIME_SMOOTHING = 0.2
+
+_current_priority: ContextVar[int] = ContextVar("lane_priority", default=0)
+
+
+def current_priority() -> int:
+    """
+    Returns the priority (niceness) of the lane of the current request, 0 outside of a lane
+    """
+    return _current_priority.get()
+
+
+class QueueStats:
+    """
+    Counters of an admission queue, exported as metrics
+    """
+
+    def __init__(self) -> None:
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.timed_out_total = 0
+        self.wait_seconds_sum = 0.0
+        # Exponential moving average of the processing time
+        self.service_seconds = 1.0
+
+    def record_admission(self, wait_seconds: float) -> None:
+        """
+        Counts an admitted request and its waiting time
+        """
+        self.admitted_total += 1
+        self.wait_seconds_sum += wait_seconds
+
+    def record_service(self, seconds: float) -> None:
+        """
+        Updates the average processing time with the one of a finished request
+        """
+        self.service_seconds += SERVICE_TIME_SMOOTHING * (seconds - self.service_seconds)
+
+
+class AdmissionQueue:
+    """
+    Bounded waiting queue in front of a limited number of concurrent requests
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, lane: Lane, concurrency: int, max_depth: int, max_wait: float, priority: int = 0
+    ) -> None:
+        """
+        Parameters:
+            - lane (Lane): The lane of the queue.
+            - concurrency (int): The number of requests processed at the same time.
+            - max_depth (int): The number of requests that can wait for their turn.
+            - max_wait (float): The maximum number of seconds a request waits for its turn.
+            - priority (int): The priority (niceness) of the admitted work.
+        """
+        self.lane = lane
+        self.limits = QueueSettings(concurrency=concurrency, max_depth=max_depth, max_wait=max_wait, priority=priority)
+        self.active = 0
+        self.stats = QueueStats()
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def depth(self) -> int:
+        """
+        The number of requests waiting for their turn
+        """
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """
+        Estimates in how many seconds a new request would be processed
+        """
+        return max(1, math.ceil(self.stats.service_seconds * (self.depth + 1) / max(self.limits.concurrency, 1)))
+
+    def reject_if_full(self) -> None:
+        """
+        Rejects a request that could neither be processed nor wait for its turn right now, e.g.
+        before receiving its body
+
+        Raises:
+            QueueFullException: If the queue is full (429).
+        """
+        if self.active < self.limits.concurrency and not self._waiters:
+            return
+        if self.depth >= self.limits.max_depth:
+            self.stats.rejected_total += 1
+            raise QueueFullException(self.retry_after())
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """
+        Waits for the turn of the request and holds its slot until the end of the context, in which
+        the priority of the lane is the current one (also in the threads started from it)
+
+        Raises:
+            QueueFullException: If the queue is full (429).
+            QueueTimeoutException: If the turn did not come within max_wait (503).
+        """
+        enqueued_at = time.monotonic()
+        await self._acquire()
+        started_at = time.monotonic()
+        self.stats.record_admission(started_at - enqueued_at)
+        reset_priority = _current_priority.set(self.limits.priority)
+        try:
+            yield
+        finally:
+            _current_priority.reset(reset_priority)
+            self.stats.record_service(time.monotonic() - started_at)
+            self._release()
+
+    async def _acquire(self) -> None:
+        if self.active < self.limits.concurrency and not self._waiters:
+            self.active += 1
+            return
+
+        self.reject_if_full()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.limits.max_wait)
+        except asyncio.TimeoutError as exc:
+            if waiter.done():
+                # The slot was handed over right at the deadline
+                return
+            waiter.cancel()
+            self._waiters.remove(waiter)
+            self.stats.timed_out_total += 1
+            raise QueueTimeoutException(self.retry_after()) from exc
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over at the same time, give it to the next request
+                self._release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self) -> None:
+        # Hand the slot over to the first waiting request, if any
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+def create_admission_queues() -> Dict[Lane, AdmissionQueue]:
+    """
+    Creates the admission queue of every lane from the settings
+    """
+    queues = {}
+    for lane in Lane:
+        queue_settings = settings.queue_settings(lane)
+        queues[lane] = AdmissionQueue(
+            lane,
+            concurrency=queue_settings.concurrency,
+            max_depth=queue_settings.max_depth,
+            max_wait=queue_settings.max_wait,
+            priority=queue_settings.priority,
+        )
+    return queues
+
+
+admission_queues = create_admission_queues()
+
+
+def render_metrics() -> str:
+    """
+    Returns the metrics of the admission queues and of the Kaleido renderer pool in the Prometheus text format
+    """
+    metrics = [
+        ("thumbnail_queue_depth", "gauge", "Requests waiting for their turn", lambda q: q.depth),
+        ("thumbnail_queue_active", "gauge", "Requests being processed", lambda q: q.active),
+        ("thumbnail_queue_admitted_total", "counter", "Admitted requests", lambda q: q.stats.admitted_total),
+        ("thumbnail_queue_rejected_total", "counter", "Requests rejected with 429", lambda q: q.stats.rejected_total),
+        ("thumbnail_queue_timed_out_total", "counter", "Requests rejected with 503", lambda q: q.stats.timed_out_total),
+        ("thumbnail_queue_wait_seconds_sum", "counter", "Total waiting time", lambda q: q.stats.wait_seconds_sum),
+        ("thumbnail_queue_service_seconds", "gauge", "Average processing time", lambda q: q.stats.service_seconds),
+    ]
+    lines = []
+    for name, metric_type, description, value in metrics:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for queue in admission_queues.values():
+            lines.append(f'{name}{{lane="{queue.lane.value}"}} {value(queue)}')
+
+    pool_metrics = [
+        (
+            "kaleido_renderers",
+            "Renderers of the started Kaleido pool",
+            kaleido_pool.size if kaleido_pool.started else 0,
+        ),
+        ("kaleido_renderers_alive", "Kaleido renderers whose Chromium process is running", kaleido_pool.alive()),
+    ]
+    for name, description, count in pool_metrics:
+        lines.extend([f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {count}"])
+    return "\n".join(lines) + "\n"
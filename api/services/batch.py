@@ -0,0 +1,239 @@
+"""
+Module: batch.py
+
+This module generates the thumbnails of a batch request, e.g. the 50-200 thumbnails of a gallery page.
+
+The user is authenticated once for the whole batch, and the thumbnails are generated concurrently:
+their downloads share the connections of the Nexus session, and their renders run in parallel on
+the render executor. Every thumbnail goes through the admission queue of its lane like a single
+request, and the number of thumbnails of a batch in flight is bounded, so that a batch cannot take
+the whole capacity of a lane. A failed thumbnail does not fail the batch: its error is reported
+with the others.
+
+The results are either sent at once as a ZIP archive, or streamed in the order they are finished
+(as NDJSON or multipart/mixed), so that clients show the first thumbnails without waiting for the
+slowest one, and the finished thumbnails are sent instead of being held in memory.
+"""
+
+import asyncio
+import base64
+import io
+import json
+import zipfile
+from http import HTTPStatus as status
+from typing import AsyncIterator, Callable, List, NamedTuple, Optional, Tuple
+from uuid import uuid4
+
+import requests
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from api.models.common import BatchItem, SimulationGenerationInput
+from api.models.enums import BatchFormat, BatchItemType
+from api.services.admission import admission_queues
+from api.services.morpho_img import generate_morphology_image
+from api.services.simulation_img import generate_simulation_plots
+from api.services.trace_img import generate_electrophysiology_image
+from api.utils.cancellation import CancellationToken, cancellation_scope, current_cancellation
+from api.utils.logger import logger
+
+BATCH_ARCHIVE_MANIFEST = "manifest.json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class BatchResult(NamedTuple):
+    """
+    The thumbnail of an item of a batch, or the error that prevented its generation
+    """
+
+    index: int
+    item: BatchItem
+    status: int
+    image: Optional[bytes] = None
+    detail: Optional[str] = None
+
+    @property
+    def file_name(self) -> str:
+        """
+        The name of the file of the thumbnail
+        """
+        return f"{self.index}.png"
+
+    def to_manifest(self) -> dict:
+        """
+        Returns the description of the result, without its image
+        """
+        entry = {
+            "index": self.index,
+            "type": self.item.type.value,
+            "content_url": self.item.content_url,
+            "status": self.status,
+        }
+        if self.image is not None:
+            entry["file"] = self.file_name
+        else:
+            entry["detail"] = self.detail
+        return entry
+
+
+def generate_batch_image(access_token: str, item: BatchItem) -> bytes:
+    """
+    Generates the thumbnail of an item of a batch, as its endpoint would
+
+    Raises:
+        HTTPException: If the thumbnail cannot be generated, with the status its endpoint would answer.
+    """
+    if item.type == BatchItemType.MORPHOLOGY_IMAGE:
+        return generate_morphology_image(access_token, item.content_url, item.dpi)
+    if item.type == BatchItemType.TRACE_IMAGE:
+        return generate_electrophysiology_image(access_token, item.content_url, item.dpi)
+
+    config = SimulationGenerationInput(content_url=item.content_url, target=item.target, w=item.w, h=item.h)
+    try:
+        image = generate_simulation_plots(access_token, config)
+    except ValueError as exc:
+        raise HTTPException(status.BAD_GATEWAY, "Simulation config file is malformed") from exc
+    if image is None:
+        raise HTTPException(status.NOT_FOUND, "Simulation results data not found")
+    return image
+
+
+async def generate_batch_result(access_token: str, index: int, item: BatchItem) -> BatchResult:
+    """
+    Generates the thumbnail of an item of a batch in the lane of its type
+
+    Returns:
+        The thumbnail, or the status and the detail of the error
+    """
+    try:
+        # Past the deadline of the batch, the remaining items are not even queued
+        current_cancellation().raise_if_cancelled()
+        async with admission_queues[item.type.lane].admit():
+            image = await run_in_threadpool(generate_batch_image, access_token, item)
+    except HTTPException as exc:
+        return BatchResult(index, item, exc.status_code, detail=exc.detail)
+    except requests.exceptions.RequestException:
+        return BatchResult(index, item, status.BAD_GATEWAY, detail="The resource could not be fetched from Nexus")
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception("Could not generate the %s of %s", item.type.value, item.content_url)
+        return BatchResult(index, item, status.INTERNAL_SERVER_ERROR, detail="Internal server error")
+    return BatchResult(index, item, status.OK, image=image)
+
+
+async def generate_batch(
+    access_token: str, items: List[BatchItem], concurrency: int, token: Optional[CancellationToken] = None
+) -> AsyncIterator[BatchResult]:
+    """
+    Generates the thumbnails of a batch, at most concurrency at the same time, and yields them in
+    the order they are finished. The finished thumbnails wait in a bounded queue until they are
+    consumed, so that a slow consumer holds the generation back instead of filling the memory.
+
+    Parameters:
+        - access_token (str): The access token of the user.
+        - items (list): The items of the batch.
+        - concurrency (int): The number of thumbnails generated at the same time.
+        - token (CancellationToken | None): The cancellation token of the batch, the current one if not set.
+    Returns:
+        The results of the items, in completion order
+    """
+    token = current_cancellation() if token is None else token
+    slots = asyncio.Semaphore(concurrency)
+    results: "asyncio.Queue[BatchResult]" = asyncio.Queue(maxsize=concurrency)
+
+    async def generate(index: int, item: BatchItem) -> None:
+        async with slots:
+            with cancellation_scope(token):
+                result = await generate_batch_result(access_token, index, item)
+            await results.put(result)
+
+    tasks = [asyncio.create_task(generate(index, item)) for index, item in enumerate(items)]
+    try:
+        for _ in tasks:
+            yield await results.get()
+    finally:
+        # The consumer stopped early (e.g. the client disconnected)
+        for task in tasks:
+            task.cancel()
+
+
+def build_batch_archive(results: List[BatchResult]) -> bytes:
+    """
+    Returns a ZIP archive of the thumbnails of a batch, named after the index of their item, with a
+    manifest.json listing the status of every item and the error detail of the failed ones
+    """
+    results = sorted(results, key=lambda result: result.index)
+    buffer = io.BytesIO()
+    # The PNG images are already compressed
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for result in results:
+            if result.image is not None:
+                archive.writestr(result.file_name, result.image)
+        archive.writestr(BATCH_ARCHIVE_MANIFEST, json.dumps([result.to_manifest() for result in results], indent=2))
+    return buffer.getvalue()
+
+
+def encode_ndjson_result(result: BatchResult) -> bytes:
+    """
+    Returns the result of an item as a JSON line, with its base64 encoded image
+    """
+    entry = result.to_manifest()
+    if result.image is not None:
+        entry["image"] = base64.b64encode(result.image).decode("ascii")
+    return json.dumps(entry).encode() + b"\n"
+
+
+def encode_multipart_result(result: BatchResult, boundary: str) -> bytes:
+    """
+    Returns the result of an item as a part of a multipart/mixed body: its image, or the JSON
+    description of its error. The index of the item is the Content-ID of the part.
+    """
+    if result.image is not None:
+        content_type, body = "image/png", result.image
+    else:
+        content_type, body = "application/json", json.dumps(result.to_manifest()).encode()
+    headers = (
+        f"--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-ID: <{result.index}>\r\n"
+        f"X-Item-Status: {result.status}\r\n\r\n"
+    )
+    return headers.encode() + body + b"\r\n"
+
+
+def batch_stream_encoder(output_format: BatchFormat) -> Tuple[str, Callable[[BatchResult], bytes], bytes]:
+    """
+    Returns the media type of a streamed batch, the encoder of its items and the end of its body
+    """
+    if output_format == BatchFormat.NDJSON:
+        return NDJSON_MEDIA_TYPE, encode_ndjson_result, b""
+    boundary = uuid4().hex
+    return (
+        f"multipart/mixed; boundary={boundary}",
+        lambda result: encode_multipart_result(result, boundary),
+        f"--{boundary}--\r\n".encode(),
+    )
+
+
+async def stream_batch(  # pylint: disable=too-many-arguments
+    access_token: str,
+    items: List[BatchItem],
+    concurrency: int,
+    timeout: float,
+    encode: Callable[[BatchResult], bytes],
+    end: bytes = b"",
+) -> AsyncIterator[bytes]:
+    """
+    Streams the encoded results of a batch as they are finished.
+
+    The response is sent after the request handler returned, out of the reach of its cancellation:
+    the batch has a cancellation token of its own, which expires after timeout seconds (the
+    unfinished items are then reported with a 504) and is cancelled if the client goes away.
+    """
+    token = CancellationToken(timeout)
+    try:
+        async for result in generate_batch(access_token, items, concurrency, token):
+            yield encode(result)
+        if end:
+            yield end
+    finally:
+        token.cancel()
@@ -0,0 +1,177 @@
+"""
+Module: disk_cache.py
+
+This module caches files on disk under the digest of the content they were computed from.
+
+The soma meshes, the rendered thumbnails and tiles and the projected morphologies are deterministic
+for a content and some options, so they are kept in directories shared by the API workers under the
+digest of both. The caches are bounded in size: the storage collector (see storage.py) periodically
+evicts the least recently used files (by modification time, which is refreshed on every hit), so
+that adding a file never scans its directory on the request thread. A cache thus exceeds its quota
+by at most what is written between two collections.
+"""
+
+import hashlib
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Optional, Sequence
+
+# Parent of the caches and of the files of the soma reconstructions
+OUTPUT_DIRECTORY = Path(__file__).parent.parent.parent / "output"
+
+
+def cache_key(content: bytes, options: Sequence[str]) -> str:
+    """
+    Returns the key of the file computed from a content with the given options
+    """
+    return cache_key_of_digest(hashlib.sha256(content), options)
+
+
+def cache_key_of_digest(content_digest: "hashlib._Hash", options: Sequence[str]) -> str:
+    """
+    Returns the key of the file computed with the given options from a content whose SHA-256 was
+    computed beforehand, e.g. while it was received
+    """
+    digest = content_digest.copy()
+    for option in options:
+        digest.update(b"\0" + option.encode())
+    return digest.hexdigest()
+
+
+def link_or_copy(source: Path, destination: Path) -> None:
+    """
+    Hard links a file (no copy, and it survives the deletion of the source), or copies it if the
+    destination is on another file system
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class DiskCache:
+    """
+    Size-bounded directory of files indexed by key
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, suffix: str) -> None:
+        """
+        Parameters:
+            - directory (Path): The directory of the cached files.
+            - max_bytes (int): The total size of the files above which the least recently used are evicted.
+            - suffix (str): The suffix of the cached files.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+    def path(self, key: str) -> Path:
+        """
+        Returns the path of the file of a key
+        """
+        return self.directory / f"{key}{self.suffix}"
+
+    def get(self, key: str) -> Optional[Path]:
+        """
+        Returns the cached file of a key, None if it is not cached
+        """
+        path = self.path(key)
+        try:
+            # Marks the file as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def link(self, key: str, destination: Path) -> bool:
+        """
+        Places the cached file of a key at destination, without copying it if possible
+
+        Returns:
+            Whether the file was cached
+        """
+        path = self.get(key)
+        if path is None:
+            return False
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            link_or_copy(path, destination)
+        except FileNotFoundError:
+            # Evicted meanwhile
+            return False
+        return True
+
+    def read(self, key: str) -> Optional[bytes]:
+        """
+        Returns the content of the cached file of a key, None if it is not cached
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            # Evicted meanwhile
+            return None
+
+    def write(self, key: str, content: bytes) -> Path:
+        """
+        Adds the content of a file to the cache
+
+        Returns:
+            The path of the cached file
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        temporary_path = self.directory / f".{key}.{uuid.uuid4().hex}.tmp"
+        temporary_path.write_bytes(content)
+        os.replace(temporary_path, path)
+        return path
+
+    def put(self, key: str, file_path: Path) -> Path:
+        """
+        Adds a file to the cache, without copying it if possible
+
+        Returns:
+            The path of the cached file
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        # Written under a temporary name, so that other workers never see a partial file
+        temporary_path = self.directory / f".{key}.{uuid.uuid4().hex}.tmp"
+        link_or_copy(file_path, temporary_path)
+        os.replace(temporary_path, path)
+        return path
+
+    def evict(self) -> int:
+        """
+        Deletes the least recently used files until the cache fits in its size limit
+
+        Returns:
+            The number of evicted files
+        """
+        if not self.directory.is_dir():
+            return 0
+        entries = []
+        total_bytes = 0
+        with os.scandir(self.directory) as scanner:
+            for entry in scanner:
+                if not entry.name.endswith(self.suffix) or entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+                total_bytes += stat.st_size
+
+        evicted = 0
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+            evicted += 1
+        return evicted
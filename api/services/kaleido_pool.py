@@ -0,0 +1,200 @@
+"""
+Module: kaleido_pool.py
+
+This module manages a pool of warm Kaleido (Chromium) renderers used to export plotly figures.
+
+Kaleido starts its Chromium subprocess lazily on the first export, which makes the first simulation
+plot of every worker take seconds and leaves the number of Chromium instances unbounded. The pool
+starts a fixed number of renderers when the application starts, hands them out through a queue,
+restarts the ones that crashed and recycles them after a number of renders to bound their memory.
+"""
+
+import os
+import queue
+import subprocess
+import threading
+import time
+from typing import List, Union
+
+import plotly
+from kaleido.scopes.plotly import PlotlyScope
+
+from api.exceptions import RendererUnavailableException
+from api.settings import settings
+from api.utils.cancellation import CANCELLATION_POLL_INTERVAL, current_cancellation
+from api.utils.logger import logger
+
+# Smallest figure that forces Chromium to load plotly.js
+WARM_UP_FIGURE = {"data": [{"x": [0, 1], "y": [0, 1], "type": "scatter"}], "layout": {}}
+
+
+def create_scope() -> PlotlyScope:
+    """
+    Creates a Kaleido scope configured the same way as the one plotly creates for write_image()
+    """
+    scope = PlotlyScope()
+    scope.plotlyjs = os.path.join(os.path.dirname(os.path.abspath(plotly.__file__)), "package_data", "plotly.min.js")
+    return scope
+
+
+class KaleidoRenderer:
+    """
+    A Kaleido scope and the number of figures it rendered since it was (re)started
+    """
+
+    def __init__(self) -> None:
+        self.scope = create_scope()
+        self.renders = 0
+
+    def transform(self, figure: dict, width: Union[int, None], height: Union[int, None]) -> bytes:
+        """
+        Exports a plotly figure to PNG, starting the Chromium process if it is not running
+        """
+        image = self.scope.transform(figure, format="png", width=width, height=height)
+        self.renders += 1
+        return image
+
+    def warm_up(self) -> None:
+        """
+        Starts the Chromium process and loads plotly.js in it
+        """
+        self.scope.transform(WARM_UP_FIGURE, format="png", width=10, height=10)
+
+    # Kaleido has no public API to check or stop the Chromium process of a scope: these are the only
+    # accesses to its internals (_proc, _shutdown_kaleido()), which are those of kaleido 0.2.1
+    # (pinned in pyproject.toml) and must be checked when it is upgraded.
+    # pylint: disable=protected-access
+
+    @property
+    def process(self) -> Union[subprocess.Popen, None]:
+        """
+        The Chromium process of the scope, None if it is not started
+        """
+        return self.scope._proc
+
+    def alive(self) -> bool:
+        """
+        Returns whether the Chromium process is running
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def shutdown(self) -> None:
+        """
+        Stops the Chromium process, which the next transform() starts again
+        """
+        self.scope._shutdown_kaleido()
+        self.renders = 0
+
+    # pylint: enable=protected-access
+
+
+class KaleidoRendererPool:
+    """
+    Pool of warm Kaleido renderers with a bounded waiting time to get one
+    """
+
+    def __init__(self, size: int, acquire_timeout: float, max_renders: int) -> None:
+        """
+        Parameters:
+            - size (int): The number of renderers (Chromium processes) of the pool.
+            - acquire_timeout (float): The maximum number of seconds to wait for a free renderer.
+            - max_renders (int): The number of renders after which a renderer is restarted.
+        """
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.max_renders = max_renders
+        self._idle: "queue.Queue[KaleidoRenderer]" = queue.Queue()
+        self._renderers: List[KaleidoRenderer] = []
+        self._lock = threading.Lock()
+        self.started = False
+
+    def start(self) -> None:
+        """
+        Starts and warms up all the renderers of the pool
+        """
+        with self._lock:
+            if self.started:
+                return
+            for _ in range(self.size):
+                renderer = KaleidoRenderer()
+                renderer.warm_up()
+                self._renderers.append(renderer)
+                self._idle.put(renderer)
+            self.started = True
+        logger.info("Started %s Kaleido renderers", self.size)
+
+    def stop(self) -> None:
+        """
+        Stops all the renderers of the pool
+        """
+        with self._lock:
+            self.started = False
+            for renderer in self._renderers:
+                renderer.shutdown()
+            self._renderers = []
+            self._idle = queue.Queue()
+
+    def alive(self) -> int:
+        """
+        Returns the number of renderers whose Chromium process is running
+        """
+        return sum(1 for renderer in self._renderers if renderer.alive())
+
+    def render(self, figure: dict, width: Union[int, None], height: Union[int, None]) -> bytes:
+        """
+        Exports a plotly figure to PNG with one of the renderers of the pool
+
+        Parameters:
+            - figure (dict): The plotly figure as a dictionary.
+            - width (int | None): The width of the image.
+            - height (int | None): The height of the image.
+        Returns:
+            The PNG image in bytes
+        Raises:
+            RendererUnavailableException: If no renderer got free within the acquire timeout.
+            RequestCancelledException, DeadlineExceededException: If the request is cancelled meanwhile.
+        """
+        renderer = self._acquire()
+        try:
+            if not renderer.alive():
+                logger.warning("Kaleido renderer crashed, restarting it")
+                renderer.warm_up()
+            image = renderer.transform(figure, width=width, height=height)
+        except Exception:
+            self._restart(renderer)
+            raise
+        finally:
+            if renderer.renders >= self.max_renders:
+                self._restart(renderer)
+            if self.started:
+                self._idle.put(renderer)
+
+        return image
+
+    def _acquire(self) -> KaleidoRenderer:
+        token = current_cancellation()
+        acquire_deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            token.raise_if_cancelled()
+            remaining = acquire_deadline - time.monotonic()
+            try:
+                return self._idle.get(timeout=max(min(remaining, CANCELLATION_POLL_INTERVAL), 0))
+            except queue.Empty as exc:
+                if remaining <= 0:
+                    raise RendererUnavailableException from exc
+
+    @staticmethod
+    def _restart(renderer: KaleidoRenderer) -> None:
+        renderer.shutdown()
+        try:
+            renderer.warm_up()
+        except Exception:  # pylint: disable=broad-exception-caught
+            # The renderer is restarted again on its next use
+            logger.exception("Could not restart Kaleido renderer")
+
+
+kaleido_pool = KaleidoRendererPool(
+    size=settings.kaleido_pool_size,
+    acquire_timeout=settings.kaleido_acquire_timeout,
+    max_renders=settings.kaleido_max_renders,
+)
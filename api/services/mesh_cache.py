@@ -0,0 +1,22 @@
+"""
+Module: mesh_cache.py
+
+This module caches the reconstructed soma meshes on disk.
+
+A soma reconstruction is deterministic for a SWC content and the reconstruction options, and takes
+tens of seconds of Blender time, so the meshes are kept in a disk cache (see disk_cache.py) under the
+digest of both, shared by the synchronous endpoints and the jobs.
+"""
+
+from pathlib import Path
+
+from api.services.disk_cache import OUTPUT_DIRECTORY, DiskCache
+from api.settings import settings
+
+MESH_SUFFIX = ".glb"
+
+mesh_cache = DiskCache(
+    directory=Path(settings.mesh_cache_directory) if settings.mesh_cache_directory else OUTPUT_DIRECTORY / "mesh_cache",
+    max_bytes=settings.mesh_cache_max_mb * 1024 * 1024,
+    suffix=MESH_SUFFIX,
+)
@@ -11,6 +11,7 @@ import neurom as nm
 from neurom.view import matplotlib_impl, matplotlib_utils
 from api.utils.common import get_buffer
 from api.services.nexus import fetch_file_content
+from api.services.render_cache import render_on_content_cached
 
 
 def plot_morphology(morphology) -> plt.Figure:
@@ -41,19 +42,20 @@ def plot_morphology(morphology) -> plt.Figure:
     return fig
 
 
-def generate_morphology_image(access_token: str, content_url: str = "", dpi: Union[int, None] = 72) -> bytes:
+def render_morphology_image(source: Union[str, bytes], dpi: Union[int, None] = 72) -> bytes:
     """
-    Returns a PNG image of a morphology (by generating a matplotlib figure from its SWC distribution).
+    Returns a PNG image of a morphology.
 
     Parameters:
-        - authorization (str): Authorization header containing the access token.
-        - content_url (str): URL of the SWC distribution.
+        - source (str | bytes): The SWC content, or the path of an SWC file.
+        - dpi (int | None): The Dots Per Inch of the image.
     Returns:
         The image in bytes format
     """
-    morph = fetch_file_content(access_token, content_url).decode(encoding="utf-8")
-
-    morphology = nm.load_morphology(io.StringIO(morph), reader="swc")
+    if isinstance(source, bytes):
+        morphology = nm.load_morphology(io.StringIO(source.decode(encoding="utf-8")), reader="swc")
+    else:
+        morphology = nm.load_morphology(source)
 
     fig = plot_morphology(morphology)
 
@@ -69,3 +71,18 @@ def generate_morphology_image(access_token: str, content_url: str = "", dpi: Uni
         plt.close(fig)
 
     return image_bytes
+
+
+def generate_morphology_image(access_token: str, content_url: str = "", dpi: Union[int, None] = 72) -> bytes:
+    """
+    Returns a PNG image of a morphology (by generating a matplotlib figure from its SWC distribution).
+
+    Parameters:
+        - authorization (str): Authorization header containing the access token.
+        - content_url (str): URL of the SWC distribution.
+    Returns:
+        The image in bytes format
+    """
+    morph = fetch_file_content(access_token, content_url)
+
+    return render_on_content_cached(render_morphology_image, morph, dpi, suffix=".swc")
@@ -0,0 +1,391 @@
+"""
+Module: morpho_tiles.py
+
+This module renders morphologies as deep-zoom tile pyramids, for the morphologies too large to be
+seen in a single image (e.g. the MouseLight axons).
+
+The morphology is projected once on the XY plane into a flat array of segments, which is cached on
+disk and in memory with a spatial index: a uniform grid listing the segments crossing every cell.
+The pyramid covers the bounding square of the morphology, with 2^z x 2^z tiles of TILE_SIZE pixels
+at zoom level z (tile (0, 0) at the top left), and a tile only draws the segments of the grid cells
+it overlaps, so that its cost does not depend on the size of the morphology. The tiles are cached
+like the other thumbnails.
+
+The content is downloaded with the access token of the user, like for the other thumbnails. As a
+pyramid is browsed with many tile requests, the access of a token to a content URL is remembered
+for a short time (TILE_ACCESS_TTL), rather than downloading the content for every tile.
+"""
+
+import hashlib
+import io
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+
+import matplotlib.pyplot as plt
+import neurom as nm
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
+from matplotlib.patches import Circle
+from neurom.core.types import NeuriteType
+from neurom.view.matplotlib_impl import TREE_COLOR
+
+from api.exceptions import TileNotFoundException
+from api.services.disk_cache import DiskCache, cache_key
+from api.services.nexus import fetch_file_content
+from api.services.render_cache import cached_render, render_cache, render_cache_key_of_digest
+from api.services.render_executor import render_executor
+from api.settings import settings
+from api.utils.logger import logger
+
+TILE_SIZE = 256
+MAX_ZOOM = 12
+# The deepest zoom level shows at least this many microns per pixel
+MIN_MICRONS_PER_PIXEL = 0.1
+# Cells per side of the grid indexing the segments
+INDEX_GRID_SIZE = 256
+# Version of the projected geometry, in the keys of the cached geometries and tiles
+GEOMETRY_VERSION = "morphology-geometry-1"
+GEOMETRY_SUFFIX = ".npz"
+TILE_DPI = 100
+ALPHA = 0.8
+BACKGROUND_COLOR = "white"
+# Neurite types, in the order of their color in the colors array of the segments
+NEURITE_TYPES = list(NeuriteType)
+
+
+class SegmentIndex:
+    """
+    Uniform grid over a square, listing the segments whose bounding box crosses each of its cells
+    """
+
+    def __init__(self, segments: np.ndarray, origin: np.ndarray, size: float, grid_size: int = INDEX_GRID_SIZE):
+        """
+        Parameters:
+            - segments (np.ndarray): The (N, 4) coordinates x0, y0, x1, y1 of the segments.
+            - origin (np.ndarray): The minimal x and y of the square.
+            - size (float): The side of the square.
+            - grid_size (int): The number of cells per side of the grid.
+        """
+        self.origin = origin
+        self.cell_size = size / grid_size
+        self.grid_size = grid_size
+        minimums = self._cells(np.minimum(segments[:, 0:2], segments[:, 2:4]))
+        maximums = self._cells(np.maximum(segments[:, 0:2], segments[:, 2:4]))
+
+        # Every segment is listed in each cell of its bounding box (usually one, the segments are short)
+        spans = maximums - minimums + 1
+        counts = spans[:, 0] * spans[:, 1]
+        segment_ids = np.repeat(np.arange(len(segments)), counts)
+        ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = minimums[segment_ids, 0] + ranks % spans[segment_ids, 0]
+        cell_y = minimums[segment_ids, 1] + ranks // spans[segment_ids, 0]
+        cells = cell_y * grid_size + cell_x
+
+        order = np.argsort(cells, kind="stable")
+        self.segment_ids = segment_ids[order]
+        self.cell_starts = np.searchsorted(cells[order], np.arange(grid_size * grid_size + 1))
+
+    def _cells(self, points: np.ndarray) -> np.ndarray:
+        cells = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, self.grid_size - 1)
+
+    def query(self, minimum: np.ndarray, maximum: np.ndarray) -> np.ndarray:
+        """
+        Returns the ids of the segments listed in the cells overlapping a box (a superset of the
+        segments crossing the box)
+        """
+        (first_x, first_y), (last_x, last_y) = self._cells(minimum), self._cells(maximum)
+        rows = []
+        # The cells of a row of the grid are contiguous
+        for y in range(first_y, last_y + 1):
+            row = y * self.grid_size
+            rows.append(self.segment_ids[self.cell_starts[row + first_x] : self.cell_starts[row + last_x + 1]])
+        return np.unique(np.concatenate(rows))
+
+
+class MorphologyGeometry:
+    """
+    A morphology projected on the XY plane, as segments indexed by their location
+    """
+
+    def __init__(self, segments: np.ndarray, diameters: np.ndarray, types: np.ndarray, soma: np.ndarray) -> None:
+        """
+        Parameters:
+            - segments (np.ndarray): The (N, 4) coordinates x0, y0, x1, y1 of the segments.
+            - diameters (np.ndarray): The (N,) diameters of the segments.
+            - types (np.ndarray): The (N,) indices of the neurite types of the segments in NEURITE_TYPES.
+            - soma (np.ndarray): The x, y and radius of the soma.
+        """
+        self.segments = segments
+        self.diameters = diameters
+        self.types = types
+        self.soma = soma
+        points = np.concatenate([segments[:, 0:2], segments[:, 2:4], [soma[:2] - soma[2], soma[:2] + soma[2]]])
+        minimum, maximum = points.min(axis=0), points.max(axis=0)
+        # The pyramid covers the bounding square, centered on the bounding box
+        self.size = max(float((maximum - minimum).max()), 1.0)
+        self.origin = (minimum + maximum) / 2 - self.size / 2
+        self.index = SegmentIndex(segments, self.origin, self.size)
+
+    @classmethod
+    def from_content(cls, source: Union[str, bytes]) -> "MorphologyGeometry":
+        """
+        Projects the morphology of a SWC content, or of the path of an SWC file
+        """
+        if isinstance(source, bytes):
+            morphology = nm.load_morphology(io.StringIO(source.decode(encoding="utf-8")), reader="swc")
+        else:
+            morphology = nm.load_morphology(source)
+
+        segments, diameters, types = [], [], []
+        for section in nm.iter_sections(morphology):
+            points = section.points
+            segments.append(np.concatenate([points[:-1, 0:2], points[1:, 0:2]], axis=1))
+            diameters.append(points[:-1, 3] + points[1:, 3])
+            types.append(np.full(len(points) - 1, NEURITE_TYPES.index(section.type)))
+        soma = np.array([*morphology.soma.center[:2], morphology.soma.radius])
+        if not segments:
+            return cls(np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64), soma)
+        return cls(np.concatenate(segments), np.concatenate(diameters), np.concatenate(types), soma)
+
+    def to_bytes(self) -> bytes:
+        """
+        Returns the geometry as a NumPy .npz file (the index is rebuilt when it is loaded)
+        """
+        buffer = io.BytesIO()
+        np.savez(buffer, segments=self.segments, diameters=self.diameters, types=self.types, soma=self.soma)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "MorphologyGeometry":
+        """
+        Loads a geometry saved with to_bytes()
+        """
+        with np.load(io.BytesIO(data)) as arrays:
+            return cls(arrays["segments"], arrays["diameters"], arrays["types"], arrays["soma"])
+
+    @property
+    def max_zoom(self) -> int:
+        """
+        The deepest zoom level of the pyramid
+        """
+        return min(max(math.ceil(math.log2(self.size / (TILE_SIZE * MIN_MICRONS_PER_PIXEL))), 0), MAX_ZOOM)
+
+    def info(self) -> dict:
+        """
+        Returns the description of the pyramid of the morphology
+        """
+        return {
+            "tile_size": TILE_SIZE,
+            "max_zoom": self.max_zoom,
+            "origin": self.origin.tolist(),
+            "size": self.size,
+            "segments": len(self.segments),
+        }
+
+    def tile_bounds(self, z: int, x: int, y: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the minimal and maximal coordinates of a tile
+
+        Raises:
+            TileNotFoundException: If the tile is not in the pyramid (404).
+        """
+        tiles = 2**z
+        if z > self.max_zoom or not (0 <= x < tiles and 0 <= y < tiles):
+            raise TileNotFoundException
+        tile_size = self.size / tiles
+        # The rows of tiles go down, the y axis goes up
+        minimum = self.origin + np.array([x, tiles - 1 - y]) * tile_size
+        return minimum, minimum + tile_size
+
+    def tile_geometry(self, z: int, x: int, y: int) -> Tuple[np.ndarray, ...]:
+        """
+        Returns the bounds of a tile, and the segments and the soma drawn on it
+
+        Returns:
+            The minimum and maximum of the tile, and the segments, diameters, types and soma to draw
+        """
+        minimum, maximum = self.tile_bounds(z, x, y)
+        # Segments are drawn with their width, which may overflow on the neighbouring tiles
+        margin = (self.diameters.max() if len(self.diameters) else 0) / 2
+        candidates = self.index.query(minimum - margin, maximum + margin)
+        segments = self.segments[candidates]
+        crossing = (
+            (np.minimum(segments[:, 0], segments[:, 2]) <= maximum[0] + margin)
+            & (np.maximum(segments[:, 0], segments[:, 2]) >= minimum[0] - margin)
+            & (np.minimum(segments[:, 1], segments[:, 3]) <= maximum[1] + margin)
+            & (np.maximum(segments[:, 1], segments[:, 3]) >= minimum[1] - margin)
+        )
+        selected = candidates[crossing]
+        return minimum, maximum, self.segments[selected], self.diameters[selected], self.types[selected], self.soma
+
+
+def render_morphology_tile(  # pylint: disable=too-many-arguments
+    minimum: np.ndarray,
+    maximum: np.ndarray,
+    segments: np.ndarray,
+    diameters: np.ndarray,
+    types: np.ndarray,
+    soma: np.ndarray,
+) -> bytes:
+    """
+    Returns a PNG tile of TILE_SIZE pixels of the segments and the soma of a morphology, colored
+    like the morphology thumbnails
+    """
+    fig = plt.figure(figsize=(TILE_SIZE / TILE_DPI, TILE_SIZE / TILE_DPI), dpi=TILE_DPI)
+    try:
+        ax = fig.add_axes((0, 0, 1, 1))
+        ax.set_axis_off()
+        ax.set_xlim(minimum[0], maximum[0])
+        ax.set_ylim(minimum[1], maximum[1])
+        # Widths in points, at least a thin line when the segments are narrower than a pixel
+        points_per_micron = TILE_SIZE / (maximum[0] - minimum[0]) * 72 / TILE_DPI
+        colors = np.array([to_rgba(TREE_COLOR.get(neurite_type, "green"), ALPHA) for neurite_type in NEURITE_TYPES])
+        ax.add_collection(
+            LineCollection(
+                segments.reshape(-1, 2, 2),
+                linewidths=np.maximum(diameters * points_per_micron, 0.5),
+                colors=colors[types] if len(types) else None,
+                capstyle="round",
+            )
+        )
+        ax.add_patch(Circle((soma[0], soma[1]), soma[2], color=TREE_COLOR[NeuriteType.soma], alpha=ALPHA))
+
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=TILE_DPI, facecolor=BACKGROUND_COLOR)
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+class GeometryStore:
+    """
+    The projected geometries by key, in memory (least recently used first out) and in a disk cache,
+    and the content URLs the access tokens recently had access to
+    """
+
+    def __init__(self, cache: DiskCache, max_entries: int, access_ttl: float) -> None:
+        """
+        Parameters:
+            - cache (DiskCache): The disk cache of the geometries.
+            - max_entries (int): The number of geometries kept in memory.
+            - access_ttl (float): The number of seconds the access of a token to a content URL is remembered.
+        """
+        self.cache = cache
+        self.max_entries = max_entries
+        self.access_ttl = access_ttl
+        self._geometries: "OrderedDict[str, MorphologyGeometry]" = OrderedDict()
+        self._accesses: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    def geometry(self, access_token: str, content_url: str) -> Tuple[str, MorphologyGeometry]:
+        """
+        Returns the key and the geometry of the morphology of a content URL, downloading it only if
+        the token did not access it recently or the geometry is not cached anymore
+
+        Raises:
+            Same exceptions as fetch_file_content().
+        """
+        key = self._recent_access(access_token, content_url)
+        geometry = self._cached_geometry(key) if key is not None else None
+        if geometry is not None:
+            return key, geometry
+
+        content = fetch_file_content(access_token, content_url)
+        key = cache_key(content, [GEOMETRY_VERSION])
+        geometry = self._cached_geometry(key)
+        if geometry is None:
+            geometry = render_executor.run_on_content(MorphologyGeometry.from_content, content, suffix=".swc")
+            try:
+                self.cache.write(key, geometry.to_bytes())
+            except OSError:
+                logger.warning("Could not cache the geometry %s", key, exc_info=True)
+            self._remember(key, geometry)
+        with self._lock:
+            self._accesses[(access_token, content_url)] = (time.monotonic() + self.access_ttl, key)
+        return key, geometry
+
+    def purge_expired_accesses(self) -> int:
+        """
+        Forgets the expired accesses
+
+        Returns:
+            The number of forgotten accesses
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [access for access, (expires_at, _) in self._accesses.items() if expires_at <= now]
+            for access in expired:
+                del self._accesses[access]
+        return len(expired)
+
+    def _recent_access(self, access_token: str, content_url: str) -> Optional[str]:
+        with self._lock:
+            expires_at, key = self._accesses.get((access_token, content_url), (0.0, None))
+        return key if expires_at > time.monotonic() else None
+
+    def _cached_geometry(self, key: str) -> Optional[MorphologyGeometry]:
+        with self._lock:
+            if key in self._geometries:
+                self._geometries.move_to_end(key)
+                return self._geometries[key]
+        data = self.cache.read(key)
+        if data is None:
+            return None
+        geometry = MorphologyGeometry.from_bytes(data)
+        self._remember(key, geometry)
+        return geometry
+
+    def _remember(self, key: str, geometry: MorphologyGeometry) -> None:
+        with self._lock:
+            self._geometries[key] = geometry
+            self._geometries.move_to_end(key)
+            while len(self._geometries) > self.max_entries:
+                self._geometries.popitem(last=False)
+
+
+def generate_morphology_tile_info(access_token: str, content_url: str) -> dict:
+    """
+    Returns the description of the tile pyramid of a morphology: its tile size, its deepest zoom
+    level, and the origin (minimal x and y) and the side of the square it covers, in microns
+    """
+    _, geometry = geometry_store.geometry(access_token, content_url)
+    return geometry.info()
+
+
+def generate_morphology_tile(access_token: str, content_url: str, z: int, x: int, y: int) -> bytes:
+    """
+    Returns a PNG tile of the pyramid of a morphology
+
+    Parameters:
+        - access_token (str): The access token of the user.
+        - content_url (str): URL of the SWC distribution.
+        - z (int): The zoom level, from 0 (the whole morphology in one tile).
+        - x (int): The column of the tile, from the left.
+        - y (int): The row of the tile, from the top.
+    Returns:
+        The PNG tile in bytes format
+    Raises:
+        TileNotFoundException: If the tile is not in the pyramid (404).
+    """
+    key, geometry = geometry_store.geometry(access_token, content_url)
+    geometry.tile_bounds(z, x, y)
+    tile_key = render_cache_key_of_digest(hashlib.sha256(key.encode()), render_morphology_tile, z, x, y)
+    return cached_render(
+        render_cache, tile_key, lambda: render_executor.submit(render_morphology_tile, *geometry.tile_geometry(z, x, y))
+    )
+
+
+geometry_store = GeometryStore(
+    cache=DiskCache(
+        directory=render_cache.directory / "geometry",
+        max_bytes=settings.tile_geometry_cache_max_mb * 1024 * 1024,
+        suffix=GEOMETRY_SUFFIX,
+    ),
+    max_entries=settings.tile_geometry_memory_entries,
+    access_ttl=settings.tile_access_ttl,
+)
@@ -2,14 +2,43 @@
 Nexus service to expose business logic of interacting with Nexus
 """
 
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+from typing import IO, Iterator
 from urllib.parse import urlparse
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 from api.exceptions import (
     AuthenticationIssueException,
     AuthorizationIssueException,
     InvalidUrlParameterException,
     ResourceNotFoundException,
 )
+from api.settings import settings
+from api.utils.cancellation import current_cancellation
+
+# Seconds to wait for Nexus to connect or to send data
+NEXUS_TIMEOUT = 15
+# Bytes downloaded between two checks of the cancellation of the request
+FETCH_CHUNK_SIZE = 256 * 1024
+
+
+def create_nexus_session(pool_size: int) -> requests.Session:
+    """
+    Returns a session keeping up to pool_size connections to every Nexus host alive, so that the
+    downloads of the requests reuse them instead of connecting (and negotiating TLS) every time.
+    It is shared by the threads of the API worker, and thus by the users: it never stores cookies.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+nexus_session = create_nexus_session(settings.nexus_pool_size)
 
 
 def fetch_file_content(access_token: str, content_url: str = "") -> bytes:
@@ -29,16 +58,115 @@ def fetch_file_content(access_token: str, content_url: str = "") -> bytes:
         AuthenticationIssueException: If authentication fails (401).
         AuthorizationIssueException: If access is forbidden (403).
         requests.exceptions.RequestException: For other types of request failures.
+        RequestCancelledException, DeadlineExceededException: If the request is cancelled meanwhile.
+    """
+    validate_content_url(content_url)
+    token = current_cancellation()
+    token.raise_if_cancelled()
+
+    response = nexus_session.get(
+        content_url,
+        headers={"authorization": f"Bearer {access_token}"},
+        timeout=token.remaining(NEXUS_TIMEOUT),
+        stream=True,
+    )
+    try:
+        raise_for_nexus_status(response)
+        chunks = []
+        for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+            token.raise_if_cancelled()
+            chunks.append(chunk)
+        return b"".join(chunks)
+    finally:
+        response.close()
+
+
+@contextmanager
+def stream_file_content(access_token: str, content_url: str = "") -> Iterator[IO[bytes]]:
+    """
+        Opens the File content of a Nexus distribution as a stream, without downloading it first.
+
+        Parameters:
+            - authorization (str): Authorization header containing the access token.
+            - content_url (str): URL of the distribution.
+
+        Returns:
+            IO[bytes]: Binary file-like object reading the (decoded) response body.
+
+    Raises:
+        Same exceptions as fetch_file_content(), also while the stream is read.
+    """
+    validate_content_url(content_url)
+    token = current_cancellation()
+    token.raise_if_cancelled()
+
+    response = nexus_session.get(
+        content_url,
+        headers={"authorization": f"Bearer {access_token}"},
+        timeout=token.remaining(NEXUS_TIMEOUT),
+        stream=True,
+    )
+    try:
+        raise_for_nexus_status(response)
+        response.raw.decode_content = True
+        yield response.raw
+    except urllib3.exceptions.HTTPError as exc:
+        # The raw stream raises the urllib3 errors that requests translates when it reads the body itself
+        raise translate_read_error(exc) from exc
+    finally:
+        response.close()
+
+
+def check_file_access(access_token: str, content_url: str = "") -> None:
+    """
+    Checks that the user can read the File content of a Nexus distribution, without downloading it
+
+    Raises:
+        Same exceptions as fetch_file_content().
+    """
+    with stream_file_content(access_token, content_url):
+        pass
+
+
+def translate_read_error(exc: urllib3.exceptions.HTTPError) -> requests.exceptions.RequestException:
+    """
+    Returns the requests exception matching an error of urllib3 while reading a response body, as
+    requests.Response.iter_content() does
+    """
+    if isinstance(exc, urllib3.exceptions.ProtocolError):
+        return requests.exceptions.ChunkedEncodingError(exc)
+    if isinstance(exc, urllib3.exceptions.DecodeError):
+        return requests.exceptions.ContentDecodingError(exc)
+    if isinstance(exc, urllib3.exceptions.SSLError):
+        return requests.exceptions.SSLError(exc)
+    return requests.exceptions.ConnectionError(exc)
+
+
+def validate_content_url(content_url: str) -> None:
+    """
+    Checks that the content_url is a complete URL
+
+    Raises:
+        InvalidUrlParameterException: If the content_url is malformed.
     """
     parsed_content_url = urlparse(content_url)
 
     if not all([parsed_content_url.scheme, parsed_content_url.netloc, parsed_content_url.path]):
         raise InvalidUrlParameterException
 
-    response = requests.get(content_url, headers={"authorization": f"Bearer {access_token}"}, timeout=15)
 
+def raise_for_nexus_status(response: requests.Response) -> None:
+    """
+    Raises the exception matching the status code of a Nexus response, if it is not successful
+
+    Raises:
+        ResourceNotFoundException: If the file is not found (404).
+        AuthenticationIssueException: If authentication fails (401).
+        AuthorizationIssueException: If access is forbidden (403).
+        requests.exceptions.RequestException: For other types of request failures.
+    """
     if response.status_code == 200:
-        return response.content
+        return
     if response.status_code == 404:
         raise ResourceNotFoundException
     if response.status_code == 401:
@@ -0,0 +1,74 @@
+"""
+Module: render_cache.py
+
+This module caches the rendered thumbnails on disk.
+
+A thumbnail is deterministic for the downloaded content and the render parameters, so the images
+are kept in a disk cache (see disk_cache.py) shared by the API workers under the digest of both.
+The content is still downloaded with the access token of the user on every request, so that a
+cached thumbnail is only served to the users who can read the resource: only the render is saved,
+which is most of the work of a thumbnail.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Any, Callable, Sequence
+
+from api.services.disk_cache import OUTPUT_DIRECTORY, DiskCache, cache_key, cache_key_of_digest
+from api.services.render_executor import render_executor
+from api.settings import settings
+from api.utils.logger import logger
+
+IMAGE_SUFFIX = ".png"
+
+
+def render_options(fn: Callable[..., Any], args: Sequence[Any]) -> list:
+    """
+    Returns the render function and its parameters as the options of a cache key
+    """
+    return [f"{fn.__module__}.{fn.__qualname__}", *(repr(arg) for arg in args)]
+
+
+def cached_render(cache: DiskCache, key: str, render: Callable[[], bytes]) -> bytes:
+    """
+    Returns the cached image of a key, or renders and caches it. A failure of the cache (e.g. a full
+    disk) only costs the render.
+    """
+    if cache.max_bytes <= 0:
+        return render()
+
+    image = cache.read(key)
+    if image is not None:
+        return image
+    image = render()
+    try:
+        cache.write(key, image)
+    except OSError:
+        logger.warning("Could not cache the image %s", key, exc_info=True)
+    return image
+
+
+def render_on_content_cached(fn: Callable[..., bytes], content: bytes, *args: Any, suffix: str = "") -> bytes:
+    """
+    Renders fn(content, *args) on the render executor (see RenderExecutor.run_on_content()), or
+    returns the image of a previous render of the same content with the same parameters
+    """
+    key = cache_key(content, render_options(fn, args))
+    return cached_render(render_cache, key, lambda: render_executor.run_on_content(fn, content, *args, suffix=suffix))
+
+
+def render_cache_key_of_digest(data_digest: "hashlib._Hash", fn: Callable[..., Any], *args: Any) -> str:
+    """
+    Returns the key of the image rendered by fn(*args) from data whose SHA-256 was computed beforehand,
+    e.g. the data extracted from a content rather than the content itself
+    """
+    return cache_key_of_digest(data_digest, render_options(fn, args))
+
+
+render_cache = DiskCache(
+    directory=(
+        Path(settings.render_cache_directory) if settings.render_cache_directory else OUTPUT_DIRECTORY / "render_cache"
+    ),
+    max_bytes=settings.render_cache_max_mb * 1024 * 1024,
+    suffix=IMAGE_SUFFIX,
+)
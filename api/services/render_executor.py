@@ -0,0 +1,314 @@
+"""
+Module: render_executor.py
+
+This module runs the CPU-bound render stage of the generators in a pool of worker processes.
+
+Rendering is pure Python/matplotlib work holding the GIL, so threads cannot use more than one core
+per API worker. The executor dispatches the renders to a process pool whose workers import the
+rendering libraries once when they start. Downloaded contents are handed over as files in a spool
+directory (only their path is pickled), and the pool is recycled after a number of tasks or when a
+worker's memory exceeds a limit, to get rid of the memory fragmentation/leaks of long-lived workers.
+
+The renders are only handed to the pool when a worker is free: until then they wait in a queue
+ordered by the priority of their lane, so that e.g. thumbnails overtake the simulation grids.
+"""
+
+import heapq
+import itertools
+import multiprocessing
+import resource
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+from typing import Any, Callable, Iterator, List, Optional, Tuple, TypeVar
+
+from api.services.admission import current_priority
+from api.settings import settings
+from api.utils.cancellation import CANCELLATION_POLL_INTERVAL, CancellationToken, current_cancellation
+from api.utils.logger import logger
+
+T = TypeVar("T")
+
+
+def initialize_worker() -> None:
+    """
+    Pre-imports the heavy rendering libraries once per worker rather than on its first task
+    """
+    # pylint: disable=import-outside-toplevel,unused-import
+    import h5py
+    import matplotlib
+    import neurom
+    import plotly.graph_objects
+
+    matplotlib.use("agg")
+
+
+def warm_up() -> None:
+    """
+    No-op task used to start the workers of a pool
+    """
+
+
+def run_task(fn: Callable[..., T], *args: Any) -> Tuple[T, int]:
+    """
+    Runs a task in a worker and returns its result with the peak memory (RSS, bytes) of the worker
+    """
+    result = fn(*args)
+    # ru_maxrss is in kilobytes on Linux
+    return result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PrioritySlots:
+    """
+    Limited number of slots given to the waiting threads by priority (lowest value first), then in
+    arrival order
+    """
+
+    def __init__(self, size: int) -> None:
+        self._free = size
+        self._waiting: List[Tuple[int, int, threading.Event]] = []
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        """
+        The number of threads waiting for a slot
+        """
+        return len(self._waiting)
+
+    @contextmanager
+    def acquire(self, priority: int, token: CancellationToken) -> Iterator[None]:
+        """
+        Waits for a slot and holds it until the end of the context
+
+        Raises:
+            RequestCancelledException, DeadlineExceededException: If the request is cancelled meanwhile.
+        """
+        with self._lock:
+            if self._free > 0 and not self._waiting:
+                self._free -= 1
+                entry = None
+            else:
+                entry = (priority, next(self._arrivals), threading.Event())
+                heapq.heappush(self._waiting, entry)
+
+        if entry is not None:
+            while not entry[2].wait(CANCELLATION_POLL_INTERVAL):
+                if token.cancelled:
+                    with self._lock:
+                        if not entry[2].is_set():
+                            self._waiting.remove(entry)
+                            heapq.heapify(self._waiting)
+                            token.raise_if_cancelled()
+                    # The slot was given at the same time, give it to the next thread
+                    self._release()
+                    token.raise_if_cancelled()
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        with self._lock:
+            if self._waiting:
+                heapq.heappop(self._waiting)[2].set()
+            else:
+                self._free += 1
+
+
+class RecyclingPolicy:
+    """
+    Counts the tasks of the current pool and decides when it is recycled
+    """
+
+    def __init__(self, max_tasks: int, max_rss_mb: int) -> None:
+        """
+        Parameters:
+            - max_tasks (int): The number of tasks per worker after which the pool is recycled.
+            - max_rss_mb (int): The peak memory of a worker (MB) above which the pool is recycled.
+        """
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.tasks = 0
+        self.recycling = False
+
+    def record_task(self, workers: int, peak_rss: int) -> bool:
+        """
+        Counts a finished task, and returns whether the pool must be recycled (only once per pool)
+        """
+        self.tasks += 1
+        if self.recycling or (self.tasks < self.max_tasks * workers and peak_rss < self.max_rss):
+            return False
+        self.recycling = True
+        return True
+
+    def reset(self, recycled: bool) -> None:
+        """
+        Ends a recycling, restarting the count of the tasks if the pool was replaced
+        """
+        if recycled:
+            self.tasks = 0
+        self.recycling = False
+
+
+class RenderExecutor:
+    """
+    Process pool for the render stage, recycled after a number of tasks or above a memory limit
+    """
+
+    def __init__(self, workers: int, max_tasks: int, max_rss_mb: int, spool_directory: Optional[str] = None) -> None:
+        """
+        Parameters:
+            - workers (int): The number of worker processes, 0 to render in the calling thread.
+            - max_tasks (int): The number of tasks per worker after which the pool is recycled.
+            - max_rss_mb (int): The peak memory of a worker (MB) above which the pool is recycled.
+            - spool_directory (str | None): The directory of the files handed over to the workers.
+        """
+        self.workers = workers
+        self.spool_directory = spool_directory
+        self.recycling_policy = RecyclingPolicy(max_tasks, max_rss_mb)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._slots = PrioritySlots(workers)
+
+    @property
+    def started(self) -> bool:
+        """
+        Whether the renders are dispatched to worker processes
+        """
+        return self._pool is not None
+
+    def start(self, workers: Optional[int] = None) -> None:
+        """
+        Starts the worker processes (no-op if the executor has no workers)
+
+        Parameters:
+            - workers (int | None): The number of worker processes, the configured one if not set.
+        """
+        if self.started:
+            return
+        if workers is not None:
+            self.workers = workers
+            self._slots = PrioritySlots(workers)
+        if self.workers <= 0:
+            return
+        pool = self._create_pool()
+        with self._lock:
+            self._pool = pool
+        logger.info("Started %s render workers", self.workers)
+
+    def stop(self) -> None:
+        """
+        Stops the worker processes, cancelling the pending renders
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, fn: Callable[..., T], *args: Any) -> T:
+        """
+        Runs fn(*args) in a worker process, or in the calling thread if the executor is not started.
+        The arguments and the result are pickled, so they should be small.
+
+        The render waits for a free worker behind the renders of higher priority (see
+        current_priority()), and is dropped if the request is cancelled meanwhile.
+        """
+        token = current_cancellation()
+        token.raise_if_cancelled()
+        if not self.started:
+            return fn(*args)
+
+        with self._slots.acquire(current_priority(), token):
+            with self._lock:
+                pool = self._pool
+            if pool is None:
+                # The executor was stopped meanwhile
+                return fn(*args)
+
+            try:
+                future: "Future[Tuple[T, int]]" = pool.submit(run_task, fn, *args)
+                while not wait([future], timeout=CANCELLATION_POLL_INTERVAL).done:
+                    if token.cancelled:
+                        # A render already running in a worker cannot be interrupted and finishes there
+                        future.cancel()
+                        token.raise_if_cancelled()
+                result, peak_rss = future.result()
+            except BrokenProcessPool:
+                # A worker died (e.g. killed by the OOM killer), the pool cannot be used anymore
+                logger.error("Render workers crashed")
+                self._account_task(pool, self.recycling_policy.max_rss)
+                raise
+        self._account_task(pool, peak_rss)
+        return result
+
+    def run_on_content(self, fn: Callable[..., T], content: bytes, *args: Any, suffix: str = "") -> T:
+        """
+        Runs fn(source, *args) where source is the downloaded content.
+
+        In the calling thread, source is the content itself. In a worker process, it is the path of a
+        spooled copy of the content, so that only the path is pickled; fn must accept both.
+        """
+        if not self.started:
+            return fn(content, *args)
+
+        with NamedTemporaryFile(suffix=suffix, dir=self.spool_directory) as spool:
+            spool.write(content)
+            spool.flush()
+            return self.submit(fn, spool.name, *args)
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        # forkserver: forking the API process (with its threads and Chromium pipes) is not safe
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=initialize_worker,
+        )
+        # Start all the workers now rather than on the first renders
+        for future in [pool.submit(warm_up) for _ in range(self.workers)]:
+            future.result()
+        return pool
+
+    def _account_task(self, pool: ProcessPoolExecutor, peak_rss: int) -> None:
+        with self._lock:
+            if pool is not self._pool:
+                # Task of a pool that has already been recycled
+                return
+            if not self.recycling_policy.record_task(self.workers, peak_rss):
+                return
+            tasks = self.recycling_policy.tasks
+        logger.info("Recycling render workers after %s tasks (worker peak RSS %s MB)", tasks, peak_rss >> 20)
+        threading.Thread(target=self._recycle, daemon=True).start()
+
+    def _recycle(self) -> None:
+        # The new pool is warmed up before replacing the old one, whose running renders are let finish
+        try:
+            new_pool = self._create_pool()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Could not start new render workers")
+            with self._lock:
+                self.recycling_policy.reset(recycled=False)
+            return
+
+        with self._lock:
+            old_pool, self._pool = self._pool, new_pool
+            self.recycling_policy.reset(recycled=True)
+        if old_pool is None:
+            # The executor was stopped meanwhile
+            with self._lock:
+                self._pool = None
+            new_pool.shutdown(wait=False)
+        else:
+            old_pool.shutdown(wait=False)
+
+
+render_executor = RenderExecutor(
+    workers=settings.render_workers,
+    max_tasks=settings.render_worker_max_tasks,
+    max_rss_mb=settings.render_worker_max_rss_mb,
+    spool_directory=settings.render_spool_directory,
+)
@@ -4,17 +4,411 @@ Module: simulation_img.py
 This module exposes the business logic for generating simulation thumbnails
 """
 
-from typing import List
+from functools import partial
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
+import hashlib
 import io
 import json
+import math
+import ijson
 import plotly.graph_objects as go
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
+from plotly.subplots import make_subplots
 
+from api.exceptions import TooManyPanelsException
+from api.models.enums import SimulationPlotEngine
 from api.models.common import (
     PlotData,
-    SimulationConfigurationFile,
+    PlotTarget,
+    SimulationDataInput,
     SimulationGenerationInput,
+    SimulationGridInput,
 )
-from api.services.nexus import fetch_file_content
+from api.services.kaleido_pool import kaleido_pool
+from api.services.nexus import stream_file_content
+from api.services.render_cache import cached_render, render_cache, render_cache_key_of_digest
+from api.services.render_executor import render_executor
+from api.settings import settings
+from api.utils.common import get_buffer
+from api.utils.decimation import minmax_decimate
+from api.utils.series import Series, encode_series
+
+# Defaults of the plotly "plotly" template reproduced by the matplotlib engine
+PLOTLY_DEFAULT_WIDTH = 700
+PLOTLY_DEFAULT_HEIGHT = 500
+PLOTLY_BACKGROUND_COLOR = "#E5ECF6"
+PLOTLY_COLORWAY = [
+    "#636efa",
+    "#EF553B",
+    "#00cc96",
+    "#ab63fa",
+    "#FFA15A",
+    "#19d3f3",
+    "#FF6692",
+    "#B6E880",
+    "#FF97FF",
+    "#FECB52",
+]
+PIXELS_PER_INCH = 100
+# Default size of every panel of a grid
+GRID_PANEL_WIDTH = 350
+GRID_PANEL_HEIGHT = 250
+# Panels of a grid at most, and size of its image at most when it is not given
+GRID_MAX_PANELS = 36
+GRID_MAX_WIDTH = 4000
+GRID_MAX_HEIGHT = 4000
+
+# Title and series of a panel of a grid
+SimulationPanel = Tuple[str, List[PlotData]]
+# Location (None for the stimulus) and raw series of a section of a configuration file
+ConfigSection = Tuple[Optional[str], List[Any]]
+
+
+def extract_plot_data(stream: IO[bytes], target: PlotTarget) -> List[PlotData]:
+    """
+    Incrementally reads a simulation configuration file and extracts only the series of the target.
+
+    The other sections (e.g. all the other recorded locations) are scanned by the parser without being
+    materialized, and the reading stops as soon as the target section is complete.
+
+    Parameters:
+        - stream: binary file-like object with the configuration file content
+        - target: the plot target
+    Returns:
+        The series to plot (may be empty)
+    Raises:
+        ValueError: if the configuration file is malformed
+    """
+    try:
+        if target == "stimulus":
+            # in the future the stimulus may have different configs
+            # we should agree how the user can specify the stimulus thumb needed
+            section = next(ijson.items(stream, "stimulus", use_float=True), None)
+        else:
+            _, section = next(ijson.kvitems(stream, "simulation", use_float=True), (None, None))
+
+        if section is None:
+            return []
+        return [PlotData.model_validate(item) for item in section]
+    except (ijson.JSONError, ValueError) as exc:
+        # Only the errors of the parser and of the validation: the errors reading the stream are
+        # transport errors, not a malformed document
+        raise ValueError("Configuration file is malformed") from exc
+
+
+def read_plot_data(access_token: str, content_url: str, target: PlotTarget) -> List[PlotData]:
+    """
+    Streams a simulation configuration file from Nexus and extracts the series of the target
+
+    Parameters:
+        - access_token: the access token of the user
+        - content_url: the URL of the configuration file
+        - target: the plot target
+    Returns:
+        The series to plot (may be empty)
+    Raises:
+        ValueError: if the configuration file is malformed
+    """
+    with stream_file_content(access_token, content_url) as stream:
+        return extract_plot_data(stream, target)
+
+
+def iter_config_sections(stream: IO[bytes], is_selected: Callable[[Optional[str]], bool]) -> Iterator[ConfigSection]:
+    """
+    Incrementally reads a simulation configuration file and yields its selected sections as they are complete:
+    the stimulus (location None) and the recorded locations. The other sections are scanned by the parser
+    without being built.
+
+    Parameters:
+        - stream: binary file-like object with the configuration file content
+        - is_selected: returns whether the section of a location (None for the stimulus) is needed
+    """
+    builder: Optional[ijson.ObjectBuilder] = None
+    section_prefix = location = ""
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            if prefix == section_prefix and event == "end_array":
+                yield (None if section_prefix == "stimulus" else location), builder.value
+                builder = None
+            else:
+                builder.event(event, value)
+        elif prefix == "simulation" and event == "map_key":
+            location = value
+        elif event == "start_array" and (
+            (prefix == "stimulus" and is_selected(None))
+            or (prefix == f"simulation.{location}" and is_selected(location))
+        ):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            section_prefix = prefix
+
+
+def extract_simulation_panels(
+    stream: IO[bytes], locations: List[str] | None, include_stimulus: bool, max_panels: int
+) -> List[SimulationPanel]:
+    """
+    Incrementally reads a simulation configuration file and extracts the series of every panel of a grid.
+
+    Only the selected sections are materialized, one at a time, and converted to arrays as soon as they
+    are complete.
+
+    Parameters:
+        - stream: binary file-like object with the configuration file content
+        - locations: the recorded locations to include (all of them if None), unknown ones are ignored
+        - include_stimulus: whether the stimulus is the first panel
+        - max_panels: the maximum number of panels of the grid
+    Returns:
+        The title and the series of every panel: the stimulus, then the locations in the requested order
+        (or in the order of the file)
+    Raises:
+        ValueError: if the configuration file is malformed
+        TooManyPanelsException: if the grid has more than max_panels panels (422)
+    """
+    selected = None if locations is None else set(locations)
+
+    def is_selected(location: Optional[str]) -> bool:
+        if location is None:
+            return include_stimulus
+        return selected is None or location in selected
+
+    stimulus: List[PlotData] = []
+    recorded: Dict[str, List[PlotData]] = {}
+    try:
+        for location, items in iter_config_sections(stream, is_selected):
+            data = [PlotData.model_validate(item) for item in items]
+            if location is None:
+                stimulus = data
+            elif data:
+                recorded[location] = data
+            if len(recorded) + (1 if stimulus else 0) > max_panels:
+                raise TooManyPanelsException(max_panels)
+    except (ijson.JSONError, ValueError) as exc:
+        raise ValueError("Configuration file is malformed") from exc
+
+    panels: List[SimulationPanel] = [("stimulus", stimulus)] if stimulus else []
+    for title in list(recorded) if locations is None else locations:
+        if title in recorded:
+            panels.append((title, recorded.pop(title)))
+    return panels
+
+
+def read_simulation_panels(
+    access_token: str, content_url: str, locations: List[str] | None, include_stimulus: bool
+) -> List[SimulationPanel]:
+    """
+    Streams a simulation configuration file from Nexus and extracts the series of every panel of a grid
+
+    Parameters:
+        - access_token: the access token of the user
+        - content_url: the URL of the configuration file
+        - locations: the recorded locations to include (all of them if None), unknown ones are ignored
+        - include_stimulus: whether the stimulus is the first panel
+    Returns:
+        The title and the series of every panel
+    Raises:
+        ValueError: if the configuration file is malformed
+        TooManyPanelsException: if the grid has more than GRID_MAX_PANELS panels (422)
+    """
+    with stream_file_content(access_token, content_url) as stream:
+        return extract_simulation_panels(stream, locations, include_stimulus, GRID_MAX_PANELS)
+
+
+def grid_shape(n_panels: int, columns: int | None) -> Tuple[int, int]:
+    """
+    Returns the number of rows and columns of a grid of n_panels (as square as possible by default)
+    """
+    columns = min(columns or math.ceil(math.sqrt(n_panels)), n_panels)
+    return math.ceil(n_panels / columns), columns
+
+
+def decimate_plot_data(data: List[PlotData], max_points: int) -> List[PlotData]:
+    """
+    Reduces every series to at most max_points with min/max decimation, so that the peaks stay visible
+
+    Parameters:
+        - data: the series
+        - max_points: the maximum number of points per series
+    Returns:
+        The decimated series
+    """
+    decimated = []
+    for pd in data:
+        x, y = minmax_decimate(pd.x, pd.y, max_points)
+        decimated.append(pd.model_copy(update={"x": x, "y": y}))
+    return decimated
+
+
+def plot_data_digest(data: List[PlotData]) -> "hashlib._Hash":
+    """
+    Returns the SHA-256 of series, which keys their rendered image
+    """
+    digest = hashlib.sha256()
+    for pd in data:
+        digest.update(json.dumps([pd.name, pd.type, len(pd.x)]).encode())
+        digest.update(pd.x.tobytes())
+        digest.update(pd.y.tobytes())
+    return digest
+
+
+def plot_simulation_plotly(data: List[PlotData], width: int | None, height: int | None) -> bytes:
+    """
+    Renders the series with plotly and Kaleido
+
+    Parameters:
+        - data: the series to plot
+        - width: the width of the image in pixels (plotly default if None)
+        - height: the height of the image in pixels (plotly default if None)
+    Returns:
+        The PNG image in bytes
+    """
+    fig = go.Figure(
+        data=[{"x": pd.x, "y": pd.y, "type": pd.type, "name": pd.name} for pd in data],
+        layout={
+            "showlegend": False,
+            "margin": {"t": 4, "r": 4, "l": 4, "b": 4},
+        },
+    )
+
+    return export_plotly_figure(fig, width=width, height=height)
+
+
+def export_plotly_figure(fig: go.Figure, width: int | None, height: int | None) -> bytes:
+    """
+    Exports a plotly figure to PNG, with the Kaleido renderer pool if it is started
+
+    Parameters:
+        - fig: the plotly figure
+        - width: the width of the image in pixels (plotly default if None)
+        - height: the height of the image in pixels (plotly default if None)
+    Returns:
+        The PNG image in bytes
+    """
+    if kaleido_pool.started:
+        return kaleido_pool.render(fig.to_dict(), width=width, height=height)
+
+    buffer = io.BytesIO()
+    fig.write_image(
+        buffer,
+        format="png",
+        width=width,
+        height=height,
+    )
+    buffer.seek(0)
+
+    return buffer.getvalue()
+
+
+def plot_on_axes(ax: Axes, data: List[PlotData]) -> None:
+    """
+    Draws the series on matplotlib axes styled like the plotly template
+
+    Parameters:
+        - ax: the matplotlib axes
+        - data: the series to plot
+    """
+    ax.set_facecolor(PLOTLY_BACKGROUND_COLOR)
+    ax.grid(color="white", linewidth=1)
+    ax.set_axisbelow(True)
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.tick_params(length=0, labelsize=9, labelcolor="#2a3f5f")
+
+    for index, pd in enumerate(data):
+        ax.plot(
+            pd.x,
+            pd.y,
+            color=PLOTLY_COLORWAY[index % len(PLOTLY_COLORWAY)],
+            linewidth=2,
+            # plotly draws markers on scatter traces with less than 20 points
+            marker="o" if len(pd.x) < 20 else None,
+            markersize=5,
+        )
+
+
+def plot_simulation_matplotlib(data: List[PlotData], width: int | None, height: int | None) -> bytes:
+    """
+    Renders the series with matplotlib, mimicking the look of the plotly engine without needing Chromium
+
+    Parameters:
+        - data: the series to plot
+        - width: the width of the image in pixels (plotly default if None)
+        - height: the height of the image in pixels (plotly default if None)
+    Returns:
+        The PNG image in bytes
+    """
+    width = width or PLOTLY_DEFAULT_WIDTH
+    height = height or PLOTLY_DEFAULT_HEIGHT
+
+    # Use the object-oriented API so that no global pyplot state is involved
+    fig = Figure(figsize=(width / PIXELS_PER_INCH, height / PIXELS_PER_INCH), dpi=PIXELS_PER_INCH)
+    plot_on_axes(fig.add_subplot(), data)
+
+    # A padding of 0.3 font sizes is about the 4px margin of the plotly layout
+    fig.set_layout_engine("tight", pad=0.3)
+
+    return get_buffer(fig, PIXELS_PER_INCH).getvalue()
+
+
+def plot_simulation_grid_plotly(panels: List[SimulationPanel], columns: int, width: int, height: int) -> bytes:
+    """
+    Renders one subplot per panel with plotly and Kaleido
+
+    Parameters:
+        - panels: the title and the series of every panel
+        - columns: the number of columns of the grid
+        - width: the width of the image in pixels
+        - height: the height of the image in pixels
+    Returns:
+        The PNG image in bytes
+    """
+    rows = math.ceil(len(panels) / columns)
+    fig = make_subplots(
+        rows=rows,
+        cols=columns,
+        subplot_titles=[title for title, _ in panels],
+        horizontal_spacing=0.2 / columns,
+        vertical_spacing=0.3 / rows,
+    )
+    for index, (_, data) in enumerate(panels):
+        for pd in data:
+            fig.add_trace(
+                {"x": pd.x, "y": pd.y, "type": pd.type, "name": pd.name},
+                row=index // columns + 1,
+                col=index % columns + 1,
+            )
+    # The top margin leaves room for the titles of the first row
+    fig.update_layout(showlegend=False, margin={"t": 24, "r": 4, "l": 4, "b": 4})
+    fig.update_annotations(font_size=12)
+
+    return export_plotly_figure(fig, width=width, height=height)
+
+
+def plot_simulation_grid_matplotlib(panels: List[SimulationPanel], columns: int, width: int, height: int) -> bytes:
+    """
+    Renders one subplot per panel with matplotlib
+
+    Parameters:
+        - panels: the title and the series of every panel
+        - columns: the number of columns of the grid
+        - width: the width of the image in pixels
+        - height: the height of the image in pixels
+    Returns:
+        The PNG image in bytes
+    """
+    rows = math.ceil(len(panels) / columns)
+    fig = Figure(figsize=(width / PIXELS_PER_INCH, height / PIXELS_PER_INCH), dpi=PIXELS_PER_INCH)
+    axes = fig.subplots(rows, columns, squeeze=False).ravel()
+
+    for ax, (title, data) in zip(axes, panels):
+        plot_on_axes(ax, data)
+        ax.set_title(title, fontsize=10, color="#2a3f5f")
+    for ax in axes[len(panels) :]:
+        ax.set_visible(False)
+
+    fig.set_layout_engine("tight", pad=0.3)
+
+    return get_buffer(fig, PIXELS_PER_INCH).getvalue()
 
 
 def generate_simulation_plots(
@@ -29,41 +423,63 @@ def generate_simulation_plots(
     Returns:
         The simulation figure
     """
-    response = fetch_file_content(access_token, config.content_url).decode(encoding="utf-8")
-    try:
-        simulation_config = SimulationConfigurationFile(**json.loads(response))
-    except Exception as exc:
-        raise ValueError("Configuration file is malformed") from exc
+    data = read_plot_data(access_token, config.content_url, config.target)
+
+    if len(data) > 0:
+        # More points than pixels are not visible, they only slow down the serialization and the rendering
+        data = decimate_plot_data(data, settings.simulation_points_per_pixel * (config.w or PLOTLY_DEFAULT_WIDTH))
+        if settings.simulation_plot_engine == SimulationPlotEngine.MATPLOTLIB:
+            plot = plot_simulation_matplotlib
+            render = partial(render_executor.submit, plot_simulation_matplotlib, data, config.w, config.h)
+        else:
+            # Kaleido renders in its own (Chromium) processes, there is no need for a render worker
+            plot = plot_simulation_plotly
+            render = partial(plot_simulation_plotly, data, width=config.w, height=config.h)
+        key = render_cache_key_of_digest(plot_data_digest(data), plot, config.w, config.h)
+        return cached_render(render_cache, key, render)
 
-    data: List[PlotData] = []
+    raise ValueError("No data for selected plot type is found")
 
-    if config.target == "stimulus":
-        stimulus_config = simulation_config.stimulus
-        # in the future the stimulus may have different configs
-        # we should agree how the user can specify the stimulus thumb needed
-        if stimulus_config is not None:
-            data = stimulus_config
-    elif config.target == "simulation":
-        if simulation_config.simulation and len(simulation_config.simulation) > 0:
-            data = list(simulation_config.simulation.items())[0][1]
 
-    if len(data) > 0:
-        fig = go.Figure(
-            data=[{"x": pd.x, "y": pd.y, "type": pd.type, "name": pd.name} for pd in data],
-            layout={
-                "showlegend": False,
-                "margin": {"t": 4, "r": 4, "l": 4, "b": 4},
-            },
-        )
-        buffer = io.BytesIO()
-        fig.write_image(
-            buffer,
-            format="png",
-            width=config.w,
-            height=config.h,
-        )
-        buffer.seek(0)
+def generate_simulation_series(access_token: str, config: SimulationDataInput) -> bytes:
+    """
+    Returns the series of the simulation plot as a compact binary payload
 
-        return buffer.getvalue()
+    Parameters:
+        - config: configuration object contains the content_url, the plot target and the maximum number of points
+    Returns:
+        The series in the format of api.utils.series
+    """
+    data = read_plot_data(access_token, config.content_url, config.target)
+
+    if len(data) > 0:
+        return encode_series([Series(pd.name, pd.x, pd.y) for pd in decimate_plot_data(data, config.max_points)])
 
     raise ValueError("No data for selected plot type is found")
+
+
+def generate_simulation_grid(access_token: str, config: SimulationGridInput) -> bytes:
+    """
+    Renders the stimulus and the recorded locations of a simulation as small multiples in one image
+
+    Parameters:
+        - config: configuration object contains the content_url, the panels to include and the grid dimensions
+    Returns:
+        The PNG image in bytes
+    """
+    panels = read_simulation_panels(access_token, config.content_url, config.location_list, config.include_stimulus)
+
+    if len(panels) == 0:
+        raise ValueError("No data for selected plot type is found")
+
+    rows, columns = grid_shape(len(panels), config.columns)
+    width = config.w or min(columns * GRID_PANEL_WIDTH, GRID_MAX_WIDTH)
+    height = config.h or min(rows * GRID_PANEL_HEIGHT, GRID_MAX_HEIGHT)
+
+    # Decimate per panel so that the total number of points only depends on the image size
+    max_points = settings.simulation_points_per_pixel * max(width // columns, 1)
+    panels = [(title, decimate_plot_data(data, max_points)) for title, data in panels]
+
+    if settings.simulation_plot_engine == SimulationPlotEngine.MATPLOTLIB:
+        return render_executor.submit(plot_simulation_grid_matplotlib, panels, columns, width, height)
+    return plot_simulation_grid_plotly(panels, columns, width=width, height=height)
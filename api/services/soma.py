@@ -0,0 +1,541 @@
+"""
+Module: soma.py
+
+This module reconstructs the soma mesh of a morphology with NeuroMorphoVis, which simulates the
+soma as a soft body in Blender and exports it to GLB.
+
+By default, every reconstruction runs the NMV script, which starts a new Blender and imports the
+nmv modules before doing any work. With BLENDER_WORKERS > 0, the reconstructions are instead sent to
+resident Blender processes running nmv/interface/cli/soma_reconstruction_server.py, which are
+recycled after a number of jobs.
+"""
+
+import json
+import os
+import queue
+import select
+import shutil
+import signal
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+from api.exceptions import DeadlineExceededException, SomaMeshNotFoundException
+from api.models.enums import SomaQuality
+from api.models.soma import SomaExportOptions
+from api.services.disk_cache import OUTPUT_DIRECTORY
+from api.settings import settings
+from api.utils.cancellation import CANCELLATION_POLL_INTERVAL, CancellationToken, current_cancellation
+from api.utils.logger import logger
+
+ROOT_DIRECTORY = Path(__file__).parent.parent.parent
+# Parent of the working directories of the reconstructions run while the request waits
+WORK_DIRECTORY = OUTPUT_DIRECTORY / "work"
+NMV_SCRIPT_PATH = ROOT_DIRECTORY / "neuromorphovis.py"
+NMV_SERVER_SCRIPT_PATH = ROOT_DIRECTORY / "nmv/interface/cli/soma_reconstruction_server.py"
+BLENDER_EXECUTABLE_PATH = ROOT_DIRECTORY / "blender/bbp-blender-3.5/blender-bbp/blender"
+# Environment variable giving the resident Blender the file descriptor of its results
+RESULT_FD_VARIABLE = "NMV_RESULT_FD"
+# Environment variable giving the NMV script the quality preset, which its launcher does not forward as an argument
+QUALITY_VARIABLE = "NMV_SOMA_QUALITY"
+# Environment variable giving the NMV script the export options of the mesh, as a JSON object
+EXPORT_VARIABLE = "NMV_SOMA_EXPORT"
+
+# Seconds given to the NMV script (and its Blender process) to exit before being killed
+NMV_TERMINATION_GRACE = 5
+
+
+def terminate_process_group(process: subprocess.Popen) -> None:
+    """
+    Terminates a process started in its own session, along with its children (e.g. Blender)
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=NMV_TERMINATION_GRACE)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+    except ProcessLookupError:
+        # The process group already exited
+        pass
+
+
+def log_process_output(process: subprocess.Popen, name: str) -> threading.Thread:
+    """
+    Logs the output of a process started with stdout=PIPE line by line, as it is printed, from a
+    background thread
+
+    Returns:
+        The thread, which ends once every process sharing the output (e.g. Blender) exited
+    """
+
+    def log_lines() -> None:
+        assert process.stdout is not None
+        with process.stdout:
+            for line in process.stdout:
+                logger.info("%s[%s]: %s", name, process.pid, line.rstrip())
+
+    thread = threading.Thread(target=log_lines, name=f"{name}-output-{process.pid}", daemon=True)
+    thread.start()
+    return thread
+
+
+def run_nmv_script(command: List[str], niceness: int = 0, environment: Optional[Dict[str, str]] = None) -> None:
+    """
+    Runs the NMV script with the given niceness, terminating it as soon as the request is cancelled.
+    The script inherits the environment of the API, updated with the given variables, and its output
+    is logged as it is printed.
+
+    The calling thread waits for the script, the request handlers call this function with
+    run_in_threadpool() so that the event loop keeps serving the other requests meanwhile.
+
+    Raises:
+        subprocess.CalledProcessError: If the script failed.
+        RequestCancelledException, DeadlineExceededException: If the request is cancelled meanwhile.
+    """
+    token = current_cancellation()
+    # In its own session, so that Blender is terminated with the script
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        command,
+        env={**os.environ, **(environment or {})},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        start_new_session=True,
+    )
+    output_logger = log_process_output(process, "NMV")
+    try:
+        if niceness > 0:
+            # Before the script starts Blender, which inherits the niceness
+            os.setpriority(os.PRIO_PGRP, process.pid, niceness)
+        while True:
+            try:
+                return_code = process.wait(timeout=CANCELLATION_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                token.raise_if_cancelled()
+    except BaseException:
+        logger.info("Terminating NMV script")
+        terminate_process_group(process)
+        raise
+    finally:
+        output_logger.join(timeout=NMV_TERMINATION_GRACE)
+
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command)
+
+
+def nmv_arguments() -> List[str]:
+    """
+    Returns the NMV arguments exporting the soma mesh of a SWC file, except the file and the output directory
+    """
+    return [
+        f"--blender={BLENDER_EXECUTABLE_PATH.as_posix()}",
+        "--input=file",
+        "--export-soma-mesh-blend",
+        "--export-soma-mesh-obj",
+    ]
+
+
+def reconstruction_options(quality: SomaQuality, export: Optional[SomaExportOptions] = None) -> List[str]:
+    """
+    Returns the options that the mesh reconstructed from a SWC content depends on
+    """
+    export = export or SomaExportOptions()
+    return [*nmv_arguments(), f"--soma-quality={quality.value}", f"--soma-export={export.to_json()}"]
+
+
+def nmv_command(swc_path: Path, output_directory: Path) -> List[str]:
+    """
+    Returns the command running the NMV script that exports the soma mesh of a SWC file
+    """
+    return [
+        "python",
+        NMV_SCRIPT_PATH.as_posix(),
+        *nmv_arguments(),
+        f"--morphology-file={swc_path.as_posix()}",
+        f"--output-directory={output_directory.as_posix()}",
+    ]
+
+
+def blender_server_command() -> List[str]:
+    """
+    Returns the command starting a resident Blender that reconstructs the somas of the jobs it receives
+    """
+    return [
+        BLENDER_EXECUTABLE_PATH.as_posix(),
+        "-b",
+        "--verbose",
+        "0",
+        "--python",
+        NMV_SERVER_SCRIPT_PATH.as_posix(),
+        "--",
+        *nmv_arguments(),
+    ]
+
+
+def soma_mesh_path(output_directory: Path, swc_path: Path) -> Path:
+    """
+    Returns the path of the GLB soma mesh exported by the NMV script for a SWC file, which NMV names
+    after the SWC file
+    """
+    return output_directory / "meshes" / f"SOMA_MESH_{swc_path.stem}.glb"
+
+
+@contextmanager
+def work_directory() -> Iterator[Path]:
+    """
+    Creates a working directory for a single reconstruction, deleted with its files on exit
+    """
+    directory = WORK_DIRECTORY / uuid.uuid4().hex
+    directory.mkdir(parents=True)
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def purge_work_directories(max_age: float) -> int:
+    """
+    Deletes the working directories left behind by API workers that were killed mid-reconstruction
+
+    Parameters:
+        - max_age (float): The number of seconds after which a working directory is abandoned.
+    Returns:
+        The number of deleted directories
+    """
+    if not WORK_DIRECTORY.is_dir():
+        return 0
+    purged = 0
+    oldest = time.time() - max_age
+    with os.scandir(WORK_DIRECTORY) as scanner:
+        for entry in scanner:
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < oldest:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    purged += 1
+            except FileNotFoundError:
+                continue
+    return purged
+
+
+def reconstruct_soma(
+    swc_path: Path,
+    output_directory: Path,
+    niceness: int = 0,
+    quality: SomaQuality = SomaQuality.STANDARD,
+    export: Optional[SomaExportOptions] = None,
+) -> Path:
+    """
+    Reconstructs the soma mesh of a SWC file with the NMV script
+
+    Parameters:
+        - swc_path (Path): The SWC file of the morphology.
+        - output_directory (Path): The directory where NMV exports the meshes.
+        - niceness (int): The niceness of the NMV script and of Blender.
+        - quality (SomaQuality): The quality/speed preset of the reconstruction.
+        - export (SomaExportOptions | None): The size and level of detail of the exported mesh.
+    Returns:
+        The path of the GLB soma mesh
+    Raises:
+        SomaMeshNotFoundException: If the script did not export the mesh.
+        subprocess.CalledProcessError: If the script failed.
+        RequestCancelledException, DeadlineExceededException: If the request is cancelled meanwhile.
+    """
+    (output_directory / "meshes").mkdir(exist_ok=True, parents=True)
+
+    if blender_pool.started:
+        logger.info("Running NMV in a resident Blender...")
+        blender_pool.run(swc_path, output_directory, quality, export)
+    else:
+        logger.info("Running NMV script...")
+        environment = {QUALITY_VARIABLE: quality.value, EXPORT_VARIABLE: (export or SomaExportOptions()).to_json()}
+        run_nmv_script(nmv_command(swc_path, output_directory), niceness, environment)
+    logger.info("Completed NMV script execution.")
+
+    mesh_file = soma_mesh_path(output_directory, swc_path)
+    if not mesh_file.is_file():
+        logger.error("OBJ file not found after processing.")
+        raise SomaMeshNotFoundException
+    return mesh_file
+
+
+class BlenderWorker:
+    """
+    Resident Blender process reconstructing the somas of its jobs one after the other
+    """
+
+    def __init__(self, command: List[str], niceness: int = 0) -> None:
+        """
+        Parameters:
+            - command (list): The command starting the Blender running the NMV server script.
+            - niceness (int): The niceness of the Blender process.
+        """
+        self.command = command
+        self.niceness = niceness
+        self.jobs = 0
+        self._process: Optional[subprocess.Popen] = None
+        self._results: Optional[Any] = None
+
+    @property
+    def alive(self) -> bool:
+        """
+        Whether the Blender process is running
+        """
+        return self._process is not None and self._process.poll() is None
+
+    def start(self, timeout: float) -> None:
+        """
+        Starts the Blender process and waits until it imported the nmv modules
+
+        Raises:
+            RuntimeError: If Blender exited or was not ready in time.
+        """
+        read_fd, write_fd = os.pipe()
+        try:
+            # In its own session, so that it is not killed with the requests of its API worker
+            self._process = subprocess.Popen(  # pylint: disable=consider-using-with
+                self.command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                pass_fds=(write_fd,),
+                env={**os.environ, RESULT_FD_VARIABLE: str(write_fd)},
+                start_new_session=True,
+                text=True,
+                errors="replace",
+            )
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        log_process_output(self._process, "Blender")
+        self._results = os.fdopen(read_fd, "r")
+        self.jobs = 0
+        if self.niceness > 0:
+            os.setpriority(os.PRIO_PGRP, self._process.pid, self.niceness)
+
+        try:
+            self._read_result(CancellationToken(timeout))
+        except DeadlineExceededException as exc:
+            self.kill()
+            raise RuntimeError(f"Blender was not ready after {timeout} seconds") from exc
+        except BaseException:
+            self.kill()
+            raise
+
+    def run(
+        self,
+        swc_path: Path,
+        output_directory: Path,
+        quality: SomaQuality = SomaQuality.STANDARD,
+        export: Optional[SomaExportOptions] = None,
+    ) -> Dict[str, Any]:
+        """
+        Reconstructs the soma of a SWC file. The Blender process is killed if the request is
+        cancelled meanwhile, since the soft body simulation cannot be interrupted.
+
+        Returns:
+            The result of the job
+        Raises:
+            RuntimeError: If Blender exited.
+            RequestCancelledException, DeadlineExceededException: If the request is cancelled meanwhile.
+        """
+        assert self._process is not None and self._process.stdin is not None
+        job = {
+            "id": uuid.uuid4().hex,
+            "morphology_file": swc_path.as_posix(),
+            "output_directory": output_directory.as_posix(),
+            "quality": quality.value,
+            "export": (export or SomaExportOptions()).model_dump(exclude_none=True),
+        }
+        self.jobs += 1
+        try:
+            self._process.stdin.write(json.dumps(job) + "\n")
+            self._process.stdin.flush()
+            return self._read_result(current_cancellation())
+        except BaseException:
+            self.kill()
+            raise
+
+    def stop(self) -> None:
+        """
+        Stops the Blender process, letting it finish its current job for a moment
+        """
+        if self._process is not None and self._process.stdin is not None:
+            try:
+                self._process.stdin.close()
+                self._process.wait(timeout=NMV_TERMINATION_GRACE)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
+    def kill(self) -> None:
+        """
+        Terminates the Blender process right away
+        """
+        if self._process is not None:
+            terminate_process_group(self._process)
+            self._process = None
+        if self._results is not None:
+            self._results.close()
+            self._results = None
+
+    def _read_result(self, token: CancellationToken) -> Dict[str, Any]:
+        assert self._process is not None and self._results is not None
+        while True:
+            readable, _, _ = select.select([self._results], [], [], CANCELLATION_POLL_INTERVAL)
+            if readable:
+                # The results are single lines shorter than the atomic size of the pipe writes
+                line = self._results.readline()
+                if not line:
+                    raise RuntimeError(f"Blender exited with code {self._process.wait()}")
+                return json.loads(line)
+            token.raise_if_cancelled()
+
+
+class BlenderLaunch(NamedTuple):
+    """
+    How the resident Blender processes of a pool are started
+    """
+
+    command: List[str]
+    niceness: int
+    startup_timeout: float
+
+    def new_worker(self) -> BlenderWorker:
+        """
+        Returns a worker started with this command and niceness
+        """
+        worker = BlenderWorker(self.command, self.niceness)
+        worker.start(self.startup_timeout)
+        return worker
+
+
+class BlenderWorkerPool:
+    """
+    Pool of resident Blender workers, recycled after a number of jobs
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        size: int,
+        max_jobs: int,
+        startup_timeout: float,
+        niceness: int = 0,
+        command: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Parameters:
+            - size (int): The number of Blender processes, 0 to run the NMV script per reconstruction.
+            - max_jobs (int): The number of jobs after which a Blender process is replaced.
+            - startup_timeout (float): The maximum number of seconds for Blender to get ready.
+            - niceness (int): The niceness of the Blender processes.
+            - command (list | None): The command starting a resident Blender, see blender_server_command().
+        """
+        self.size = size
+        self.max_jobs = max_jobs
+        self.launch = BlenderLaunch(command or blender_server_command(), niceness, startup_timeout)
+        self._idle: "queue.Queue[BlenderWorker]" = queue.Queue()
+        self._workers: List[BlenderWorker] = []
+        self._lock = threading.Lock()
+        self.started = False
+
+    def start(self) -> None:
+        """
+        Starts all the Blender processes of the pool
+        """
+        with self._lock:
+            if self.started or self.size <= 0:
+                return
+            for _ in range(self.size):
+                worker = self.launch.new_worker()
+                self._workers.append(worker)
+                self._idle.put(worker)
+            self.started = True
+        logger.info("Started %s resident Blender workers", self.size)
+
+    def stop(self) -> None:
+        """
+        Stops all the Blender processes of the pool
+        """
+        with self._lock:
+            self.started = False
+            workers, self._workers = self._workers, []
+            self._idle = queue.Queue()
+        for worker in workers:
+            worker.stop()
+
+    def run(
+        self,
+        swc_path: Path,
+        output_directory: Path,
+        quality: SomaQuality = SomaQuality.STANDARD,
+        export: Optional[SomaExportOptions] = None,
+    ) -> None:
+        """
+        Reconstructs the soma of a SWC file in one of the Blender processes
+
+        Raises:
+            RuntimeError: If the reconstruction failed in Blender.
+            RequestCancelledException, DeadlineExceededException: If the request is cancelled meanwhile.
+        """
+        worker = self._acquire(current_cancellation())
+        try:
+            if not worker.alive:
+                worker.start(self.launch.startup_timeout)
+            result = worker.run(swc_path, output_directory, quality, export)
+        except BaseException:
+            self._recycle(worker)
+            raise
+        if worker.jobs >= self.max_jobs:
+            self._recycle(worker)
+        else:
+            self._release(worker)
+
+        if result.get("error"):
+            raise RuntimeError(f"NMV failed: {result['error']}")
+
+    def _acquire(self, token: CancellationToken) -> BlenderWorker:
+        while True:
+            token.raise_if_cancelled()
+            try:
+                return self._idle.get(timeout=CANCELLATION_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _release(self, worker: BlenderWorker) -> None:
+        with self._lock:
+            if self.started and worker in self._workers:
+                self._idle.put(worker)
+                return
+        # The pool was stopped meanwhile
+        worker.stop()
+
+    def _recycle(self, worker: BlenderWorker) -> None:
+        # The replacement is started in the background, so that the request is not delayed by it
+        def replace() -> None:
+            worker.stop()
+            try:
+                worker.start(self.launch.startup_timeout)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # The worker is started again on its next use
+                logger.exception("Could not restart resident Blender")
+            self._release(worker)
+
+        threading.Thread(target=replace, daemon=True).start()
+
+
+blender_pool = BlenderWorkerPool(
+    size=settings.blender_workers,
+    max_jobs=settings.blender_worker_max_jobs,
+    startup_timeout=settings.blender_worker_startup_timeout,
+    niceness=settings.soma_queue.priority,
+)
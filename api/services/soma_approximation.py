@@ -0,0 +1,210 @@
+"""
+Module: soma_approximation.py
+
+This module approximates the soma of a morphology without Blender, for instant previews.
+
+The soma is approximated by the convex envelope of the spheres of its SWC points and of the first
+point of each neurite (the points NeuroMorphoVis pulls the soft body towards): every vertex of a
+subdivided icosahedron centered on the soma is moved along its direction to the farthest extent of
+the spheres in that direction (their support function). The result is exported as a compact GLB
+mesh, or as a PNG of its profile in the XY plane.
+"""
+
+import io
+from pathlib import Path
+from typing import Tuple, Union
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from api.exceptions import InvalidSomaException
+from api.models.enums import SomaApproximationFormat
+from api.services.nexus import fetch_file_content
+from api.services.render_executor import render_executor
+from api.utils.common import get_buffer
+from api.utils.glb import encode_glb
+
+SOMA_TYPE = 1
+# Subdivisions of the icosahedron: 642 vertices and 1280 triangles
+MESH_SUBDIVISIONS = 3
+# Directions sampled for the profile
+PROFILE_DIRECTIONS = 360
+SOMA_COLOR = "black"
+
+ICOSAHEDRON_FACES = np.array(
+    [
+        [0, 11, 5],
+        [0, 5, 1],
+        [0, 1, 7],
+        [0, 7, 10],
+        [0, 10, 11],
+        [1, 5, 9],
+        [5, 11, 4],
+        [11, 10, 2],
+        [10, 7, 6],
+        [7, 1, 8],
+        [3, 9, 4],
+        [3, 4, 2],
+        [3, 2, 6],
+        [3, 6, 8],
+        [3, 8, 9],
+        [4, 9, 5],
+        [2, 4, 11],
+        [6, 2, 10],
+        [8, 6, 7],
+        [9, 8, 1],
+    ]
+)
+
+
+def read_soma_spheres(content: bytes) -> np.ndarray:
+    """
+    Returns the spheres approximating the soma of a SWC content: its soma points and the first point
+    of each neurite
+
+    Returns:
+        The (N, 4) centers and radii of the spheres
+    Raises:
+        InvalidSomaException: If the SWC content is malformed or has no soma point (422).
+    """
+    try:
+        # Columns: index, type, x, y, z, radius, parent
+        points = np.loadtxt(io.BytesIO(content), comments="#", usecols=range(7), ndmin=2)
+    except ValueError as exc:
+        raise InvalidSomaException("The SWC file is malformed") from exc
+
+    is_soma = points[:, 1] == SOMA_TYPE
+    if not is_soma.any():
+        raise InvalidSomaException("The SWC file has no soma point")
+    neurite_roots = ~is_soma & np.isin(points[:, 6], points[is_soma, 0])
+    return points[is_soma | neurite_roots][:, 2:6]
+
+
+def icosphere(subdivisions: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the unit vertices and the outward oriented triangles of a subdivided icosahedron
+    """
+    golden = (1 + 5**0.5) / 2
+    vertices = np.array(
+        [
+            [-1, golden, 0],
+            [1, golden, 0],
+            [-1, -golden, 0],
+            [1, -golden, 0],
+            [0, -1, golden],
+            [0, 1, golden],
+            [0, -1, -golden],
+            [0, 1, -golden],
+            [golden, 0, -1],
+            [golden, 0, 1],
+            [-golden, 0, -1],
+            [-golden, 0, 1],
+        ]
+    )
+    vertices /= np.linalg.norm(vertices, axis=1, keepdims=True)
+    faces = ICOSAHEDRON_FACES
+    for _ in range(subdivisions):
+        # Splits every triangle in 4 at the middle of its edges, shared with the neighbouring triangles
+        edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+        unique_edges, inverse = np.unique(np.sort(edges, axis=1), axis=0, return_inverse=True)
+        middles = vertices[unique_edges].mean(axis=1)
+        middles /= np.linalg.norm(middles, axis=1, keepdims=True)
+        first, second, third = faces.T
+        first_second, second_third, third_first = len(vertices) + inverse.reshape(3, -1)
+        faces = np.concatenate(
+            [
+                np.stack([first, first_second, third_first], axis=1),
+                np.stack([second, second_third, first_second], axis=1),
+                np.stack([third, third_first, second_third], axis=1),
+                np.stack([first_second, second_third, third_first], axis=1),
+            ]
+        )
+        vertices = np.concatenate([vertices, middles])
+    return vertices, faces
+
+
+def support_extents(spheres: np.ndarray, center: np.ndarray, directions: np.ndarray) -> np.ndarray:
+    """
+    Returns the distance from center to the farthest extent of the spheres along each direction
+    """
+    dimensions = directions.shape[1]
+    return ((spheres[:, :dimensions] - center) @ directions.T + spheres[:, 3:4]).max(axis=0)
+
+
+def approximate_soma_mesh(spheres: np.ndarray, subdivisions: int = MESH_SUBDIVISIONS) -> Tuple[np.ndarray, ...]:
+    """
+    Returns the positions, the normals and the triangles of the mesh approximating a soma
+    """
+    directions, triangles = icosphere(subdivisions)
+    center = spheres[:, :3].mean(axis=0)
+    positions = center + support_extents(spheres, center, directions)[:, np.newaxis] * directions
+
+    # Vertex normals, as the area weighted sum of the normals of their triangles
+    corners = positions[triangles]
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals = np.zeros_like(positions)
+    for corner in range(3):
+        np.add.at(normals, triangles[:, corner], face_normals)
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    return positions, normals, triangles
+
+
+def plot_soma_profile(spheres: np.ndarray) -> plt.Figure:
+    """
+    Creates a matplotlib figure of the profile of a soma in the XY plane
+    """
+    angles = np.linspace(0, 2 * np.pi, PROFILE_DIRECTIONS, endpoint=False)
+    directions = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    center = spheres[:, :2].mean(axis=0)
+    profile = center + support_extents(spheres, center, directions)[:, np.newaxis] * directions
+
+    fig, ax = plt.subplots()
+    ax.fill(profile[:, 0], profile[:, 1], color=SOMA_COLOR)
+    ax.set_aspect("equal")
+    ax.set_axis_off()
+    fig.set_layout_engine("tight")
+    return fig
+
+
+def render_soma_approximation(
+    source: Union[str, bytes], output_format: SomaApproximationFormat, dpi: Union[int, None] = 72
+) -> bytes:
+    """
+    Returns the approximated soma of a morphology as a GLB mesh or a PNG profile.
+
+    Parameters:
+        - source (str | bytes): The SWC content, or the path of an SWC file.
+        - output_format (SomaApproximationFormat): The format of the result.
+        - dpi (int | None): The Dots Per Inch of the PNG profile.
+    Returns:
+        The GLB or PNG file in bytes format
+    """
+    spheres = read_soma_spheres(source if isinstance(source, bytes) else Path(source).read_bytes())
+
+    if output_format == SomaApproximationFormat.GLB:
+        return encode_glb(*approximate_soma_mesh(spheres))
+
+    fig = plot_soma_profile(spheres)
+    try:
+        return get_buffer(fig, dpi).getvalue()
+    finally:
+        plt.close(fig)
+
+
+def generate_soma_approximation(
+    access_token: str, content_url: str, output_format: SomaApproximationFormat, dpi: Union[int, None] = 72
+) -> bytes:
+    """
+    Returns the approximated soma of the morphology of a SWC distribution as a GLB mesh or a PNG profile.
+
+    Parameters:
+        - access_token (str): The access token of the user.
+        - content_url (str): URL of the SWC distribution.
+        - output_format (SomaApproximationFormat): The format of the result.
+        - dpi (int | None): The Dots Per Inch of the PNG profile.
+    Returns:
+        The GLB or PNG file in bytes format
+    """
+    content = fetch_file_content(access_token, content_url)
+
+    return render_executor.run_on_content(render_soma_approximation, content, output_format, dpi, suffix=".swc")
@@ -0,0 +1,515 @@
+"""
+Module: soma_jobs.py
+
+This module runs the soma reconstructions as asynchronous jobs.
+
+A Blender run takes longer than the proxies let a request wait, and a retried request would redo
+it. Instead, the SWC file is stored with a job in a SQLite database shared by the API workers, and
+worker threads claim the pending jobs and run them. Jobs are deduplicated by the SHA-256 of the SWC
+content (per submitter, who is the only one to see the job, as long as Nexus still lets them read
+the SWC file), and finished jobs are deleted with their mesh after a TTL.
+
+A running job holds a lease on itself: if its API worker dies, the job is claimed again by another
+worker once the lease expired, up to a number of attempts after which it fails. A worker only
+records the result of a job while it still holds its claim.
+"""
+
+import hashlib
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from api.exceptions import QueueFullException, RequestCancelledException
+from api.models.enums import JobStatus, SomaQuality
+from api.models.soma import SomaExportOptions, SomaJob
+from api.services.disk_cache import OUTPUT_DIRECTORY, DiskCache, cache_key
+from api.services.mesh_cache import mesh_cache
+from api.services.soma import reconstruct_soma, reconstruction_options, soma_mesh_path
+from api.settings import settings
+from api.utils.cancellation import CancellationToken, cancellation_scope
+from api.utils.logger import logger
+
+SWC_FILE_NAME = "morphology.swc"
+# Seconds between two looks for pending jobs submitted to other API workers
+JOB_POLL_INTERVAL = 1.0
+# Seconds added to the job timeout for the lease of a running job
+LEASE_GRACE = 60.0
+# Seconds after which a client whose job was rejected should retry
+PENDING_RETRY_AFTER = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS soma_jobs (
+    id TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    quality TEXT NOT NULL,
+    export TEXT NOT NULL,
+    status TEXT NOT NULL,
+    submitter TEXT,
+    content_url TEXT,
+    mesh_path TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    lease_expires_at REAL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS soma_jobs_digest ON soma_jobs (digest);
+CREATE INDEX IF NOT EXISTS soma_jobs_status ON soma_jobs (status, created_at);
+"""
+
+SomaRunner = Callable[[Path, Path, int, SomaQuality, SomaExportOptions], Path]
+
+
+def content_digest(content: bytes, quality: SomaQuality, export: SomaExportOptions) -> str:
+    """
+    Returns the key deduplicating the jobs of a SWC content reconstructed and exported with the same options
+    """
+    return hashlib.sha256(b"\0".join([content, quality.value.encode(), export.to_json().encode()])).hexdigest()
+
+
+def to_datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    """
+    Converts a stored UNIX timestamp to an aware datetime
+    """
+    return None if timestamp is None else datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+class SomaJobStore:
+    """
+    Persistent store of the soma reconstruction jobs, safe to use from several threads and processes
+    """
+
+    def __init__(self, directory: Path, ttl: float, max_pending: int, max_attempts: int = 3) -> None:
+        """
+        Parameters:
+            - directory (Path): The directory of the database and of the job files.
+            - ttl (float): The number of seconds a finished job is kept.
+            - max_pending (int): The number of pending jobs above which new jobs are rejected.
+            - max_attempts (int): The number of times a job is claimed before it fails, e.g. when its
+              reconstruction kills its worker or always overruns its lease.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._initialized = False
+
+    @property
+    def database_path(self) -> Path:
+        """
+        The path of the SQLite database
+        """
+        return self.directory / "jobs.sqlite3"
+
+    def job_directory(self, job_id: str) -> Path:
+        """
+        Returns the directory of the SWC file and of the meshes of a job
+        """
+        return self.directory / job_id
+
+    def submit(  # pylint: disable=too-many-arguments
+        self,
+        content: bytes,
+        quality: SomaQuality = SomaQuality.STANDARD,
+        export: Optional[SomaExportOptions] = None,
+        submitter: Optional[str] = None,
+        content_url: Optional[str] = None,
+    ) -> Tuple[SomaJob, bool]:
+        """
+        Creates a job reconstructing the soma of a SWC content with a quality preset and export options,
+        unless a job of the same submitter, content and options is already pending, running or succeeded.
+        The URL the content was fetched from is kept to check the access of the submitter to the job.
+
+        Returns:
+            The job, and whether it was created
+        Raises:
+            QueueFullException: If too many jobs are pending (429).
+        """
+        export = export or SomaExportOptions()
+        digest = content_digest(content, quality, export)
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT * FROM soma_jobs WHERE digest = ? AND submitter IS ? AND status != ?"
+                " AND (expires_at IS NULL OR expires_at > ?) ORDER BY created_at DESC LIMIT 1",
+                (digest, submitter, JobStatus.FAILED.value, now),
+            ).fetchone()
+            if row is not None:
+                return self._to_job(row), False
+
+            (pending,) = connection.execute(
+                "SELECT COUNT(*) FROM soma_jobs WHERE status = ?", (JobStatus.PENDING.value,)
+            ).fetchone()
+            if pending >= self.max_pending:
+                raise QueueFullException(PENDING_RETRY_AFTER)
+
+            job_id = uuid.uuid4().hex
+            job_directory = self.job_directory(job_id)
+            job_directory.mkdir(parents=True)
+            (job_directory / SWC_FILE_NAME).write_bytes(content)
+            connection.execute(
+                "INSERT INTO soma_jobs"
+                " (id, digest, quality, export, status, submitter, content_url, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    digest,
+                    quality.value,
+                    export.to_json(),
+                    JobStatus.PENDING.value,
+                    submitter,
+                    content_url,
+                    now,
+                    now,
+                ),
+            )
+            row = connection.execute("SELECT * FROM soma_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_job(row), True
+
+    def get(self, job_id: str, submitter: Optional[str] = None) -> Optional[SomaJob]:
+        """
+        Returns a job of a submitter, None if it does not exist, expired, or was submitted by someone else
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT * FROM soma_jobs WHERE id = ? AND submitter IS ? AND (expires_at IS NULL OR expires_at > ?)",
+                (job_id, submitter, time.time()),
+            ).fetchone()
+        return None if row is None else self._to_job(row)
+
+    def claim(self, lease: float) -> Optional[SomaJob]:
+        """
+        Marks the oldest pending job (or running job whose lease expired) as running. The jobs whose
+        lease expired on their last attempt are failed instead.
+
+        Parameters:
+            - lease (float): The number of seconds after which the job can be claimed again.
+        Returns:
+            The claimed job, None if there is none
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE soma_jobs SET status = ?, error = ?, updated_at = ?, lease_expires_at = NULL, expires_at = ?"
+                " WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+                (
+                    JobStatus.FAILED.value,
+                    f"The reconstruction did not finish after {self.max_attempts} attempts",
+                    now,
+                    now + self.ttl,
+                    JobStatus.RUNNING.value,
+                    now,
+                    self.max_attempts,
+                ),
+            )
+            row = connection.execute(
+                "SELECT id FROM soma_jobs WHERE status = ? OR (status = ? AND lease_expires_at < ?)"
+                " ORDER BY created_at LIMIT 1",
+                (JobStatus.PENDING.value, JobStatus.RUNNING.value, now),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE soma_jobs SET status = ?, attempts = attempts + 1, updated_at = ?, lease_expires_at = ?"
+                " WHERE id = ?",
+                (JobStatus.RUNNING.value, now, now + lease, row["id"]),
+            )
+            row = connection.execute("SELECT * FROM soma_jobs WHERE id = ?", (row["id"],)).fetchone()
+        return self._to_job(row)
+
+    def complete(self, job: SomaJob, mesh_path: Path) -> bool:
+        """
+        Marks a claimed job as succeeded with its mesh
+
+        Returns:
+            Whether the job was still running under this claim, otherwise it is left as is
+        """
+        return self._finish(job, JobStatus.SUCCEEDED, mesh_path=mesh_path.as_posix())
+
+    def fail(self, job: SomaJob, error: str) -> bool:
+        """
+        Marks a claimed job as failed with its error
+
+        Returns:
+            Whether the job was still running under this claim, otherwise it is left as is
+        """
+        return self._finish(job, JobStatus.FAILED, error=error)
+
+    def release(self, job: SomaJob) -> None:
+        """
+        Puts a claimed job back to pending, e.g. when its worker stops, without counting its attempt
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE soma_jobs SET status = ?, attempts = attempts - 1, updated_at = ?, lease_expires_at = NULL"
+                " WHERE id = ? AND status = ? AND attempts = ?",
+                (JobStatus.PENDING.value, time.time(), job.id, JobStatus.RUNNING.value, job.attempts),
+            )
+
+    def purge_expired(self) -> int:
+        """
+        Deletes the expired jobs with their files
+
+        Returns:
+            The number of deleted jobs
+        """
+        with self._transaction() as connection:
+            job_ids = [
+                row["id"]
+                for row in connection.execute("SELECT id FROM soma_jobs WHERE expires_at <= ?", (time.time(),))
+            ]
+            connection.executemany("DELETE FROM soma_jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+        for job_id in job_ids:
+            shutil.rmtree(self.job_directory(job_id), ignore_errors=True)
+        return len(job_ids)
+
+    def _finish(
+        self, job: SomaJob, status: JobStatus, mesh_path: Optional[str] = None, error: Optional[str] = None
+    ) -> bool:
+        # Once the lease expired, the job may have been claimed again by another worker, which records its result
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE soma_jobs SET status = ?, mesh_path = ?, error = ?, updated_at = ?, lease_expires_at = NULL,"
+                " expires_at = ? WHERE id = ? AND status = ? AND attempts = ?",
+                (status.value, mesh_path, error, now, now + self.ttl, job.id, JobStatus.RUNNING.value, job.attempts),
+            )
+        return cursor.rowcount == 1
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per operation: connections cannot be shared between threads
+        if not self._initialized:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        with closing(sqlite3.connect(self.database_path, timeout=30, isolation_level=None)) as connection:
+            connection.row_factory = sqlite3.Row
+            if not self._initialized:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(SCHEMA)
+                self._initialized = True
+            yield connection
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE: the other processes cannot claim/submit between the reads and the writes
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> SomaJob:
+        return SomaJob(
+            id=row["id"],
+            status=JobStatus(row["status"]),
+            quality=SomaQuality(row["quality"]),
+            export=SomaExportOptions.model_validate_json(row["export"]),
+            created_at=to_datetime(row["created_at"]),
+            updated_at=to_datetime(row["updated_at"]),
+            expires_at=to_datetime(row["expires_at"]),
+            error=row["error"],
+            submitter=row["submitter"],
+            content_url=row["content_url"],
+            attempts=row["attempts"],
+            mesh_path=row["mesh_path"],
+        )
+
+
+class SomaReconstructor:
+    """
+    Reconstructs the soma of the SWC file of a job, or reuses the cached mesh of the same content and options
+    """
+
+    def __init__(self, runner: SomaRunner = reconstruct_soma, niceness: int = 0, cache: Optional[DiskCache] = None):
+        """
+        Parameters:
+            - runner (Callable): Reconstructs the soma of a SWC file into an output directory, with a niceness,
+              a quality preset and export options.
+            - niceness (int): The niceness of the NMV runs.
+            - cache (DiskCache | None): The cache of the meshes, looked up before running a job.
+        """
+        self.runner = runner
+        self.niceness = niceness
+        self.cache = cache
+
+    def reconstruct(self, swc_path: Path, job_directory: Path, job: SomaJob) -> Path:
+        """
+        Returns the path of the mesh of the job, in its directory
+        """
+        if self.cache is None:
+            return self.runner(swc_path, job_directory, self.niceness, job.quality, job.export)
+
+        mesh_key = cache_key(swc_path.read_bytes(), reconstruction_options(job.quality, job.export))
+        mesh_path = soma_mesh_path(job_directory, swc_path)
+        if self.cache.link(mesh_key, mesh_path):
+            logger.info("Soma mesh of %s found in cache", swc_path)
+            return mesh_path
+        mesh_path = self.runner(swc_path, job_directory, self.niceness, job.quality, job.export)
+        self.cache.put(mesh_key, mesh_path)
+        return mesh_path
+
+
+class RunningJobs:
+    """
+    The cancellation tokens of the jobs run by the worker threads, cancelled together when the workers stop
+    """
+
+    def __init__(self) -> None:
+        self.stopping = threading.Event()
+        self._tokens: Dict[str, CancellationToken] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def running(self, job_id: str, token: CancellationToken) -> Iterator[None]:
+        """
+        Registers the token of a job for the duration of the context, cancelled if the workers are stopping
+        """
+        with self._lock:
+            self._tokens[job_id] = token
+            if self.stopping.is_set():
+                token.cancel()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._tokens[job_id]
+
+    def stop(self) -> None:
+        """
+        Cancels the running jobs and the ones started from now on
+        """
+        with self._lock:
+            self.stopping.set()
+            for token in self._tokens.values():
+                token.cancel()
+
+
+class SomaJobWorkers:
+    """
+    Threads running the pending soma reconstruction jobs
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        store: SomaJobStore,
+        workers: int,
+        job_timeout: float,
+        niceness: int = 0,
+        runner: SomaRunner = reconstruct_soma,
+        cache: Optional[DiskCache] = None,
+    ) -> None:
+        """
+        Parameters:
+            - store (SomaJobStore): The store of the jobs.
+            - workers (int): The number of jobs run at the same time.
+            - job_timeout (float): The number of seconds after which a job is stopped and failed.
+            - niceness (int): The niceness of the NMV runs.
+            - runner (Callable): Reconstructs the soma of a SWC file into an output directory, with a niceness,
+              a quality preset and export options.
+            - cache (DiskCache | None): The cache of the meshes, looked up before running a job.
+        """
+        self.store = store
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.reconstructor = SomaReconstructor(runner, niceness, cache)
+        self._threads: List[threading.Thread] = []
+        self._running = RunningJobs()
+        self._wake_up = threading.Event()
+
+    def start(self) -> None:
+        """
+        Starts the worker threads
+        """
+        if self._threads:
+            return
+        self._running = RunningJobs()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"soma-job-worker-{index}", daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        if self._threads:
+            logger.info("Started %s soma job workers", self.workers)
+
+    def stop(self) -> None:
+        """
+        Stops the worker threads. The running jobs are stopped and put back to pending.
+        """
+        self._running.stop()
+        self._wake_up.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def wake_up(self) -> None:
+        """
+        Makes an idle worker look for pending jobs right away, e.g. after a submission
+        """
+        self._wake_up.set()
+
+    def _work(self) -> None:
+        running = self._running
+        while not running.stopping.is_set():
+            try:
+                job = self.store.claim(lease=self.job_timeout + LEASE_GRACE)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Could not claim soma job")
+                job = None
+            if job is None:
+                self._wake_up.wait(JOB_POLL_INTERVAL)
+                self._wake_up.clear()
+                continue
+            self._run(job, running)
+
+    def _run(self, job: SomaJob, running: RunningJobs) -> None:
+        token = CancellationToken(self.job_timeout)
+        job_directory = self.store.job_directory(job.id)
+        logger.info("Running soma job %s (attempt %s)", job.id, job.attempts)
+        with running.running(job.id, token):
+            try:
+                with cancellation_scope(token):
+                    mesh_path = self.reconstructor.reconstruct(job_directory / SWC_FILE_NAME, job_directory, job)
+                recorded = self.store.complete(job, mesh_path)
+                logger.info("Soma job %s succeeded", job.id)
+            except RequestCancelledException:
+                # The worker is stopping, another one runs the job again
+                self.store.release(job)
+                return
+            except HTTPException as exc:
+                logger.warning("Soma job %s failed: %s", job.id, exc.detail)
+                recorded = self.store.fail(job, exc.detail)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                logger.exception("Soma job %s failed", job.id)
+                recorded = self.store.fail(job, str(exc) or type(exc).__name__)
+        if not recorded:
+            logger.warning("Soma job %s was claimed again after its lease expired, its result is dropped", job.id)
+
+
+soma_job_store = SomaJobStore(
+    directory=Path(settings.soma_job_directory) if settings.soma_job_directory else OUTPUT_DIRECTORY / "jobs",
+    ttl=settings.soma_job_ttl,
+    max_pending=settings.soma_job_max_pending,
+    max_attempts=settings.soma_job_max_attempts,
+)
+
+soma_job_workers = SomaJobWorkers(
+    store=soma_job_store,
+    workers=settings.soma_job_workers,
+    job_timeout=settings.soma_job_timeout,
+    niceness=settings.soma_queue.priority,
+    cache=mesh_cache,
+)
@@ -0,0 +1,130 @@
+"""
+Module: sprite_sheet.py
+
+This module renders the thumbnails of a grid (e.g. of a listing page) into a single sprite sheet.
+
+The cells are generated concurrently like the items of a batch (see batch.py), at a resolution
+matching the cell size, then scaled down to fit their cell and pasted on a transparent sheet. The
+sheet is returned with a JSON map giving the offset and the status of every cell, as the two fields
+of a multipart/form-data body, which browsers parse natively with Response.formData().
+"""
+
+import io
+import json
+import math
+from typing import List, Tuple
+from uuid import uuid4
+
+from PIL import Image
+
+from api.exceptions import SpriteSheetTooLargeException
+from api.models.common import BatchItem
+from api.models.enums import BatchItemType
+from api.services.batch import BatchResult
+from api.services.simulation_img import grid_shape
+
+# Default size of the matplotlib figures (inches), which the dpi of the cells is computed from
+FIGURE_SIZE = (6.4, 4.8)
+SPRITE_SHEET_FILE_NAME = "sprite-sheet.png"
+# Maximum width and height of a sheet in pixels, which bounds the memory of its image
+SPRITE_SHEET_MAX_SIZE = 8192
+
+
+def sprite_item(item: BatchItem, cell_width: int, cell_height: int) -> BatchItem:
+    """
+    Returns the item rendered at the resolution of a cell, instead of its own
+    """
+    if item.type == BatchItemType.SIMULATION_PLOT:
+        return item.model_copy(update={"w": cell_width, "h": cell_height})
+    dpi = max(10, math.ceil(max(cell_width / FIGURE_SIZE[0], cell_height / FIGURE_SIZE[1])))
+    return item.model_copy(update={"dpi": dpi})
+
+
+def sheet_shape(count: int, cell_width: int, cell_height: int, columns: int | None = None) -> Tuple[int, int]:
+    """
+    Returns the number of rows and columns of the sheet of a grid, see grid_shape()
+
+    Raises:
+        SpriteSheetTooLargeException: If the sheet would be wider or higher than SPRITE_SHEET_MAX_SIZE.
+    """
+    rows, columns = grid_shape(count, columns)
+    if max(columns * cell_width, rows * cell_height) > SPRITE_SHEET_MAX_SIZE:
+        raise SpriteSheetTooLargeException(SPRITE_SHEET_MAX_SIZE)
+    return rows, columns
+
+
+def paste_thumbnail(sheet: Image.Image, image: bytes, cell: Tuple[int, int, int, int]) -> None:
+    """
+    Pastes an image on a cell (x, y, width, height) of a sheet, scaled down to fit the cell, keeping its
+    aspect ratio, and centered in it
+    """
+    x, y, cell_width, cell_height = cell
+    with Image.open(io.BytesIO(image)) as opened:
+        thumbnail = opened.convert("RGBA")
+    thumbnail.thumbnail((cell_width, cell_height), Image.Resampling.LANCZOS)
+    offset = (x + (cell_width - thumbnail.width) // 2, y + (cell_height - thumbnail.height) // 2)
+    sheet.paste(thumbnail, offset, thumbnail)
+
+
+def compose_sprite_sheet(
+    results: List[BatchResult], cell_width: int, cell_height: int, columns: int | None = None
+) -> Tuple[bytes, dict]:
+    """
+    Pastes the thumbnails of a grid on a sprite sheet, in the order of their items (row by row)
+
+    Parameters:
+        - results (list): The results of the items of the grid.
+        - cell_width (int): The width of a cell in pixels.
+        - cell_height (int): The height of a cell in pixels.
+        - columns (int | None): The number of columns of the grid, as square as possible if not set.
+    Returns:
+        The PNG sprite sheet, and its map giving the offset and the status of every cell
+    Raises:
+        SpriteSheetTooLargeException: If the sheet would be wider or higher than SPRITE_SHEET_MAX_SIZE.
+    """
+    rows, columns = sheet_shape(len(results), cell_width, cell_height, columns)
+    sheet = Image.new("RGBA", (columns * cell_width, rows * cell_height), (0, 0, 0, 0))
+    cells = []
+    for result in sorted(results, key=lambda result: result.index):
+        x = (result.index % columns) * cell_width
+        y = (result.index // columns) * cell_height
+        cell = {key: value for key, value in result.to_manifest().items() if key != "file"}
+        cells.append({**cell, "x": x, "y": y})
+        if result.image is not None:
+            paste_thumbnail(sheet, result.image, (x, y, cell_width, cell_height))
+
+    buffer = io.BytesIO()
+    sheet.save(buffer, format="PNG")
+    sprite_map = {
+        "width": sheet.width,
+        "height": sheet.height,
+        "cell_width": cell_width,
+        "cell_height": cell_height,
+        "columns": columns,
+        "cells": cells,
+    }
+    return buffer.getvalue(), sprite_map
+
+
+def encode_sprite_sheet(image: bytes, sprite_map: dict) -> Tuple[bytes, str]:
+    """
+    Returns a multipart/form-data body with the map (field "map") and the sheet (field "image")
+
+    Returns:
+        The body and its media type
+    """
+    boundary = uuid4().hex
+    body = b"".join(
+        [
+            f"--{boundary}\r\n".encode(),
+            b'Content-Disposition: form-data; name="map"\r\n',
+            b"Content-Type: application/json\r\n\r\n",
+            json.dumps(sprite_map).encode(),
+            f"\r\n--{boundary}\r\n".encode(),
+            f'Content-Disposition: form-data; name="image"; filename="{SPRITE_SHEET_FILE_NAME}"\r\n'.encode(),
+            b"Content-Type: image/png\r\n\r\n",
+            image,
+            f"\r\n--{boundary}--\r\n".encode(),
+        ]
+    )
+    return body, f"multipart/form-data; boundary={boundary}"
@@ -0,0 +1,95 @@
+"""
+Module: storage.py
+
+This module keeps the disk usage of the soma reconstructions and of the thumbnails bounded.
+
+The reconstructions leave files behind them: the jobs and their meshes, the meshes of the cache and
+the working directories of the API workers that were killed mid-reconstruction. A background thread
+of every API worker periodically deletes the expired jobs, evicts the caches of the meshes and of
+the thumbnails down to their quota and deletes the abandoned working directories. All of them can
+run concurrently in several API workers.
+"""
+
+import threading
+from functools import partial
+from typing import Callable, Dict, Optional
+
+from api.services.mesh_cache import mesh_cache
+from api.services.morpho_tiles import geometry_store
+from api.services.render_cache import render_cache
+from api.services.soma import purge_work_directories
+from api.services.soma_jobs import soma_job_store
+from api.settings import settings
+from api.utils.logger import logger
+
+
+class StorageCollector:
+    """
+    Background thread running the garbage collection tasks of the storage
+    """
+
+    def __init__(self, interval: float, tasks: Dict[str, Callable[[], int]]) -> None:
+        """
+        Parameters:
+            - interval (float): The number of seconds between two collections.
+            - tasks (dict): The tasks by the name of what they delete, returning the number of deleted items.
+        """
+        self.interval = interval
+        self.tasks = tasks
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        """
+        Starts the collection thread, which collects right away
+        """
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="storage-collector", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the collection thread
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def collect(self) -> Dict[str, int]:
+        """
+        Runs every task once. A failed task does not stop the others.
+
+        Returns:
+            The number of deleted items by task
+        """
+        collected = {}
+        for name, task in self.tasks.items():
+            try:
+                collected[name] = task()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Could not delete the %s", name)
+                continue
+            if collected[name]:
+                logger.info("Deleted %s %s", collected[name], name)
+        return collected
+
+    def _run(self) -> None:
+        self.collect()
+        while not self._stopping.wait(self.interval):
+            self.collect()
+
+
+storage_collector = StorageCollector(
+    interval=settings.storage_gc_interval,
+    tasks={
+        "expired soma jobs": soma_job_store.purge_expired,
+        "soma meshes above the cache quota": mesh_cache.evict,
+        "thumbnails above the cache quota": render_cache.evict,
+        "projected morphologies above the cache quota": geometry_store.cache.evict,
+        "expired accesses to the tile pyramids": geometry_store.purge_expired_accesses,
+        "abandoned working directories": partial(purge_work_directories, settings.soma_work_max_age),
+    },
+)
@@ -5,13 +5,16 @@ This module exposes the business logic for generating trace thumbnails
 """
 
 import io
-from typing import Any, Union
+from typing import IO, Any, Tuple, Union
 import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy.typing import NDArray
 from api.utils.common import get_buffer
+from api.utils.decimation import minmax_decimate
+from api.utils.series import Series, encode_series
 from api.services.nexus import fetch_file_content
+from api.services.render_cache import render_on_content_cached
 from api.utils.trace_img import select_element, select_protocol, select_response, get_unit, get_conversion, get_rate
 from api.models.enums import MetaType
 
@@ -19,6 +22,23 @@ from api.models.enums import MetaType
 Num = Union[int, float]
 
 
+def to_display_unit(data: NDArray[Any], unit: str) -> Tuple[NDArray[Any], Union[str, None]]:
+    """
+    Scales the trace data from SI units to the units used for display
+
+    Args:
+        data: the trace data
+        unit: the SI unit of the data as stored in the NWB file
+    Returns:
+        The scaled data and its display unit (None if the unit is unknown)
+    """
+    if unit == "volts":
+        return data * 1e3, "mV"
+    if unit == "amperes":
+        return data * 1e12, "pA"
+    return data, None
+
+
 def plot_nwb(data: NDArray[Any], unit: str, rate: Num) -> plt.FigureBase:
     """Plots traces"""
 
@@ -38,15 +58,8 @@ def plot_nwb(data: NDArray[Any], unit: str, rate: Num) -> plt.FigureBase:
             return np.arange(start, end + stepsize, stepsize)
         return None
 
-    yrunit = None
-
     # Plotting
-    if unit == "volts":
-        data = data * 1e3
-        yrunit = "mV"
-    elif unit == "amperes":
-        data = data * 1e12
-        yrunit = "pA"
+    data, yrunit = to_display_unit(data, unit)
 
     npoints = data.shape[0]
     timestamps = 1000 * np.linspace(0, npoints / rate, npoints)
@@ -72,22 +85,17 @@ def plot_nwb(data: NDArray[Any], unit: str, rate: Num) -> plt.FigureBase:
     return figure
 
 
-def generate_electrophysiology_image(access_token: str, content_url: str = "", dpi: Union[int, None] = 72) -> bytes:
-    """Creates and returns an electrophysiology trace image.
+def read_electrophysiology_trace(source: Union[str, IO[bytes]]) -> Tuple[NDArray[Any], str, float]:
+    """Selects the thumbnail sweep of an NWB file and reads it.
 
     Args:
-        access_token (str): The authorization token.
-        content_url (str): The content URL that contains the NWB file.
-        dpi (Union[int, None]): Optional parameter that defines the Dots Per Inch of the image result.
-                                Higher DPI means higher resolution.
+        source (str | IO[bytes]): The path of the NWB file, or a file-like object with its content.
 
     Returns:
-        bytes: The image in bytes format.
+        Tuple[NDArray[Any], str, float]: The converted data, its unit and its sampling rate.
     """
-    content: bytes = fetch_file_content(access_token=access_token, content_url=content_url)
-
     # Using context manager to handle the HDF5 file properly and ensure it is closed
-    with h5py.File(io.BytesIO(content), "r") as h5_handle:
+    with h5py.File(source, "r") as h5_handle:
         h5_handle = h5_handle["data_organization"]
         h5_handle = h5_handle[select_element(list(h5_handle.keys()), n=0)]
         h5_handle = h5_handle[select_protocol(list(h5_handle.keys()))]
@@ -103,6 +111,22 @@ def generate_electrophysiology_image(access_token: str, content_url: str = "", d
         # Retrieve and process the data
         data = np.array(h5_handle["data"][:]) * conversion
 
+    return data, unit, rate
+
+
+def render_electrophysiology_image(source: Union[str, bytes], dpi: Union[int, None] = 72) -> bytes:
+    """Renders the thumbnail sweep of an NWB file.
+
+    Args:
+        source (str | bytes): The content of the NWB file, or its path.
+        dpi (Union[int, None]): Optional parameter that defines the Dots Per Inch of the image result.
+
+    Returns:
+        bytes: The image in bytes format.
+    """
+    # From a path, h5py only reads the selected sweep instead of the whole file
+    data, unit, rate = read_electrophysiology_trace(io.BytesIO(source) if isinstance(source, bytes) else source)
+
     # Generate the plot using the data
     fig = plot_nwb(data, unit, rate)
 
@@ -115,3 +139,42 @@ def generate_electrophysiology_image(access_token: str, content_url: str = "", d
 
     # Return the image as bytes
     return buffer.getvalue()
+
+
+def generate_electrophysiology_image(access_token: str, content_url: str = "", dpi: Union[int, None] = 72) -> bytes:
+    """Creates and returns an electrophysiology trace image.
+
+    Args:
+        access_token (str): The authorization token.
+        content_url (str): The content URL that contains the NWB file.
+        dpi (Union[int, None]): Optional parameter that defines the Dots Per Inch of the image result.
+                                Higher DPI means higher resolution.
+
+    Returns:
+        bytes: The image in bytes format.
+    """
+    content: bytes = fetch_file_content(access_token=access_token, content_url=content_url)
+
+    return render_on_content_cached(render_electrophysiology_image, content, dpi, suffix=".nwb")
+
+
+def generate_electrophysiology_series(access_token: str, content_url: str = "", max_points: int = 2000) -> bytes:
+    """Returns the sweep shown in the electrophysiology thumbnail as a compact binary series.
+
+    Args:
+        access_token (str): The authorization token.
+        content_url (str): The content URL that contains the NWB file.
+        max_points (int): The maximum number of points of the returned series.
+
+    Returns:
+        bytes: The series in the format of api.utils.series.
+    """
+    content: bytes = fetch_file_content(access_token=access_token, content_url=content_url)
+
+    data, unit, rate = read_electrophysiology_trace(io.BytesIO(content))
+    data, yunit = to_display_unit(data, unit)
+    timestamps = 1000 * np.linspace(0, data.shape[0] / rate, data.shape[0])
+
+    timestamps, data = minmax_decimate(timestamps, data, max_points)
+
+    return encode_series([Series("trace", timestamps, data, x_unit="ms", y_unit=yunit, rate=rate)])
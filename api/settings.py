@@ -2,10 +2,12 @@
 Module to setup the environment variables of the application
 """
 
+from typing import Optional
 import matplotlib
 from dotenv import load_dotenv
+from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from api.models.enums import Environment
+from api.models.enums import Environment, Lane, SimulationPlotEngine
 
 matplotlib.use("agg")
 
@@ -13,6 +15,23 @@ matplotlib.use("agg")
 load_dotenv()
 
 
+class QueueSettings(BaseModel):
+    """
+    Admission control settings of a lane, e.g. MORPHOLOGY_QUEUE__MAX_DEPTH=64
+    """
+
+    # Requests processed at the same time
+    concurrency: int
+    # Requests waiting for their turn, above which requests are rejected with a 429
+    max_depth: int
+    # Seconds a request waits for its turn, above which it is rejected with a 503
+    max_wait: float
+    # Scheduling priority, as a niceness (0 is the highest priority, 19 the lowest): the renders of
+    # the lanes with the lowest value get the free render workers first, and the subprocesses of
+    # the lane run with this niceness
+    priority: int = Field(default=0, ge=0, le=19)
+
+
 class Settings(BaseSettings):
     """
     Defines basic global settings that can be used throughout the application.
@@ -20,7 +39,7 @@ class Settings(BaseSettings):
     Variables are retrieved from environment variables but also calculated based on environment variables
     """
 
-    model_config = SettingsConfigDict(env_file=".env")
+    model_config = SettingsConfigDict(env_file=".env", env_nested_delimiter="__")
 
     whitelisted_cors_urls: str = "http://localhost:3000"
     base_path: str = ""
@@ -28,6 +47,63 @@ class Settings(BaseSettings):
     sentry_dsn: str = ""
     sentry_traces_sample_rate: float = 0.2
     sentry_profiles_sample_rate: float = 0.05
+    simulation_plot_engine: SimulationPlotEngine = SimulationPlotEngine.PLOTLY
+    # Maximum number of points per series and per pixel of width of the simulation plots
+    simulation_points_per_pixel: int = 4
+    # Kaleido renderers (Chromium processes) per worker started with the application, 0 to start them lazily
+    kaleido_pool_size: int = 1
+    kaleido_acquire_timeout: float = 30.0
+    kaleido_max_renders: int = 500
+    # Worker processes per API worker for the render stage, 0 to render in the request thread
+    render_workers: int = 0
+    render_worker_max_tasks: int = 200
+    render_worker_max_rss_mb: int = 1024
+    render_spool_directory: Optional[str] = None
+    # Connections to a Nexus host kept alive per API worker
+    nexus_pool_size: int = 32
+    # Seconds after which the work of a request is cancelled and answered with a 504
+    request_timeout: float = 60.0
+    batch_request_timeout: float = 120.0
+    # Thumbnails of a batch request generated at the same time
+    batch_concurrency: int = 8
+    soma_request_timeout: float = 240.0
+    # Size above which an uploaded SWC file is rejected with a 413
+    soma_upload_max_bytes: int = 20 * 1024 * 1024
+    # Resident Blender processes per API worker for the soma reconstructions, 0 to start one per reconstruction
+    blender_workers: int = 0
+    blender_worker_max_jobs: int = 20
+    blender_worker_startup_timeout: float = 120.0
+    # Seconds between two deletions of the expired jobs, evictions of the mesh cache and of the abandoned
+    # working directories, and age after which a working directory is abandoned
+    storage_gc_interval: float = 60.0
+    soma_work_max_age: float = 3600.0
+    # Cache of the soma meshes shared by the API workers (default: output/mesh_cache)
+    mesh_cache_directory: Optional[str] = None
+    mesh_cache_max_mb: int = 2048
+    # Cache of the rendered thumbnails shared by the API workers (default: output/render_cache), 0 MB to disable it
+    render_cache_directory: Optional[str] = None
+    render_cache_max_mb: int = 512
+    # Projected morphologies of the tile pyramids, on disk (in the render cache directory) and in memory, and
+    # seconds the access of a token to a morphology is remembered instead of downloading it for every tile
+    tile_geometry_cache_max_mb: int = 512
+    tile_geometry_memory_entries: int = 8
+    tile_access_ttl: float = 300.0
+    # Soma reconstruction jobs, stored in a SQLite database shared by the API workers (default: output/jobs)
+    soma_job_directory: Optional[str] = None
+    # Job workers per API worker, 0 to only run the jobs in other processes
+    soma_job_workers: int = 1
+    soma_job_timeout: float = 900.0
+    # Seconds a finished job and its mesh are kept
+    soma_job_ttl: float = 86400.0
+    # Pending jobs above which new jobs are rejected with a 429
+    soma_job_max_pending: int = 64
+    # Claims of a job (e.g. after its worker died or its lease expired) after which it fails
+    soma_job_max_attempts: int = 3
+    morphology_queue: QueueSettings = QueueSettings(concurrency=4, max_depth=32, max_wait=30.0)
+    trace_queue: QueueSettings = QueueSettings(concurrency=4, max_depth=32, max_wait=30.0)
+    simulation_queue: QueueSettings = QueueSettings(concurrency=2, max_depth=16, max_wait=30.0, priority=5)
+    # A Blender run takes a CPU core for up to minutes, they should not starve the thumbnails
+    soma_queue: QueueSettings = QueueSettings(concurrency=1, max_depth=4, max_wait=120.0, priority=10)
 
     @property
     def debug_mode(self) -> bool:
@@ -36,5 +112,11 @@ class Settings(BaseSettings):
         """
         return self.environment in (Environment.LOCAL, Environment.DEVELOPMENT)
 
+    def queue_settings(self, lane: Lane) -> QueueSettings:
+        """
+        Returns the admission control settings of a lane
+        """
+        return getattr(self, f"{lane.value}_queue")
+
 
 settings = Settings()
@@ -0,0 +1,170 @@
+"""
+Module: cancellation.py
+
+This module gives every request a deadline and cancels its work when the client disconnects.
+
+The request handlers run the blocking work (downloads, renders, NMV runs) in threads, which cannot
+be interrupted from the outside. Instead, the work of a request shares a cancellation token that is
+cancelled when the client disconnects, and expires at the deadline of the request; the blocking
+code checks it between its steps (downloaded chunks, waits for a worker or a renderer, polls of a
+subprocess) and stops there, releasing its capacity for the requests whose client is still waiting.
+"""
+
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Iterator, Optional
+
+import anyio
+from starlette.requests import Request
+
+from api.exceptions import DeadlineExceededException, RequestCancelledException
+from api.utils.logger import logger
+
+# Seconds between two checks of the cancellation token by a blocking wait
+CANCELLATION_POLL_INTERVAL = 0.25
+# Seconds between two checks of the connection of the client
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+class CancellationToken:
+    """
+    Cancellation state of the work of a request, shared with the threads doing it
+    """
+
+    def __init__(self, timeout: Optional[float] = None) -> None:
+        """
+        Parameters:
+            - timeout (float | None): The number of seconds after which the token expires, None for never.
+        """
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self._disconnected = threading.Event()
+
+    def cancel(self) -> None:
+        """
+        Cancels the work, because the client disconnected
+        """
+        self._disconnected.set()
+
+    @property
+    def disconnected(self) -> bool:
+        """
+        Whether the client disconnected
+        """
+        return self._disconnected.is_set()
+
+    @property
+    def expired(self) -> bool:
+        """
+        Whether the deadline of the request passed
+        """
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @property
+    def cancelled(self) -> bool:
+        """
+        Whether the work should stop
+        """
+        return self.disconnected or self.expired
+
+    def remaining(self, default: Optional[float] = None) -> Optional[float]:
+        """
+        Returns the number of seconds left until the deadline, bounded by default (if given)
+        """
+        if self.deadline is None:
+            return default
+        remaining = max(self.deadline - time.monotonic(), 0.0)
+        return remaining if default is None else min(remaining, default)
+
+    def raise_if_cancelled(self) -> None:
+        """
+        Raises:
+            RequestCancelledException: If the client disconnected.
+            DeadlineExceededException: If the deadline of the request passed.
+        """
+        if self.disconnected:
+            raise RequestCancelledException
+        if self.expired:
+            raise DeadlineExceededException
+
+
+_current_token: ContextVar[Optional[CancellationToken]] = ContextVar("cancellation_token", default=None)
+
+
+def current_cancellation() -> CancellationToken:
+    """
+    Returns the cancellation token of the current request, or a token that is never cancelled
+    outside of a request (e.g. in tests or scripts).
+    """
+    token = _current_token.get()
+    return CancellationToken() if token is None else token
+
+
+@contextmanager
+def cancellation_scope(token: CancellationToken) -> Iterator[CancellationToken]:
+    """
+    Makes token the cancellation token of the enclosed code
+    """
+    reset_token = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset_token)
+
+
+@asynccontextmanager
+async def cancel_after(timeout: float) -> AsyncIterator[CancellationToken]:
+    """
+    Makes a cancellation token current for the enclosed code and cancels it after timeout seconds,
+    without watching the client. Used while the body of the request is read, before entering
+    cancel_on_disconnect() with the remaining time of the token.
+
+    Raises:
+        DeadlineExceededException: If the deadline passed.
+    """
+    token = CancellationToken(timeout)
+    with cancellation_scope(token), anyio.CancelScope(deadline=anyio.current_time() + timeout) as scope:
+        yield token
+
+    if scope.cancelled_caught:
+        raise DeadlineExceededException
+
+
+async def _watch_disconnect(request: Request, token: CancellationToken, scope: anyio.CancelScope) -> None:
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+    logger.info("Client disconnected, cancelling %s", request.url.path)
+    token.cancel()
+    scope.cancel()
+
+
+@asynccontextmanager
+async def cancel_on_disconnect(request: Request, timeout: Optional[float]) -> AsyncIterator[CancellationToken]:
+    """
+    Makes a cancellation token current for the enclosed code and cancels it when the client
+    disconnects or after timeout seconds. The token is also seen by the threads started with
+    run_in_threadpool().
+
+    Asynchronous waits (e.g. for an admission slot) are interrupted right away. Threads stop at their
+    next check of the token, and are waited for, so that capacity is only released once it is free.
+    Must be entered after the body of the request has been read.
+
+    Raises:
+        RequestCancelledException: If the client disconnected.
+        DeadlineExceededException: If the deadline of the request passed.
+    """
+    token = CancellationToken(timeout)
+    with cancellation_scope(token), anyio.CancelScope() as scope:
+        if timeout is not None:
+            scope.deadline = anyio.current_time() + timeout
+        watcher = asyncio.create_task(_watch_disconnect(request, token, scope))
+        try:
+            yield token
+        finally:
+            watcher.cancel()
+
+    if scope.cancelled_caught:
+        token.raise_if_cancelled()
+        raise DeadlineExceededException
@@ -0,0 +1,46 @@
+"""
+decimation utils module exposes helpers to reduce the number of points of a series while keeping its shape
+"""
+
+from typing import Any, Tuple
+import numpy as np
+from numpy.typing import NDArray
+
+
+def minmax_decimate(x: NDArray[Any], y: NDArray[Any], max_points: int) -> Tuple[NDArray[Any], NDArray[Any]]:
+    """
+    Reduces a series to at most max_points by keeping the minimum and maximum of evenly sized buckets.
+
+    Unlike plain striding, peaks (e.g. action potentials) always survive the decimation. The first and
+    the last points are always kept so that the range of the series does not change.
+
+    Args:
+        x: the x values of the series
+        y: the y values of the series, same length as x
+        max_points: the maximum number of points of the result
+    Returns:
+        The decimated x and y values
+    """
+    n = len(y)
+    if n <= max_points or max_points < 4:
+        return x, y
+
+    n_buckets = (max_points - 2) // 2
+    size = -(-n // n_buckets)
+    n_buckets = -(-n // size)
+
+    # Pad with the last value so that every bucket has the same size; argmin/argmax return the first
+    # occurrence, so a padded index is never selected over the real last point
+    buckets = np.pad(y, (0, n_buckets * size - n), mode="edge").reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+    indices = np.concatenate(
+        (
+            [0],
+            np.sort(np.stack((buckets.argmin(axis=1), buckets.argmax(axis=1)), axis=1), axis=1).ravel()
+            + np.repeat(offsets, 2),
+            [n - 1],
+        )
+    )
+    indices = np.unique(indices)
+
+    return x[indices], y[indices]
@@ -0,0 +1,93 @@
+"""
+Module: glb.py
+
+This module encodes triangle meshes as binary glTF 2.0 (GLB) files, without any dependency.
+
+A GLB file is a 12 bytes header followed by a JSON chunk describing the scene and a binary chunk
+holding the vertex and index arrays. Both chunks are padded to 4 bytes.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+GLB_MAGIC = b"glTF"
+GLB_VERSION = 2
+JSON_CHUNK_TYPE = b"JSON"
+BIN_CHUNK_TYPE = b"BIN\0"
+
+# glTF constants
+FLOAT = 5126
+UNSIGNED_SHORT = 5123
+UNSIGNED_INT = 5125
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+
+def _pad(data: bytes, padding: bytes) -> bytes:
+    return data + padding * (-len(data) % 4)
+
+
+def encode_glb(positions: np.ndarray, normals: np.ndarray, triangles: np.ndarray) -> bytes:
+    """
+    Encodes a triangle mesh as a GLB file with a single node
+
+    Parameters:
+        - positions (np.ndarray): The (N, 3) coordinates of the vertices.
+        - normals (np.ndarray): The (N, 3) unit normals of the vertices.
+        - triangles (np.ndarray): The (M, 3) vertex indices of the triangles, counter-clockwise seen from outside.
+    Returns:
+        The GLB file in bytes format
+    """
+    positions = np.ascontiguousarray(positions, dtype="<f4")
+    normals = np.ascontiguousarray(normals, dtype="<f4")
+    # 16 bits indices when they fit, as most meshes of a soma do
+    index_dtype, index_type = ("<u2", UNSIGNED_SHORT) if len(positions) <= 0xFFFF else ("<u4", UNSIGNED_INT)
+    indices = np.ascontiguousarray(triangles, dtype=index_dtype)
+
+    views = [
+        (positions.tobytes(), ARRAY_BUFFER),
+        (normals.tobytes(), ARRAY_BUFFER),
+        (indices.tobytes(), ELEMENT_ARRAY_BUFFER),
+    ]
+    buffer_views = []
+    binary = b""
+    for data, target in views:
+        buffer_views.append({"buffer": 0, "byteOffset": len(binary), "byteLength": len(data), "target": target})
+        binary = _pad(binary + data, b"\0")
+
+    document = {
+        "asset": {"version": "2.0", "generator": "thumbnail-generation-api"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0, "NORMAL": 1}, "indices": 2}]}],
+        "accessors": [
+            {
+                "bufferView": 0,
+                "componentType": FLOAT,
+                "count": len(positions),
+                "type": "VEC3",
+                # Required for the positions
+                "min": positions.min(axis=0).tolist(),
+                "max": positions.max(axis=0).tolist(),
+            },
+            {"bufferView": 1, "componentType": FLOAT, "count": len(normals), "type": "VEC3"},
+            {"bufferView": 2, "componentType": index_type, "count": indices.size, "type": "SCALAR"},
+        ],
+        "bufferViews": buffer_views,
+        "buffers": [{"byteLength": len(binary)}],
+    }
+    json_chunk = _pad(json.dumps(document, separators=(",", ":")).encode(), b" ")
+
+    length = 12 + 8 + len(json_chunk) + 8 + len(binary)
+    return b"".join(
+        [
+            struct.pack("<4sII", GLB_MAGIC, GLB_VERSION, length),
+            struct.pack("<I4s", len(json_chunk), JSON_CHUNK_TYPE),
+            json_chunk,
+            struct.pack("<I4s", len(binary), BIN_CHUNK_TYPE),
+            binary,
+        ]
+    )
@@ -0,0 +1,94 @@
+"""
+series utils module exposes the compact binary format used to send plot data to the clients
+
+The payload is laid out as follows (all numbers are little-endian):
+    - 4 bytes: the magic string b"TGS1"
+    - 4 bytes: uint32 length of the JSON header, padded with spaces to a multiple of 4
+    - the UTF-8 JSON header: {"dtype": "<f4", "series": [{"name", "length", "x_unit", "y_unit", "rate"}, ...]}
+    - for every series, `length` float32 x values followed by `length` float32 y values
+
+Every array starts at an offset that is a multiple of 4, so clients can map them directly
+(e.g. with a JavaScript Float32Array) without copying.
+"""
+
+import json
+import struct
+from typing import Any, List, NamedTuple, Optional
+import numpy as np
+from numpy.typing import NDArray
+
+SERIES_MAGIC = b"TGS1"
+SERIES_MEDIA_TYPE = "application/octet-stream"
+SERIES_DTYPE = np.dtype("<f4")
+
+
+class Series(NamedTuple):
+    """
+    A single plotted series and the metadata needed to draw it
+    """
+
+    name: str
+    x: NDArray[Any]
+    y: NDArray[Any]
+    x_unit: Optional[str] = None
+    y_unit: Optional[str] = None
+    rate: Optional[float] = None
+
+
+def encode_series(series: List[Series]) -> bytes:
+    """
+    Encodes a list of series into the compact binary format described in the module docstring.
+
+    Args:
+        series: the series to encode
+    Returns:
+        The payload in bytes
+    """
+    header = json.dumps(
+        {
+            "dtype": SERIES_DTYPE.str,
+            "series": [
+                {"name": s.name, "length": len(s.y), "x_unit": s.x_unit, "y_unit": s.y_unit, "rate": s.rate}
+                for s in series
+            ],
+        },
+        separators=(",", ":"),
+    ).encode("utf-8")
+    header += b" " * (-len(header) % 4)
+
+    chunks = [SERIES_MAGIC, struct.pack("<I", len(header)), header]
+    for s in series:
+        chunks.append(np.ascontiguousarray(s.x, dtype=SERIES_DTYPE).tobytes())
+        chunks.append(np.ascontiguousarray(s.y, dtype=SERIES_DTYPE).tobytes())
+
+    return b"".join(chunks)
+
+
+def decode_series(payload: bytes) -> List[Series]:
+    """
+    Decodes a payload generated by encode_series(). Mostly useful for Python clients and tests.
+
+    Args:
+        payload: the payload in bytes
+    Returns:
+        The decoded series
+    Raises:
+        ValueError: if the payload is not in the expected format
+    """
+    if payload[:4] != SERIES_MAGIC:
+        raise ValueError("Payload is not a series payload")
+
+    (header_length,) = struct.unpack_from("<I", payload, 4)
+    offset = 8 + header_length
+    header = json.loads(payload[8:offset])
+    dtype = np.dtype(header["dtype"])
+
+    series = []
+    for meta in header["series"]:
+        x = np.frombuffer(payload, dtype=dtype, count=meta["length"], offset=offset)
+        offset += x.nbytes
+        y = np.frombuffer(payload, dtype=dtype, count=meta["length"], offset=offset)
+        offset += y.nbytes
+        series.append(Series(meta["name"], x, y, meta["x_unit"], meta["y_unit"], meta["rate"]))
+
+    return series
@@ -0,0 +1,155 @@
+"""
+Module: upload.py
+
+This module streams a file uploaded in a multipart/form-data body to the disk.
+
+FastAPI parses a multipart body completely before calling the handler, spooling its files in memory
+first. Instead, the body is read chunk by chunk from the request stream, and the data of the file
+field is written to its destination as it arrives, hashed on the way, so that a large upload is
+never held in memory and an oversized one is rejected as soon as it exceeds the limit.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Any, BinaryIO, Dict
+
+from starlette.requests import Request
+
+from api.exceptions import InvalidUploadException, PayloadTooLargeException
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# Bytes of a multipart body besides the file: boundaries and headers of the parts
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+class MultipartFileWriter:
+    """
+    Writes the file of a field of a multipart body to a file object, fed with the chunks of the body
+    """
+
+    def __init__(self, content_type: str, field_name: str, destination: BinaryIO, max_bytes: int) -> None:
+        """
+        Parameters:
+            - content_type (str): The Content-Type header of the request, with the boundary of the parts.
+            - field_name (str): The name of the field of the file.
+            - destination (BinaryIO): The file object the file is written to.
+            - max_bytes (int): The size above which the file is rejected.
+        Raises:
+            InvalidUploadException: If the body is not multipart/form-data (422).
+        """
+        media_type, options = parse_options_header(content_type)
+        if media_type != b"multipart/form-data" or b"boundary" not in options:
+            raise InvalidUploadException("The body must be multipart/form-data")
+
+        self.field_name = field_name
+        self.destination = destination
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.found = False
+        self._disposition = b""
+        self._header_field = b""
+        self._header_value = b""
+        self._in_file = False
+        callbacks: Dict[str, Any] = {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        }
+        self._parser = MultipartParser(options[b"boundary"], callbacks)
+
+    def write(self, chunk: bytes) -> None:
+        """
+        Parses a chunk of the body
+
+        Raises:
+            PayloadTooLargeException: If the file exceeds the size limit (413).
+            InvalidUploadException: If the body is malformed (422).
+        """
+        try:
+            self._parser.write(chunk)
+        except ValueError as exc:
+            raise InvalidUploadException("The multipart body is malformed") from exc
+
+    def finalize(self) -> None:
+        """
+        Ends the parsing once the body was read
+
+        Raises:
+            InvalidUploadException: If the body has no file in the field (422).
+        """
+        self._parser.finalize()
+        if not self.found:
+            raise InvalidUploadException(f"The body has no '{self.field_name}' file")
+
+    def _on_part_begin(self) -> None:
+        self._disposition = b""
+
+    # A header can be split across chunks, and is given in several pieces
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        self._in_file = options.get(b"name") == self.field_name.encode() and b"filename" in options
+        if self._in_file:
+            self.found = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if not self._in_file:
+            return
+        self.size += end - start
+        if self.size > self.max_bytes:
+            raise PayloadTooLargeException(self.max_bytes)
+        self.destination.write(data[start:end])
+        self.digest.update(data[start:end])
+
+    def _on_part_end(self) -> None:
+        self._in_file = False
+
+
+async def receive_multipart_file(request: Request, field_name: str, path: Path, max_bytes: int) -> "hashlib._Hash":
+    """
+    Streams the file of a field of the multipart body of a request to a path
+
+    Parameters:
+        - request (Request): The request, whose body was not read yet.
+        - field_name (str): The name of the field of the file.
+        - path (Path): The path the file is written to.
+        - max_bytes (int): The size above which the file is rejected.
+    Returns:
+        The SHA-256 hash of the file
+    Raises:
+        PayloadTooLargeException: If the body or the file exceeds the size limit (413).
+        InvalidUploadException: If the body is not a multipart body with a file in the field (422).
+    """
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit():
+        # Rejected before reading the body
+        if int(content_length) > max_bytes + MULTIPART_OVERHEAD:
+            raise PayloadTooLargeException(max_bytes)
+
+    with path.open("wb") as file:
+        writer = MultipartFileWriter(request.headers.get("content-type", ""), field_name, file, max_bytes)
+        # Small synchronous writes: the chunks of the body are at most 64 KiB
+        async for chunk in request.stream():
+            writer.write(chunk)
+        writer.finalize()
+    return writer.digest
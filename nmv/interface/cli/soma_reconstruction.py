@@ -1,5 +1,6 @@
 """NeuroMorphoVis soma reconstruction module."""
 
+import json
 import os
 import sys
 
@@ -15,6 +16,12 @@ import nmv.rendering
 import nmv.scene
 from api.utils.logger import logger
 
+# Environment variable giving the quality preset of the reconstruction, since the NMV launcher only forwards
+# the arguments it knows to Blender
+SOMA_QUALITY_VARIABLE = "NMV_SOMA_QUALITY"
+# Environment variable giving the export options of the .glb mesh, as a JSON object
+SOMA_EXPORT_VARIABLE = "NMV_SOMA_EXPORT"
+
 # Append the internal modules into the system paths to avoid Blender importing conflicts
 import_paths = ["neuromorphovis"]
 for import_path in import_paths:
@@ -35,6 +42,28 @@ def render_soma_two_dimensional_profile(morphology_object, options):
     nmv.scene.ops.clear_scene()
 
 
+def add_triangle_budget_modifier(mesh_object, max_triangles):
+    """Adds a decimate modifier reducing a mesh to a number of triangles, applied by the exporter.
+
+    :param mesh_object:
+        The mesh object.
+    :param max_triangles:
+        The maximum number of triangles of the exported mesh.
+    :return
+        The modifier, or None if the mesh is already within the budget.
+    """
+
+    # Number of triangles once the polygons are triangulated
+    triangles = sum(len(polygon.vertices) - 2 for polygon in mesh_object.data.polygons)
+    if triangles <= max_triangles:
+        return None
+
+    modifier = mesh_object.modifiers.new(name="TriangleBudget", type="DECIMATE")
+    modifier.decimate_type = "COLLAPSE"
+    modifier.ratio = max_triangles / triangles
+    return modifier
+
+
 def reconstruct_soma_three_dimensional_profile_mesh(cli_morphology, cli_options):
     """Reconstructs a three-dimensional profile of the soma and renders it.
 
@@ -52,8 +81,14 @@ def reconstruct_soma_three_dimensional_profile_mesh(cli_morphology, cli_options)
     # Create a soma builder object
     soma_builder = nmv.builders.SomaSoftBodyBuilder(cli_morphology, cli_options)
 
-    # Reconstruct the three-dimensional profile of the soma mesh
-    soma_mesh = soma_builder.reconstruct_soma_mesh()
+    # Reconstruct the three-dimensional profile of the soma mesh, simulating the frames of the quality preset.
+    # The default is restored for the next soma of a resident Blender.
+    default_max_frame = nmv.consts.Simulation.MAX_FRAME
+    nmv.consts.Simulation.MAX_FRAME = cli_options.soma.simulation_frames
+    try:
+        soma_mesh = soma_builder.reconstruct_soma_mesh()
+    finally:
+        nmv.consts.Simulation.MAX_FRAME = default_max_frame
 
     # Soma mesh file prefix
     soma_mesh_file_name = "SOMA_MESH_%s" % cli_options.morphology.label
@@ -71,21 +106,33 @@ def reconstruct_soma_three_dimensional_profile_mesh(cli_morphology, cli_options)
 
     print("Exporting .glb to", output_file_path)
 
-    bpy.ops.export_scene.gltf(
-        filepath=output_file_path,
-        check_existing=False,
-        export_format="GLB",
-        export_image_format="NONE",
-        export_texcoords=False,
-        export_normals=False,
-        export_draco_mesh_compression_level=6,
-        export_materials="NONE",
-        export_attributes=False,
-        use_selection=True,
-        export_yup=False,
-        export_animations=False,
-        export_lights=False,
-    )
+    # The decimation only applies to the exported copy, the renders below use the full resolution mesh
+    decimate_modifier = None
+    if cli_options.soma.max_triangles is not None:
+        decimate_modifier = add_triangle_budget_modifier(soma_mesh, cli_options.soma.max_triangles)
+
+    try:
+        bpy.ops.export_scene.gltf(
+            filepath=output_file_path,
+            check_existing=False,
+            export_format="GLB",
+            export_image_format="NONE",
+            export_texcoords=False,
+            export_normals=False,
+            export_apply=decimate_modifier is not None,
+            export_draco_mesh_compression_enable=cli_options.soma.draco_compression,
+            export_draco_mesh_compression_level=cli_options.soma.draco_compression_level,
+            export_draco_position_quantization=cli_options.soma.draco_position_quantization,
+            export_materials="NONE",
+            export_attributes=False,
+            use_selection=True,
+            export_yup=False,
+            export_animations=False,
+            export_lights=False,
+        )
+    finally:
+        if decimate_modifier is not None:
+            soma_mesh.modifiers.remove(decimate_modifier)
 
     # Render a static frame of the reconstructed soma mesh
     if cli_options.rendering.render_soma_static_frame:
@@ -166,30 +213,16 @@ def reconstruct_soma_three_dimensional_profile_mesh(cli_morphology, cli_options)
         nmv.scene.ops.clear_scene()
 
 
-# Run the main function if invoked from the command line.
-if __name__ == "__main__":
-    # Ignore blender extra arguments required to launch blender given to the command line interface
-    args = sys.argv
-    sys.argv = args[args.index("--") + 1 :]
-
-    # Parse the command line arguments, filter them and report the errors
-    arguments = nmv.interface.cli.parse_command_line_arguments()
-
-    # Verify the output directory before screwing things !
-    if not nmv.file.ops.path_exists(arguments.output_directory):
-        logger.error("Please set the output directory to a valid path")
-        exit(0)
-    else:
-        print("Output: [%s]" % arguments.output_directory)
-
-    # Get the options from the arguments
-    cli_options = nmv.options.NeuroMorphoVisOptions()
-
-    # Convert the CLI arguments to system options
-    cli_options.consume_arguments(arguments=arguments)
+def load_cli_morphology(arguments, cli_options):
+    """Loads the morphology given in the command line arguments.
 
-    # Read the morphology
-    cli_morphology = None
+    :param arguments:
+        Input command line arguments.
+    :param cli_options:
+        System options parsed from the command line interface (CLI).
+    :return
+        The morphology, or None if it cannot be loaded.
+    """
 
     # If the input is a GID, then open the circuit and read it
     if arguments.input == "gid":
@@ -205,10 +238,11 @@ if __name__ == "__main__":
                 cli_options.morphology.blue_config,
                 cli_options.morphology.gid,
             )
-            exit(0)
+            return None
+        return cli_morphology
 
     # If the input is a morphology file, then use the parser to load it directly
-    elif arguments.input == "file":
+    if arguments.input == "file":
         # Read the morphology file
         cli_morphology = nmv.file.read_morphology_from_file(options=cli_options)
 
@@ -217,12 +251,60 @@ if __name__ == "__main__":
                 "Cannot load the morphology file [%s]",
                 cli_options.morphology.morphology_file_path,
             )
-            exit(0)
+        return cli_morphology
 
-    else:
-        logger.error("Invalid input option")
-        exit(0)
+    logger.error("Invalid input option")
+    return None
+
+
+def reconstruct_soma(arguments, quality=None, export=None):
+    """Reconstructs the soma mesh of the morphology given in the command line arguments.
+
+    :param arguments:
+        Input command line arguments.
+    :param quality:
+        The quality preset of the reconstruction, by default the one of the environment or "standard".
+    :param export:
+        The export options of the .glb mesh, by default the ones of the environment or none.
+    :return
+        True if the soma mesh was reconstructed, False if the arguments are invalid.
+    """
+
+    # Verify the output directory before screwing things !
+    if not nmv.file.ops.path_exists(arguments.output_directory):
+        logger.error("Please set the output directory to a valid path")
+        return False
+    print("Output: [%s]" % arguments.output_directory)
+
+    # Get the options from the arguments
+    cli_options = nmv.options.NeuroMorphoVisOptions()
+
+    # Convert the CLI arguments to system options
+    cli_options.consume_arguments(arguments=arguments)
+    cli_options.apply_soma_quality(quality or os.environ.get(SOMA_QUALITY_VARIABLE, "standard"))
+    if export is None:
+        export = json.loads(os.environ.get(SOMA_EXPORT_VARIABLE, "{}"))
+    cli_options.apply_soma_export(export)
+
+    # Read the morphology
+    cli_morphology = load_cli_morphology(arguments, cli_options)
+    if cli_morphology is None:
+        return False
 
     # Soma mesh reconstruction and visualization
     reconstruct_soma_three_dimensional_profile_mesh(cli_morphology=cli_morphology, cli_options=cli_options)
+    return True
+
+
+# Run the main function if invoked from the command line.
+if __name__ == "__main__":
+    # Ignore blender extra arguments required to launch blender given to the command line interface
+    args = sys.argv
+    sys.argv = args[args.index("--") + 1 :]
+
+    # Parse the command line arguments, filter them and report the errors
+    arguments = nmv.interface.cli.parse_command_line_arguments()
+
+    if not reconstruct_soma(arguments):
+        exit(0)
     logger.info("NMV Done")
@@ -0,0 +1,72 @@
+"""NeuroMorphoVis resident soma reconstruction server.
+
+Runs in a Blender started once, and reconstructs the somas of the jobs it reads on its standard
+input (one JSON object per line) one after the other, so that the startup of Blender and the imports
+of the nmv modules are paid once per worker rather than once per soma. The result of every job is
+written as one JSON line to the file descriptor given in the NMV_RESULT_FD environment variable,
+since Blender and nmv print their logs on the standard output.
+
+Job: {"id": ..., "morphology_file": ..., "output_directory": ..., "quality": ..., "export": {...}}
+Result: {"id": ..., "ok": true/false, "error": null or the traceback of the failure}
+"""
+
+import json
+import os
+import sys
+import traceback
+
+# Append the internal modules into the system paths to avoid Blender importing conflicts
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append("%s/../../.." % (os.path.dirname(os.path.realpath(__file__))))
+
+import nmv.interface  # noqa: E402
+import nmv.scene  # noqa: E402
+import soma_reconstruction  # noqa: E402
+
+
+def process_job(job, base_arguments):
+    """Reconstructs the soma of a job.
+
+    :param job:
+        The job read from the standard input.
+    :param base_arguments:
+        The command line arguments shared by all the jobs.
+    :return
+        The result of the job.
+    """
+
+    try:
+        # The nmv parser reads the arguments of the job from sys.argv
+        sys.argv = (
+            [sys.argv[0]]
+            + base_arguments
+            + [
+                "--morphology-file=%s" % job["morphology_file"],
+                "--output-directory=%s" % job["output_directory"],
+            ]
+        )
+        arguments = nmv.interface.cli.parse_command_line_arguments()
+        reconstructed = soma_reconstruction.reconstruct_soma(arguments, job.get("quality"), job.get("export"))
+        return {"id": job["id"], "ok": reconstructed, "error": None}
+    except BaseException:  # pylint: disable=broad-exception-caught
+        return {"id": job["id"], "ok": False, "error": traceback.format_exc()}
+    finally:
+        # Reset the scene for the next job
+        nmv.scene.ops.clear_scene()
+
+
+def serve():
+    """Processes the jobs until the standard input is closed."""
+
+    # Ignore blender extra arguments required to launch blender given to the command line interface
+    base_arguments = sys.argv[sys.argv.index("--") + 1 :]
+
+    with os.fdopen(int(os.environ["NMV_RESULT_FD"]), "w", buffering=1) as results:
+        results.write(json.dumps({"ready": True}) + "\n")
+        for line in sys.stdin:
+            if line.strip():
+                results.write(json.dumps(process_job(json.loads(line), base_arguments)) + "\n")
+
+
+if __name__ == "__main__":
+    serve()
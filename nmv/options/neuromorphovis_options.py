@@ -3,6 +3,15 @@
 import nmv.options
 import nmv.utilities as nmvu
 
+# Quality/speed presets of the soft body soma reconstruction. The number of simulated frames is a fraction of the
+# NeuroMorphoVis default (nmv.consts.Simulation.MAX_FRAME), and a subdivision level of None keeps the level given
+# on the command line. The Draco compression of the mesh is an export option, see apply_soma_export().
+SOMA_QUALITY_PRESETS = {
+    "preview": {"simulation_frames_scale": 0.25, "subdivision_level": 3},
+    "standard": {"simulation_frames_scale": 1.0, "subdivision_level": None},
+    "high": {"simulation_frames_scale": 1.5, "subdivision_level": 6},
+}
+
 
 class NeuroMorphoVisOptions:
     """Workflow options all combined in a single structure."""
@@ -32,6 +41,49 @@ class NeuroMorphoVisOptions:
         # Synaptic options
         self.synaptics = nmv.options.SynapticsOptions()
 
+    # @apply_soma_quality
+
+    def apply_soma_quality(self, quality):
+        """Applies a quality/speed preset to the soft body soma reconstruction.
+
+        :param quality:
+            The name of the preset, a key of SOMA_QUALITY_PRESETS.
+        """
+
+        # Internal imports
+        import nmv.consts
+
+        preset = SOMA_QUALITY_PRESETS[quality]
+
+        # Number of frames of the soft body simulation
+        self.soma.simulation_frames = max(
+            int(nmv.consts.Simulation.MAX_FRAME * preset["simulation_frames_scale"]),
+            nmv.consts.Simulation.MIN_FRAME + 1,
+        )
+
+        # Subdivision level of the sphere
+        if preset["subdivision_level"] is not None:
+            self.soma.subdivision_level = preset["subdivision_level"]
+
+    # @apply_soma_export
+
+    def apply_soma_export(self, export):
+        """Applies the size and level of detail options of the .glb export of the soma mesh.
+
+        :param export:
+            A dictionary with the optional keys max_triangles (triangle budget of the mesh, reached with a decimate
+            modifier), draco_compression_level and draco_position_quantization. Draco compression is only enabled
+            if one of the Draco options is given, since the viewers need a Draco decoder for the mesh.
+        """
+
+        # Triangle budget of the exported mesh, None for the full resolution
+        self.soma.max_triangles = export.get("max_triangles")
+
+        # Draco compression
+        self.soma.draco_compression = "draco_compression_level" in export or "draco_position_quantization" in export
+        self.soma.draco_compression_level = export.get("draco_compression_level", 6)
+        self.soma.draco_position_quantization = export.get("draco_position_quantization", 14)
+
     # @consume_arguments
 
     def consume_arguments(self, arguments):
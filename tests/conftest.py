@@ -3,9 +3,22 @@ Nexus-related fixtures definition
 """
 
 import pytest
+from api.services.mesh_cache import mesh_cache
+from api.services.morpho_tiles import geometry_store
+from api.services.render_cache import render_cache
 from tests.utils import load_nwb_content
 
 
+@pytest.fixture(autouse=True)
+def cache_directories(tmp_path, monkeypatch):
+    """
+    Caches of the meshes, renders and geometries in a temporary directory instead of the output one
+    """
+    monkeypatch.setattr(mesh_cache, "directory", tmp_path / "mesh_cache")
+    monkeypatch.setattr(render_cache, "directory", tmp_path / "render_cache")
+    monkeypatch.setattr(geometry_store.cache, "directory", tmp_path / "geometry")
+
+
 @pytest.fixture
 def morphology_content_url() -> str:
     """
@@ -0,0 +1,79 @@
+"""
+Unit test module for testing the pre-rendering command
+"""
+
+import time
+from unittest.mock import patch
+import pytest
+from api.exceptions import ResourceNotFoundException
+from api.models.common import BatchItem
+from api.prerender import RateLimiter, item_key, prerender, read_access_log, read_state, read_url_list
+
+ACCESS_LOG = """\
+10.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /generate/trace-image?content_url=https%3A%2F%2Fnexus%2Ft HTTP/1.1" 200 10
+10.0.0.1 - - [19/Oct/2026:10:00:01 +0000] "GET /generate/morphology-image?content_url=https%3A%2F%2Fnexus%2Fm&dpi=72 HTTP/1.1" 200 10
+10.0.0.2 - - [19/Oct/2026:10:00:02 +0000] "GET /generate/morphology-image?dpi=72&content_url=https%3A%2F%2Fnexus%2Fm HTTP/1.1" 200 10
+10.0.0.2 - - [19/Oct/2026:10:00:03 +0000] "GET /generate/morphology-image?content_url=https%3A%2F%2Fnexus%2Fgone HTTP/1.1" 404 10
+10.0.0.2 - - [19/Oct/2026:10:00:04 +0000] "GET /soma/process-nexus-swc?content_url=https%3A%2F%2Fnexus%2Fm HTTP/1.1" 200 10
+"""
+
+
+def test_access_log_is_replayed_most_requested_first():
+    """
+    Tests whether the successful thumbnail requests of an access log are returned by popularity
+    """
+    items = read_access_log(ACCESS_LOG.splitlines())
+
+    assert [(item.type.value, item.content_url, item.dpi) for item in items] == [
+        ("morphology-image", "https://nexus/m", 72),
+        ("trace-image", "https://nexus/t", None),
+    ]
+    assert len(read_access_log(ACCESS_LOG.splitlines(), limit=1)) == 1
+
+
+def test_url_list_is_parsed_with_parameters():
+    """
+    Tests whether the lines of a URL list give the type, the content URL and the parameters of the thumbnails
+    """
+    items = read_url_list(
+        ["# gallery", "", "morphology-image https://nexus/m dpi=100", "simulation-plot https://nexus/s target=stimulus"]
+    )
+    assert items[0] == BatchItem(type="morphology-image", content_url="https://nexus/m", dpi=100)
+    assert items[1].target == "stimulus"
+
+    with pytest.raises(ValueError, match="Line 1"):
+        read_url_list(["https://nexus/m"])
+
+
+def test_interrupted_run_resumes_with_the_failed_and_missing_thumbnails(tmp_path):
+    """
+    Tests whether a run skips the thumbnails rendered by a previous run, and retries the failed ones
+    """
+    items = [BatchItem(type="morphology-image", content_url=f"https://nexus/{index}") for index in range(4)]
+    state_path = tmp_path / "state"
+
+    def generate(access_token, item):
+        if item.content_url.endswith("3"):
+            raise ResourceNotFoundException
+        return b"png"
+
+    with patch("api.prerender.generate_batch_image", side_effect=generate) as generate_batch_image:
+        progress = prerender(items[:2] + items[3:], "token", workers=0, rate=0, state_path=state_path)
+        assert (progress.rendered, progress.failed) == (2, 1)
+        assert read_state(state_path) == {item_key(item) for item in items[:2]}
+
+        progress = prerender(items, "token", workers=0, rate=0, state_path=state_path)
+    assert (progress.skipped, progress.rendered, progress.failed) == (2, 1, 1)
+    assert generate_batch_image.call_count == 5
+    assert progress.report().startswith("2/2 thumbnails (1 rendered, 1 failed, 2 already rendered)")
+
+
+def test_rate_limiter_spaces_the_calls():
+    """
+    Tests whether the calls are spaced at the rate of the limiter
+    """
+    limiter = RateLimiter(rate=50)
+    started_at = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - started_at >= 0.1
@@ -2,14 +2,27 @@
 Unit test module related to the router of /generate
 """
 
+import base64
+import io
+import json
+import time
+import zipfile
+from email.parser import BytesParser
 from http import HTTPStatus as status
 from unittest.mock import Mock, patch
 from fastapi.testclient import TestClient
 import pytest
+from PIL import Image
+from api.exceptions import ResourceNotFoundException
 from api.main import app
+from api.models.enums import Lane
+from api.services.admission import AdmissionQueue, admission_queues
+from api.settings import settings
+from api.utils.cancellation import current_cancellation
 from api.dependencies import retrieve_user
-from tests.utils import load_content, load_json_file, load_nwb_content
+from tests.utils import load_content, load_json_stream, load_nwb_content
 from api.user import User
+from api.utils.series import decode_series
 
 
 def override_retrieve_user():
@@ -52,7 +65,7 @@ class TestMorphologyThumbnailGenerationRouter:
         assert response.status_code == 200
         assert response.headers["content-type"] == "image/png"
 
-    @patch("requests.get")
+    @patch("api.services.nexus.nexus_session.get")
     def test_morphology_thumbnail_generation_returns_404_if_resource_not_exists(self, mock_get, mock_headers):
         """
         Tests whether the router returns a 404 and correct error message if resource does not exist
@@ -69,7 +82,7 @@ class TestMorphologyThumbnailGenerationRouter:
         assert response.status_code == 404
         assert response.json()["detail"] == "The resource is not found"
 
-    @patch("requests.get")
+    @patch("api.services.nexus.nexus_session.get")
     def test_morphology_thumbnail_generation_returns_422_if_content_url_is_wrong(self, mock_get, mock_headers):
         """
         Tests whether the router returns a 422 and correct error message if content url is wrong
@@ -113,7 +126,7 @@ class TestElectrophusiologyThumbnailGenerationRouter:
         assert response.status_code == 200
         assert response.headers["content-type"] == "image/png"
 
-    @patch("requests.get")
+    @patch("api.services.nexus.nexus_session.get")
     def test_electrophysiology_thumbnail_generation_returns_404_if_resource_not_exists(self, mock_get, mock_headers):
         """
         Tests whether the router returns a 404 and correct error message if resource does not exist
@@ -130,7 +143,7 @@ class TestElectrophusiologyThumbnailGenerationRouter:
         assert response.status_code == 404
         assert response.json()["detail"] == "The resource is not found"
 
-    @patch("requests.get")
+    @patch("api.services.nexus.nexus_session.get")
     def test_electrophysiology_thumbnail_generation_returns_422_if_content_url_is_wrong(self, mock_get, mock_headers):
         """
         Tests whether the router returns a 422 and correct error message if content url is wrong
@@ -147,6 +160,26 @@ class TestElectrophusiologyThumbnailGenerationRouter:
         assert response.status_code == 422
         assert response.json()["detail"] == "Invalid content_url parameter in request"
 
+    @patch(
+        "api.services.trace_img.fetch_file_content",
+        return_value=load_nwb_content("./tests/fixtures/data/correct_trace.nwb"),
+    )
+    def test_electrophysiology_data_returns_200_and_decimated_series(self, fetch_file_content, mock_headers):
+        """
+        Tests whether the router returns a 200 and the decimated series if the request is correct
+        """
+        response = self.client.get(
+            "/generate/trace-data",
+            headers=mock_headers,
+            params={"content_url": "http://example.com/image", "max_points": 100},
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/octet-stream"
+        series = decode_series(response.content)
+        assert len(series) == 1
+        assert len(series[0].y) <= 100
+        assert series[0].x_unit == "ms"
+
 
 class TestSingleNeuronSimulationThumbnailGenerationRouter:
     """
@@ -159,8 +192,8 @@ class TestSingleNeuronSimulationThumbnailGenerationRouter:
         app.dependency_overrides[retrieve_user] = override_retrieve_user
 
     @patch(
-        "api.services.simulation_img.fetch_file_content",
-        return_value=load_json_file("./tests/fixtures/data/simulation_config.json"),
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
     )
     def test_not_correct_target(self, fetch_file_content, mock_headers):
         """
@@ -175,8 +208,8 @@ class TestSingleNeuronSimulationThumbnailGenerationRouter:
         assert response.headers["content-type"] == "application/json"
 
     @patch(
-        "api.services.simulation_img.fetch_file_content",
-        return_value=load_json_file("./tests/fixtures/data/simulation_config.json"),
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
     )
     def test_stimulus(self, fetch_file_content, mock_headers):
         """
@@ -191,8 +224,8 @@ class TestSingleNeuronSimulationThumbnailGenerationRouter:
         assert response.headers["content-type"] == "image/png"
 
     @patch(
-        "api.services.simulation_img.fetch_file_content",
-        return_value=load_json_file("./tests/fixtures/data/simulation_config.json"),
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
     )
     def test_simulation(self, fetch_file_content, mock_headers):
         """
@@ -206,8 +239,8 @@ class TestSingleNeuronSimulationThumbnailGenerationRouter:
         assert response.status_code == status.OK
 
     @patch(
-        "api.services.simulation_img.fetch_file_content",
-        return_value=load_json_file("./tests/fixtures/data/simulation_config.json", "stimulus"),
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json", "stimulus"),
     )
     def test_stimulus_not_in_config(self, fetch_file_content, mock_headers):
         """
@@ -222,8 +255,8 @@ class TestSingleNeuronSimulationThumbnailGenerationRouter:
         assert response.status_code == status.BAD_GATEWAY
 
     @patch(
-        "api.services.simulation_img.fetch_file_content",
-        return_value=load_json_file("./tests/fixtures/data/simulation_config.json", "simulation"),
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json", "simulation"),
     )
     def test_stimulation_not_in_config(self, fetch_file_content, mock_headers):
         """
@@ -236,3 +269,297 @@ class TestSingleNeuronSimulationThumbnailGenerationRouter:
         )
 
         assert response.status_code == status.BAD_GATEWAY
+
+    @patch(
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+    )
+    def test_simulation_data(self, fetch_file_content, mock_headers):
+        """
+        Tests whether the router returns a 200 and the stimulus series if the request is correct
+        """
+        response = self.client.get(
+            "/generate/simulation-data",
+            headers=mock_headers,
+            params={"content_url": "http://example.com/image", "target": "stimulus"},
+        )
+        assert response.status_code == status.OK
+        assert [s.name for s in decode_series(response.content)] == ["IV_40", "IV_80", "IV_120"]
+
+    @patch(
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+    )
+    def test_simulation_grid(self, fetch_file_content, mock_headers):
+        """
+        Tests whether the router returns a 200 and an image with all the panels if the request is correct
+        """
+        response = self.client.get(
+            "/generate/simulation-grid",
+            headers=mock_headers,
+            params={"content_url": "http://example.com/image"},
+        )
+        assert response.status_code == status.OK
+        assert response.headers["content-type"] == "image/png"
+        assert fetch_file_content.call_count == 1
+
+    @patch(
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+    )
+    def test_simulation_grid_without_panels(self, fetch_file_content, mock_headers):
+        """
+        Tests whether the router returns a 502 if none of the requested panels exist
+        """
+        response = self.client.get(
+            "/generate/simulation-grid",
+            headers=mock_headers,
+            params={"content_url": "http://example.com/image", "locations": "unknown", "include_stimulus": False},
+        )
+        assert response.status_code == status.BAD_GATEWAY
+
+    @patch("api.services.simulation_img.GRID_MAX_PANELS", 1)
+    @patch(
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+    )
+    def test_simulation_grid_with_too_many_panels(self, fetch_file_content, mock_headers):
+        """
+        Tests whether the router returns a 422 if the grid has more panels than the limit
+        """
+        response = self.client.get(
+            "/generate/simulation-grid",
+            headers=mock_headers,
+            params={"content_url": "http://example.com/image"},
+        )
+        assert response.status_code == status.UNPROCESSABLE_ENTITY
+
+
+class TestAdmissionControl:
+    """
+    Unit test class for testing the admission control of the generation routers
+    """
+
+    @classmethod
+    def setup_class(cls):
+        cls.client = TestClient(app)
+        app.dependency_overrides[retrieve_user] = override_retrieve_user
+
+    def test_full_queue_returns_429_with_retry_after(self, mock_headers):
+        """
+        Tests whether a request is rejected with a 429 and a Retry-After header if its lane is full
+        """
+        full_queue = AdmissionQueue(Lane.MORPHOLOGY, concurrency=0, max_depth=0, max_wait=1)
+        with patch.dict(admission_queues, {Lane.MORPHOLOGY: full_queue}):
+            response = self.client.get(
+                "/generate/morphology-image",
+                headers=mock_headers,
+                params={"content_url": "http://example.com/image"},
+            )
+        assert response.status_code == status.TOO_MANY_REQUESTS
+        assert response.headers["Retry-After"] == "1"
+
+    def test_metrics(self):
+        """
+        Tests whether the metrics of the admission queues are exported
+        """
+        response = self.client.get("/metrics")
+        assert response.status_code == status.OK
+        assert "thumbnail_queue_depth" in response.text
+
+    def test_request_over_its_deadline_returns_504(self, mock_headers):
+        """
+        Tests whether the work of a request is stopped and answered with a 504 once its deadline passed
+        """
+
+        def slow_generator(**_):
+            while True:
+                current_cancellation().raise_if_cancelled()
+                time.sleep(0.01)
+
+        with patch.object(settings, "request_timeout", 0.1), patch(
+            "api.router.generate.generate_morphology_image", side_effect=slow_generator
+        ):
+            response = self.client.get(
+                "/generate/morphology-image",
+                headers=mock_headers,
+                params={"content_url": "http://example.com/image"},
+            )
+        assert response.status_code == status.GATEWAY_TIMEOUT
+        assert admission_queues[Lane.MORPHOLOGY].active == 0
+
+
+class TestBatchThumbnailGenerationRouter:
+    """
+    Unit test class for testing the router of the batch thumbnail generation
+    """
+
+    @classmethod
+    def setup_class(cls):
+        cls.client = TestClient(app)
+        app.dependency_overrides[retrieve_user] = override_retrieve_user
+
+    @patch(
+        "api.services.simulation_img.stream_file_content",
+        side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+    )
+    @patch("api.services.trace_img.fetch_file_content", side_effect=ResourceNotFoundException)
+    @patch(
+        "api.services.morpho_img.fetch_file_content", return_value=load_content("./tests/fixtures/data/morphology.swc")
+    )
+    def test_batch_returns_archive_with_images_and_errors(
+        self, fetch_morphology, fetch_trace, stream_config, mock_headers
+    ):
+        """
+        Tests whether a batch returns the images of its items and the error of the failed ones in a ZIP archive
+        """
+        response = self.client.post(
+            "/generate/batch",
+            headers=mock_headers,
+            json={
+                "items": [
+                    {"type": "morphology-image", "content_url": "http://example.com/morphology", "dpi": 50},
+                    {"type": "trace-image", "content_url": "http://example.com/trace"},
+                    {"type": "simulation-plot", "content_url": "http://example.com/config", "target": "stimulus"},
+                ]
+            },
+        )
+        assert response.status_code == status.OK
+        assert response.headers["content-type"] == "application/zip"
+
+        archive = zipfile.ZipFile(io.BytesIO(response.content))
+        assert archive.namelist() == ["0.png", "2.png", "manifest.json"]
+        assert archive.read("0.png").startswith(b"\x89PNG")
+        manifest = json.loads(archive.read("manifest.json"))
+        assert [entry["status"] for entry in manifest] == [200, 404, 200]
+        assert manifest[1]["detail"] == "The resource is not found"
+
+    def test_batch_validates_its_items(self, mock_headers):
+        """
+        Tests whether a batch is rejected with a 422 if it is empty or an item misses a parameter
+        """
+        response = self.client.post("/generate/batch", headers=mock_headers, json={"items": []})
+        assert response.status_code == status.UNPROCESSABLE_ENTITY
+
+        response = self.client.post(
+            "/generate/batch",
+            headers=mock_headers,
+            json={"items": [{"type": "simulation-plot", "content_url": "http://example.com/config"}]},
+        )
+        assert response.status_code == status.UNPROCESSABLE_ENTITY
+
+    @patch(
+        "api.services.morpho_img.fetch_file_content", return_value=load_content("./tests/fixtures/data/morphology.swc")
+    )
+    def test_batch_streams_items_as_ndjson(self, fetch_file_content, mock_headers):
+        """
+        Tests whether a batch streams a JSON line per item with its base64 encoded image
+        """
+        items = [{"type": "morphology-image", "content_url": f"http://example.com/{index}"} for index in range(3)]
+        response = self.client.post(
+            "/generate/batch", headers=mock_headers, params={"format": "ndjson"}, json={"items": items}
+        )
+        assert response.status_code == status.OK
+        assert response.headers["content-type"] == "application/x-ndjson"
+
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert sorted(line["index"] for line in lines) == [0, 1, 2]
+        assert all(base64.b64decode(line["image"]).startswith(b"\x89PNG") for line in lines)
+
+    @patch("api.services.morpho_img.fetch_file_content", side_effect=ResourceNotFoundException)
+    def test_batch_streams_items_as_multipart(self, fetch_file_content, mock_headers):
+        """
+        Tests whether a batch streams a multipart/mixed part per item, closed by the final boundary
+        """
+        response = self.client.post(
+            "/generate/batch",
+            headers=mock_headers,
+            params={"format": "multipart"},
+            json={"items": [{"type": "morphology-image", "content_url": "http://example.com/missing"}]},
+        )
+        assert response.status_code == status.OK
+        boundary = response.headers["content-type"].split("boundary=")[1]
+        assert response.content.endswith(f"--{boundary}--\r\n".encode())
+        assert b"Content-ID: <0>\r\nX-Item-Status: 404" in response.content
+
+    @patch("api.services.trace_img.fetch_file_content", side_effect=ResourceNotFoundException)
+    @patch(
+        "api.services.morpho_img.fetch_file_content", return_value=load_content("./tests/fixtures/data/morphology.swc")
+    )
+    def test_sprite_sheet_returns_map_and_image(self, fetch_morphology, fetch_trace, mock_headers):
+        """
+        Tests whether a sprite sheet is returned as form data with the map of its cells and the image
+        """
+        items = [
+            {"type": "morphology-image", "content_url": "http://example.com/morphology"},
+            {"type": "trace-image", "content_url": "http://example.com/trace"},
+            {"type": "morphology-image", "content_url": "http://example.com/other"},
+        ]
+        response = self.client.post(
+            "/generate/sprite-sheet", headers=mock_headers, json={"items": items, "cell_width": 64, "cell_height": 48}
+        )
+        assert response.status_code == status.OK
+
+        message = BytesParser().parsebytes(
+            f"Content-Type: {response.headers['content-type']}\r\n\r\n".encode() + response.content
+        )
+        sprite_map, image = [part.get_payload(decode=True) for part in message.get_payload()]
+        sprite_map = json.loads(sprite_map)
+        assert (sprite_map["width"], sprite_map["height"], sprite_map["columns"]) == (128, 96, 2)
+        assert [cell["status"] for cell in sprite_map["cells"]] == [200, 404, 200]
+        assert Image.open(io.BytesIO(image)).size == (128, 96)
+
+    @patch("api.services.morpho_img.fetch_file_content")
+    def test_sprite_sheet_larger_than_the_limit_returns_422(self, fetch_file_content, mock_headers):
+        """
+        Tests whether a sprite sheet wider than the limit is rejected before rendering its items
+        """
+        items = [{"type": "morphology-image", "content_url": f"http://example.com/{index}"} for index in range(20)]
+        response = self.client.post(
+            "/generate/sprite-sheet",
+            headers=mock_headers,
+            json={"items": items, "cell_width": 512, "cell_height": 128, "columns": 20},
+        )
+        assert response.status_code == status.UNPROCESSABLE_ENTITY
+        assert fetch_file_content.call_count == 0
+
+    @patch(
+        "api.services.morpho_tiles.fetch_file_content",
+        return_value=load_content("./tests/fixtures/data/morphology.swc"),
+    )
+    def test_morphology_tiles_return_info_and_tiles(self, fetch_file_content, mock_headers):
+        """
+        Tests whether the pyramid of a morphology is described, and its tiles are 256 pixels images
+        """
+        params = {"content_url": "http://example.com/tiled-morphology"}
+        response = self.client.get("/generate/morphology-tiles", headers=mock_headers, params=params)
+        assert response.status_code == status.OK
+        info = response.json()
+        assert info["tile_size"] == 256
+        assert info["max_zoom"] > 0
+
+        response = self.client.get("/generate/morphology-tiles/1/0/1", headers=mock_headers, params=params)
+        assert response.status_code == status.OK
+        assert response.headers["content-type"] == "image/png"
+        assert Image.open(io.BytesIO(response.content)).size == (256, 256)
+        # The access of the token to the morphology is remembered between the requests of its tiles
+        fetch_file_content.assert_called_once()
+
+        response = self.client.get("/generate/morphology-tiles/1/2/0", headers=mock_headers, params=params)
+        assert response.status_code == status.NOT_FOUND
+        response = self.client.get(
+            f"/generate/morphology-tiles/{info['max_zoom'] + 1}/0/0", headers=mock_headers, params=params
+        )
+        assert response.status_code == status.NOT_FOUND
+
+    @patch("api.services.morpho_tiles.fetch_file_content", side_effect=ResourceNotFoundException)
+    def test_morphology_tiles_of_a_missing_resource_return_404(self, fetch_file_content, mock_headers):
+        """
+        Tests whether the tiles of a morphology which cannot be downloaded are not found
+        """
+        response = self.client.get(
+            "/generate/morphology-tiles/0/0/0",
+            headers=mock_headers,
+            params={"content_url": "http://example.com/missing-morphology"},
+        )
+        assert response.status_code == status.NOT_FOUND
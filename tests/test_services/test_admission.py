@@ -0,0 +1,129 @@
+"""
+Unit test module for testing the admission queues
+"""
+
+import asyncio
+import pytest
+from api.exceptions import QueueFullException, QueueTimeoutException
+from api.models.enums import Lane
+from starlette.concurrency import run_in_threadpool
+from api.services.admission import AdmissionQueue, current_priority, render_metrics
+
+
+def test_request_is_admitted_while_slots_are_free():
+    """
+    Tests whether a request is processed immediately if a slot is free
+    """
+    queue = AdmissionQueue(Lane.MORPHOLOGY, concurrency=1, max_depth=0, max_wait=1)
+
+    async def run():
+        async with queue.admit():
+            assert queue.active == 1
+        assert queue.active == 0
+
+    asyncio.run(run())
+    assert queue.stats.admitted_total == 1
+
+
+def test_request_is_rejected_if_queue_is_full():
+    """
+    Tests whether a request is rejected with a 429 and a Retry-After if no request can wait anymore
+    """
+    queue = AdmissionQueue(Lane.MORPHOLOGY, concurrency=1, max_depth=0, max_wait=1)
+
+    async def run():
+        async with queue.admit():
+            with pytest.raises(QueueFullException) as exc_info:
+                async with queue.admit():
+                    pass
+        return exc_info.value
+
+    exc = asyncio.run(run())
+    assert exc.status_code == 429
+    assert int(exc.headers["Retry-After"]) >= 1
+    assert queue.stats.rejected_total == 1
+
+
+def test_request_times_out_if_its_turn_does_not_come():
+    """
+    Tests whether a waiting request is rejected with a 503 after the maximum waiting time
+    """
+    queue = AdmissionQueue(Lane.TRACE, concurrency=1, max_depth=1, max_wait=0.05)
+
+    async def run():
+        async with queue.admit():
+            with pytest.raises(QueueTimeoutException):
+                async with queue.admit():
+                    pass
+
+    asyncio.run(run())
+    assert queue.stats.timed_out_total == 1
+    assert queue.depth == 0
+    assert queue.active == 0
+
+
+def test_slot_is_handed_over_in_arrival_order():
+    """
+    Tests whether the released slots are given to the waiting requests in order
+    """
+    queue = AdmissionQueue(Lane.SIMULATION, concurrency=1, max_depth=2, max_wait=1)
+    order = []
+
+    async def request(name):
+        async with queue.admit():
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(request("first"), request("second"), request("third"))
+
+    asyncio.run(run())
+    assert order == ["first", "second", "third"]
+    assert queue.active == 0
+
+
+def test_cancelled_request_leaves_the_queue():
+    """
+    Tests whether a request cancelled while waiting does not keep its place in the queue
+    """
+    queue = AdmissionQueue(Lane.SIMULATION, concurrency=1, max_depth=1, max_wait=1)
+
+    async def waiting():
+        async with queue.admit():
+            pass
+
+    async def run():
+        async with queue.admit():
+            task = asyncio.create_task(waiting())
+            await asyncio.sleep(0.01)
+            assert queue.depth == 1
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert queue.depth == 0
+
+    asyncio.run(run())
+    assert queue.active == 0
+
+
+def test_metrics_are_exported_per_lane():
+    """
+    Tests whether the metrics of every lane are exported in the Prometheus text format
+    """
+    metrics = render_metrics()
+    for lane in Lane:
+        assert f'thumbnail_queue_depth{{lane="{lane.value}"}} 0' in metrics
+
+
+def test_priority_of_lane_is_current_in_admitted_work():
+    """
+    Tests whether the priority of the lane is seen by the admitted work, including its threads
+    """
+    queue = AdmissionQueue(Lane.SOMA, concurrency=1, max_depth=0, max_wait=1, priority=10)
+
+    async def run():
+        async with queue.admit():
+            return await run_in_threadpool(current_priority)
+
+    assert asyncio.run(run()) == 10
+    assert current_priority() == 0
@@ -0,0 +1,174 @@
+"""
+Unit test module for testing the generation of the thumbnails of a batch
+"""
+
+import asyncio
+import base64
+import io
+import json
+import threading
+import time
+import zipfile
+from unittest.mock import patch
+import pytest
+import requests
+from fastapi import HTTPException
+from api.exceptions import ResourceNotFoundException
+from api.models.common import BatchItem
+from api.services.batch import (
+    BatchResult,
+    build_batch_archive,
+    encode_multipart_result,
+    encode_ndjson_result,
+    generate_batch,
+    generate_batch_image,
+    stream_batch,
+)
+from api.utils.cancellation import current_cancellation
+
+
+def morphology_item(content_url: str = "http://example.com/morphology") -> BatchItem:
+    """
+    Returns a morphology-image item of a batch
+    """
+    return BatchItem(type="morphology-image", content_url=content_url)
+
+
+def collect(items, concurrency=4):
+    """
+    Runs a batch and returns its results in completion order
+    """
+
+    async def run():
+        return [result async for result in generate_batch("token", items, concurrency)]
+
+    return asyncio.run(run())
+
+
+def test_batch_reports_the_error_of_every_failed_item():
+    """
+    Tests whether the failed items of a batch are reported with their status, without failing the others
+    """
+
+    def generate(access_token, item):
+        if item.content_url.endswith("missing"):
+            raise ResourceNotFoundException
+        if item.content_url.endswith("unreachable"):
+            raise requests.exceptions.ConnectionError
+        if item.content_url.endswith("broken"):
+            raise RuntimeError("boom")
+        return b"png"
+
+    items = [morphology_item(f"http://example.com/{name}") for name in ["a", "missing", "unreachable", "broken"]]
+    with patch("api.services.batch.generate_batch_image", side_effect=generate):
+        results = sorted(collect(items), key=lambda result: result.index)
+
+    assert [result.status for result in results] == [200, 404, 502, 500]
+    assert results[0].image == b"png"
+    assert results[1].detail == "The resource is not found"
+
+
+def test_batch_yields_in_completion_order_with_bounded_concurrency():
+    """
+    Tests whether the items are generated concurrently, at most concurrency at a time, and yielded as they finish
+    """
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def generate(access_token, item):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        # The first item is the slowest one
+        time.sleep(0.3 if item.content_url.endswith("0") else 0.05)
+        with lock:
+            running -= 1
+        return item.content_url.encode()
+
+    items = [morphology_item(f"http://example.com/{index}") for index in range(6)]
+    with patch("api.services.batch.generate_batch_image", side_effect=generate):
+        results = collect(items, concurrency=3)
+
+    assert len(results) == 6
+    assert results[-1].index == 0
+    assert peak == 3
+
+
+def test_simulation_item_without_data_is_not_found():
+    """
+    Tests whether a simulation plot without data is reported as a 404, like its endpoint does
+    """
+    item = BatchItem(type="simulation-plot", content_url="http://example.com/config", target="stimulus")
+    with patch("api.services.batch.generate_simulation_plots", return_value=None):
+        with pytest.raises(HTTPException) as exc_info:
+            generate_batch_image("token", item)
+    assert exc_info.value.status_code == 404
+
+
+def test_batch_archive_has_the_images_and_a_manifest():
+    """
+    Tests whether the archive of a batch holds the images of the items and the status of all of them
+    """
+    items = [morphology_item(), morphology_item()]
+
+    def generate(access_token, item):
+        if item is items[1]:
+            raise ResourceNotFoundException
+        return b"png"
+
+    with patch("api.services.batch.generate_batch_image", side_effect=generate):
+        archive = zipfile.ZipFile(io.BytesIO(build_batch_archive(collect(items))))
+
+    assert archive.namelist() == ["0.png", "manifest.json"]
+    assert archive.read("0.png") == b"png"
+    manifest = json.loads(archive.read("manifest.json"))
+    assert manifest[0] == {
+        "index": 0,
+        "type": "morphology-image",
+        "content_url": items[0].content_url,
+        "status": 200,
+        "file": "0.png",
+    }
+    assert manifest[1]["status"] == 404
+    assert manifest[1]["detail"] == "The resource is not found"
+
+
+def test_streamed_items_past_the_deadline_are_reported_with_a_504():
+    """
+    Tests whether a streamed batch reports the items it could not finish before its deadline
+    """
+
+    def generate(access_token, item):
+        if item.content_url.endswith("slow"):
+            while True:
+                current_cancellation().raise_if_cancelled()
+                time.sleep(0.01)
+        return b"png"
+
+    items = [morphology_item("http://example.com/fast"), morphology_item("http://example.com/slow")]
+
+    async def run():
+        return [line async for line in stream_batch("token", items, 4, 0.2, encode_ndjson_result)]
+
+    with patch("api.services.batch.generate_batch_image", side_effect=generate):
+        lines = [json.loads(line) for line in asyncio.run(run())]
+
+    assert [(line["index"], line["status"]) for line in lines] == [(0, 200), (1, 504)]
+    assert base64.b64decode(lines[0]["image"]) == b"png"
+
+
+def test_multipart_parts_are_identified_by_the_index_of_their_item():
+    """
+    Tests whether a multipart part has the index of its item as Content-ID, and the JSON error of a failed item
+    """
+    image_part = encode_multipart_result(BatchResult(3, morphology_item(), 200, image=b"png"), "boundary")
+    assert image_part == (
+        b"--boundary\r\nContent-Type: image/png\r\nContent-ID: <3>\r\nX-Item-Status: 200\r\n\r\npng\r\n"
+    )
+
+    error_part = encode_multipart_result(BatchResult(4, morphology_item(), 404, detail="Not found"), "boundary")
+    headers, body = error_part.split(b"\r\n\r\n", 1)
+    assert b"Content-Type: application/json" in headers
+    assert json.loads(body)["detail"] == "Not found"
@@ -0,0 +1,77 @@
+"""
+Unit test module for testing the disk caches, e.g. of the soma meshes
+"""
+
+import os
+from api.services.disk_cache import DiskCache, cache_key
+
+
+def write_mesh(path, size):
+    """
+    Writes a fake mesh of the given size
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"m" * size)
+    return path
+
+
+def test_key_depends_on_content_and_options():
+    """
+    Tests whether the cache key changes with the content and the options
+    """
+    key = cache_key(b"swc", ["--input=file"])
+    assert key == cache_key(b"swc", ["--input=file"])
+    assert key != cache_key(b"other swc", ["--input=file"])
+    assert key != cache_key(b"swc", ["--input=file", "--export-soma-mesh-obj"])
+    # Options are separated, so that they cannot be merged with the content
+    assert cache_key(b"swc", ["a"]) != cache_key(b"swca", [])
+
+
+def test_put_and_get(tmp_path):
+    """
+    Tests whether a cached mesh is found by its key, and survives the deletion of its source
+    """
+    cache = DiskCache(tmp_path / "cache", max_bytes=1024, suffix=".glb")
+    assert cache.get("key") is None
+
+    source = write_mesh(tmp_path / "job" / "SOMA_MESH_a.glb", 10)
+    cached = cache.put("key", source)
+    source.unlink()
+
+    assert cache.get("key") == cached
+    assert cached.read_bytes() == b"m" * 10
+    assert not [path for path in cache.directory.iterdir() if path.name.endswith(".tmp")]
+
+
+def test_least_recently_used_meshes_are_evicted(tmp_path):
+    """
+    Tests whether the least recently used meshes are evicted above the size limit, by the eviction only
+    """
+    cache = DiskCache(tmp_path / "cache", max_bytes=25, suffix=".glb")
+    for index, key in enumerate(["a", "b"]):
+        cache.put(key, write_mesh(tmp_path / f"{key}.glb", 10))
+        os.utime(cache.path(key), (index, index))
+    # A hit makes "a" the most recently used
+    cache.get("a")
+
+    # Adding a mesh does not evict: the storage collector does
+    cache.put("c", write_mesh(tmp_path / "c.glb", 10))
+    assert cache.path("b").exists()
+
+    assert cache.evict() == 1
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+
+def test_link_places_cached_mesh(tmp_path):
+    """
+    Tests whether a cached mesh is placed in a job directory
+    """
+    cache = DiskCache(tmp_path / "cache", max_bytes=1024, suffix=".glb")
+    destination = tmp_path / "job" / "meshes" / "SOMA_MESH_morphology.glb"
+    assert not cache.link("key", destination)
+
+    cache.put("key", write_mesh(tmp_path / "mesh.glb", 10))
+    assert cache.link("key", destination)
+    assert destination.read_bytes() == b"m" * 10
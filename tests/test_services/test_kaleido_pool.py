@@ -0,0 +1,80 @@
+"""
+Unit test module for testing the Kaleido renderer pool
+"""
+
+import asyncio
+from io import BytesIO
+from unittest.mock import patch
+import pytest
+from PIL import Image
+from api.exceptions import RendererUnavailableException
+from api.router.health import health
+from api.services.admission import render_metrics
+from api.services.kaleido_pool import KaleidoRendererPool, WARM_UP_FIGURE
+
+
+@pytest.fixture
+def pool():
+    """
+    Started pool with a single renderer
+    """
+    renderer_pool = KaleidoRendererPool(size=1, acquire_timeout=0.1, max_renders=2)
+    renderer_pool.start()
+    yield renderer_pool
+    renderer_pool.stop()
+
+
+def test_pool_starts_warm_renderers(pool):
+    """
+    Tests whether the renderers are running as soon as the pool is started
+    """
+    assert pool.started
+    assert pool.alive() == 1
+
+
+def test_pool_renders_png_with_requested_size(pool):
+    """
+    Tests whether the pool exports the figure with the requested size
+    """
+    image = Image.open(BytesIO(pool.render(WARM_UP_FIGURE, width=120, height=80)))
+    assert image.size == (120, 80)
+
+
+def test_pool_restarts_crashed_renderer(pool):
+    """
+    Tests whether a renderer whose Chromium process died is restarted on its next use
+    """
+    renderer = pool._renderers[0]  # pylint: disable=protected-access
+    renderer.process.kill()
+    renderer.process.wait()
+
+    assert pool.render(WARM_UP_FIGURE, width=50, height=50)
+    assert pool.alive() == 1
+
+
+def test_pool_raises_if_no_renderer_is_free(pool):
+    """
+    Tests whether the pool raises a 503 exception if no renderer got free in time
+    """
+    renderer = pool._idle.get()  # pylint: disable=protected-access
+    try:
+        with pytest.raises(RendererUnavailableException):
+            pool.render(WARM_UP_FIGURE, width=50, height=50)
+    finally:
+        pool._idle.put(renderer)  # pylint: disable=protected-access
+
+
+def test_pool_is_reported_by_metrics_and_health(pool):
+    """
+    Tests whether the live renderers are exported, and the health is degraded once none is alive
+    """
+    with patch("api.services.admission.kaleido_pool", pool), patch("api.router.health.kaleido_pool", pool):
+        assert "kaleido_renderers 1\n" in render_metrics()
+        assert "kaleido_renderers_alive 1\n" in render_metrics()
+        assert asyncio.run(health()) == {"status": "OK"}
+
+        renderer = pool._renderers[0]  # pylint: disable=protected-access
+        renderer.process.kill()
+        renderer.process.wait()
+        assert "kaleido_renderers_alive 0\n" in render_metrics()
+        assert asyncio.run(health())["status"] == "DEGRADED"
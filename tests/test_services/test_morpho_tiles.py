@@ -0,0 +1,139 @@
+"""
+Unit test module for testing the deep-zoom tile pyramids of the morphologies
+"""
+
+import time
+from unittest.mock import Mock, patch
+import numpy as np
+import pytest
+from api.exceptions import TileNotFoundException
+from api.services.disk_cache import DiskCache
+from api.services.morpho_tiles import (
+    GeometryStore,
+    MorphologyGeometry,
+    SegmentIndex,
+    generate_morphology_tile,
+)
+from api.services.render_executor import render_executor
+from tests.utils import load_content
+
+MORPHOLOGY_PATH = "./tests/fixtures/data/morphology.swc"
+
+
+@pytest.fixture(name="geometry")
+def fixture_geometry():
+    """
+    The projected geometry of the fixture morphology
+    """
+    return MorphologyGeometry.from_content(load_content(MORPHOLOGY_PATH))
+
+
+@pytest.fixture(name="store")
+def fixture_store(tmp_path):
+    """
+    A geometry store caching on a temporary directory
+    """
+    cache = DiskCache(tmp_path / "geometry", max_bytes=64 * 1024 * 1024, suffix=".npz")
+    return GeometryStore(cache, max_entries=2, access_ttl=60.0)
+
+
+def test_index_returns_every_segment_crossing_a_box():
+    """
+    Tests whether the segments crossing a box are all among the ones returned by the index
+    """
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(0, 100, size=(500, 2))
+    segments = np.concatenate([starts, starts + rng.uniform(-5, 5, size=(500, 2))], axis=1)
+    index = SegmentIndex(segments, origin=np.array([-5.0, -5.0]), size=110.0, grid_size=16)
+
+    minimum, maximum = np.array([20.0, 30.0]), np.array([40.0, 45.0])
+    crossing = np.flatnonzero(
+        (np.minimum(segments[:, 0], segments[:, 2]) <= maximum[0])
+        & (np.maximum(segments[:, 0], segments[:, 2]) >= minimum[0])
+        & (np.minimum(segments[:, 1], segments[:, 3]) <= maximum[1])
+        & (np.maximum(segments[:, 1], segments[:, 3]) >= minimum[1])
+    )
+    candidates = index.query(minimum, maximum)
+    assert set(crossing) <= set(candidates)
+    assert len(candidates) < len(segments)
+
+
+def test_tiles_split_the_bounding_square(geometry):
+    """
+    Tests whether the tiles of a zoom level cover the bounding square, the first row at the top
+    """
+    minimum, maximum = geometry.tile_bounds(0, 0, 0)
+    np.testing.assert_allclose(minimum, geometry.origin)
+    np.testing.assert_allclose(maximum, geometry.origin + geometry.size)
+
+    minimum, maximum = geometry.tile_bounds(1, 1, 0)
+    np.testing.assert_allclose(minimum, geometry.origin + geometry.size / 2)
+    np.testing.assert_allclose(maximum, geometry.origin + geometry.size)
+
+
+@pytest.mark.parametrize("z, x, y", [(0, 1, 0), (1, 0, 2), (1, -1, 0), (99, 0, 0)])
+def test_tiles_out_of_the_pyramid_are_not_found(geometry, z, x, y):
+    """
+    Tests whether the tiles out of the pyramid raise a 404
+    """
+    with pytest.raises(TileNotFoundException):
+        geometry.tile_bounds(z, x, y)
+
+
+def test_tile_only_draws_the_segments_it_crosses(geometry):
+    """
+    Tests whether the whole morphology is drawn at zoom level 0, and a deep tile only draws a part of it
+    """
+    assert len(geometry.tile_geometry(0, 0, 0)[2]) == len(geometry.segments)
+
+    z = geometry.max_zoom
+    drawn = sum(len(geometry.tile_geometry(z, x, y)[2]) for x in range(2**z) for y in range(2**z) if (x + y) % 7 == 0)
+    assert 0 < drawn < len(geometry.segments)
+
+
+def test_geometry_round_trips_through_bytes(geometry):
+    """
+    Tests whether the cached geometry is the projected one
+    """
+    loaded = MorphologyGeometry.from_bytes(geometry.to_bytes())
+    np.testing.assert_array_equal(loaded.segments, geometry.segments)
+    np.testing.assert_array_equal(loaded.types, geometry.types)
+    assert loaded.info() == geometry.info()
+
+
+def test_store_remembers_the_access_of_a_token(store):
+    """
+    Tests whether the content is downloaded once per token while its access is remembered
+    """
+    fetch = Mock(return_value=load_content(MORPHOLOGY_PATH))
+    with patch("api.services.morpho_tiles.fetch_file_content", fetch):
+        key, geometry = store.geometry("token", "http://example.com/morphology")
+        assert store.geometry("token", "http://example.com/morphology") == (key, geometry)
+        assert fetch.call_count == 1
+
+        # Another token still needs its own access to the content
+        store.geometry("other-token", "http://example.com/morphology")
+        assert fetch.call_count == 2
+
+        # Once expired, the access is checked again by downloading the content
+        with patch("api.services.morpho_tiles.time.monotonic", return_value=time.monotonic() + 120):
+            assert store.purge_expired_accesses() == 2
+            store.geometry("token", "http://example.com/morphology")
+        assert fetch.call_count == 3
+    assert store.cache.path(key).exists()
+
+
+def test_tiles_are_rendered_once(store, tmp_path):
+    """
+    Tests whether a tile is served from the render cache after its first render
+    """
+    render_cache = DiskCache(tmp_path / "render_cache", max_bytes=1024 * 1024, suffix=".png")
+    with patch("api.services.morpho_tiles.geometry_store", store), patch(
+        "api.services.morpho_tiles.render_cache", render_cache
+    ), patch("api.services.morpho_tiles.fetch_file_content", return_value=load_content(MORPHOLOGY_PATH)), patch.object(
+        render_executor, "submit", return_value=b"png"
+    ) as render:
+        assert generate_morphology_tile("token", "http://example.com/morphology", 1, 0, 1) == b"png"
+        assert generate_morphology_tile("token", "http://example.com/morphology", 1, 0, 1) == b"png"
+        generate_morphology_tile("token", "http://example.com/morphology", 1, 1, 1)
+    assert render.call_count == 2
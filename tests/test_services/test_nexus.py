@@ -2,27 +2,40 @@
 Testing Nexus-related services
 """
 
+from http.client import HTTPMessage
 import pytest
+import requests
+import urllib3
+from requests.cookies import extract_cookies_to_jar
 from unittest.mock import Mock, patch
-from api.services.nexus import fetch_file_content
-from api.exceptions import AuthenticationIssueException, AuthorizationIssueException, ResourceNotFoundException
+from api.services.nexus import check_file_access, create_nexus_session, fetch_file_content, stream_file_content
+from api.services.simulation_img import extract_plot_data
+from api.exceptions import (
+    AuthenticationIssueException,
+    AuthorizationIssueException,
+    RequestCancelledException,
+    ResourceNotFoundException,
+)
+from api.utils.cancellation import CancellationToken, cancellation_scope
 from tests.utils import load_content
 
 
-@patch("requests.get")
+@patch("api.services.nexus.nexus_session.get")
 def test_fetch_file_content_returns_data_if_request_is_200(mock_get, morphology_content_url, access_token):
     """
     Tests whether the content is correctly returned if the request is 200
     """
+    content = load_content("./tests/fixtures/data/morphology.swc")
     mock_response = Mock()
     mock_response.status_code = 200
-    mock_response.json.return_value = load_content("./tests/fixtures/data/morphology.swc", encoded=False)
+    mock_response.iter_content.return_value = [content[:100], content[100:]]
     mock_get.return_value = mock_response
 
-    fetch_file_content(access_token, morphology_content_url)
+    assert fetch_file_content(access_token, morphology_content_url) == content
+    mock_response.close.assert_called_once()
 
 
-@patch("requests.get")
+@patch("api.services.nexus.nexus_session.get")
 def test_fetch_file_content_raises_exception_if_content_url_does_not_exist(
     mock_get, morphology_content_url, access_token
 ):
@@ -37,7 +50,7 @@ def test_fetch_file_content_raises_exception_if_content_url_does_not_exist(
         fetch_file_content(access_token, morphology_content_url)
 
 
-@patch("requests.get")
+@patch("api.services.nexus.nexus_session.get")
 def test_fetch_file_content_raises_exception_if_user_is_not_authenticated(
     mock_get, morphology_content_url, access_token
 ):
@@ -52,7 +65,7 @@ def test_fetch_file_content_raises_exception_if_user_is_not_authenticated(
         fetch_file_content(access_token, morphology_content_url)
 
 
-@patch("requests.get")
+@patch("api.services.nexus.nexus_session.get")
 def test_fetch_file_content_raises_exception_if_user_is_not_authorized_to_access_resource(
     mock_get, morphology_content_url, access_token
 ):
@@ -65,3 +78,105 @@ def test_fetch_file_content_raises_exception_if_user_is_not_authorized_to_access
     mock_get.return_value = mock_response
     with pytest.raises(AuthorizationIssueException):
         fetch_file_content(access_token, morphology_content_url)
+
+
+@patch("api.services.nexus.nexus_session.get")
+def test_stream_file_content_yields_raw_stream_and_closes_response(mock_get, morphology_content_url, access_token):
+    """
+    Tests whether the raw response stream is returned and the response is closed afterwards
+    """
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_get.return_value = mock_response
+
+    with stream_file_content(access_token, morphology_content_url) as stream:
+        assert stream is mock_response.raw
+        assert stream.decode_content is True
+
+    assert mock_get.call_args.kwargs["stream"] is True
+    mock_response.close.assert_called_once()
+
+
+@patch("api.services.nexus.nexus_session.get")
+def test_stream_file_content_raises_exception_if_content_url_does_not_exist(
+    mock_get, morphology_content_url, access_token
+):
+    """
+    Tests whether the proper error is raised if content_url does not exist
+    """
+    mock_response = Mock()
+    mock_response.status_code = 404
+    mock_get.return_value = mock_response
+    with pytest.raises(ResourceNotFoundException):
+        with stream_file_content(access_token, morphology_content_url):
+            pass
+
+
+@patch("api.services.nexus.nexus_session.get")
+def test_stream_file_content_raises_request_exception_on_read_errors(mock_get, morphology_content_url, access_token):
+    """
+    Tests whether a connection lost while the stream is read raises a requests exception, like fetch_file_content()
+    """
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_response.raw.read.side_effect = urllib3.exceptions.ProtocolError("Connection broken")
+    mock_get.return_value = mock_response
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        with stream_file_content(access_token, morphology_content_url) as stream:
+            extract_plot_data(stream, "stimulus")
+    mock_response.close.assert_called_once()
+
+
+@patch("api.services.nexus.nexus_session.get")
+def test_fetch_file_content_stops_download_of_cancelled_request(mock_get, morphology_content_url, access_token):
+    """
+    Tests whether the download stops as soon as the request is cancelled
+    """
+    token = CancellationToken()
+
+    def chunks(_):
+        yield b"first"
+        token.cancel()
+        yield b"second"
+        pytest.fail("The download went on after the cancellation")
+
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_response.iter_content.side_effect = chunks
+    mock_get.return_value = mock_response
+
+    with cancellation_scope(token), pytest.raises(RequestCancelledException):
+        fetch_file_content(access_token, morphology_content_url)
+    mock_response.close.assert_called_once()
+
+
+def test_nexus_session_pools_connections_without_cookies():
+    """
+    Tests whether the session shared by the users keeps its connections alive but never stores cookies
+    """
+    session = create_nexus_session(pool_size=8)
+    assert session.get_adapter("https://example.com")._pool_maxsize == 8
+
+    headers = HTTPMessage()
+    headers["Set-Cookie"] = "session=user-1"
+    request = requests.Request("GET", "https://example.com/file").prepare()
+    extract_cookies_to_jar(session.cookies, request, Mock(_original_response=Mock(msg=headers)))
+    assert len(session.cookies) == 0
+
+
+@patch("api.services.nexus.nexus_session.get")
+def test_check_file_access_does_not_read_content(mock_get, morphology_content_url, access_token):
+    """
+    Tests whether the access to a file is checked without reading its content, and a denied access raises
+    """
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_get.return_value = mock_response
+    check_file_access(access_token, morphology_content_url)
+    mock_response.raw.read.assert_not_called()
+    mock_response.close.assert_called_once()
+
+    mock_response.status_code = 403
+    with pytest.raises(AuthorizationIssueException):
+        check_file_access(access_token, morphology_content_url)
@@ -0,0 +1,69 @@
+"""
+Unit test module for testing the cache of the rendered thumbnails
+"""
+
+from unittest.mock import Mock, patch
+from api.services.disk_cache import DiskCache
+from api.services.morpho_img import generate_morphology_image, render_morphology_image
+from api.services.render_cache import cached_render, render_cache_key_of_digest, render_options
+from api.services.simulation_img import plot_data_digest
+from api.models.common import PlotData
+from tests.utils import load_content
+
+
+def test_cached_image_is_rendered_once(tmp_path):
+    """
+    Tests whether an image is only rendered on the first request of its key
+    """
+    cache = DiskCache(tmp_path / "cache", max_bytes=1024, suffix=".png")
+    render = Mock(return_value=b"png")
+
+    assert cached_render(cache, "key", render) == b"png"
+    assert cached_render(cache, "key", render) == b"png"
+    render.assert_called_once()
+    assert cache.path("key").name == "key.png"
+
+
+def test_disabled_cache_always_renders(tmp_path):
+    """
+    Tests whether nothing is cached with a size limit of 0
+    """
+    cache = DiskCache(tmp_path / "cache", max_bytes=0, suffix=".png")
+    render = Mock(return_value=b"png")
+
+    cached_render(cache, "key", render)
+    cached_render(cache, "key", render)
+    assert render.call_count == 2
+    assert not cache.directory.exists()
+
+
+def test_key_depends_on_render_parameters():
+    """
+    Tests whether the renders of the same data with other functions or parameters have other keys
+    """
+    options = render_options(render_morphology_image, [72])
+    assert options != render_options(render_morphology_image, [300])
+    assert options[0] == "api.services.morpho_img.render_morphology_image"
+
+    data = [PlotData(x=[0, 1], y=[1, 2], name="a")]
+    key = render_cache_key_of_digest(plot_data_digest(data), render_morphology_image, 100, 100)
+    other_data = [PlotData(x=[0, 1], y=[1, 3], name="a")]
+    assert key != render_cache_key_of_digest(plot_data_digest(other_data), render_morphology_image, 100, 100)
+
+
+def test_morphology_thumbnail_is_served_from_the_cache(tmp_path):
+    """
+    Tests whether a morphology thumbnail is downloaded on every request but rendered once
+    """
+    content = load_content("./tests/fixtures/data/morphology.swc")
+    cache = DiskCache(tmp_path / "cache", max_bytes=1024 * 1024, suffix=".png")
+    with patch("api.services.render_cache.render_cache", cache), patch(
+        "api.services.morpho_img.fetch_file_content", return_value=content
+    ) as fetch_file_content, patch(
+        "api.services.render_cache.render_executor.run_on_content", wraps=lambda fn, *args, **_: fn(*args)
+    ) as run_on_content:
+        image = generate_morphology_image("token", "http://example.com/morphology", 50)
+        assert generate_morphology_image("token", "http://example.com/morphology", 50) == image
+
+    assert fetch_file_content.call_count == 2
+    run_on_content.assert_called_once()
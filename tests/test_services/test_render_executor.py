@@ -0,0 +1,123 @@
+"""
+Unit test module for testing the process pool of the render stage
+"""
+
+import os
+import threading
+import time
+from io import BytesIO
+import pytest
+from PIL import Image
+from api.exceptions import DeadlineExceededException
+from api.services.morpho_img import render_morphology_image
+from api.services.render_executor import PrioritySlots, RenderExecutor
+from api.utils.cancellation import CancellationToken, cancellation_scope
+from tests.utils import load_content
+
+
+@pytest.fixture
+def executor():
+    """
+    Started executor with a single worker, recycled after every task
+    """
+    render_executor = RenderExecutor(workers=1, max_tasks=1, max_rss_mb=4096)
+    render_executor.start()
+    yield render_executor
+    render_executor.stop()
+
+
+def test_executor_runs_inline_if_not_started():
+    """
+    Tests whether the tasks run in the calling process if the executor has no workers
+    """
+    render_executor = RenderExecutor(workers=0, max_tasks=1, max_rss_mb=4096)
+    render_executor.start()
+
+    assert not render_executor.started
+    assert render_executor.submit(os.getpid) == os.getpid()
+
+
+def test_executor_renders_spooled_content_in_worker(executor):
+    """
+    Tests whether the content is handed over to a worker process and rendered there
+    """
+    image = executor.run_on_content(
+        render_morphology_image, load_content("./tests/fixtures/data/morphology.swc"), 72, suffix=".swc"
+    )
+
+    assert Image.open(BytesIO(image)).format == "PNG"
+
+
+def test_executor_recycles_workers_after_max_tasks(executor):
+    """
+    Tests whether the worker is replaced once it reached its maximum number of tasks
+    """
+    first_pid = executor.submit(os.getpid)
+    assert first_pid != os.getpid()
+
+    deadline = time.monotonic() + 60
+    while executor.recycling_policy.recycling and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    assert executor.submit(os.getpid) != first_pid
+
+
+def test_executor_drops_queued_task_of_cancelled_request():
+    """
+    Tests whether a render still waiting for a worker is dropped when its request is cancelled
+    """
+    render_executor = RenderExecutor(workers=1, max_tasks=100, max_rss_mb=4096)
+    render_executor.start()
+    try:
+        # Keeps the only worker busy
+        busy = threading.Thread(target=render_executor.submit, args=(time.sleep, 1))
+        busy.start()
+        time.sleep(0.1)
+
+        token = CancellationToken(timeout=0.2)
+        started = time.monotonic()
+        with cancellation_scope(token), pytest.raises(DeadlineExceededException):
+            render_executor.submit(os.getpid)
+        assert time.monotonic() - started < 0.8
+        busy.join()
+    finally:
+        render_executor.stop()
+
+
+def test_priority_slots_are_given_by_priority_then_arrival():
+    """
+    Tests whether the free slots go to the waiting threads with the lowest priority value first
+    """
+    slots = PrioritySlots(1)
+    token = CancellationToken()
+    order = []
+
+    def take(name, priority):
+        with slots.acquire(priority, token):
+            order.append(name)
+
+    with slots.acquire(0, token):
+        threads = []
+        for name, priority in [("grid", 5), ("thumbnail", 0), ("second grid", 5)]:
+            threads.append(threading.Thread(target=take, args=(name, priority)))
+            threads[-1].start()
+            while slots.waiting < len(threads):
+                time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+
+    assert order == ["thumbnail", "grid", "second grid"]
+
+
+def test_priority_slots_drop_cancelled_waiter():
+    """
+    Tests whether a thread whose request is cancelled leaves the queue without taking a slot
+    """
+    slots = PrioritySlots(1)
+    with slots.acquire(0, CancellationToken()):
+        with pytest.raises(DeadlineExceededException):
+            with slots.acquire(0, CancellationToken(timeout=0.1)):
+                pass
+        assert slots.waiting == 0
+    with slots.acquire(0, CancellationToken(timeout=0.1)):
+        pass
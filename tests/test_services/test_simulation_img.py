@@ -0,0 +1,197 @@
+"""
+Unit test module for testing simulation thumbnail generation service
+"""
+
+from io import BytesIO
+from unittest.mock import patch
+import numpy as np
+import pytest
+from PIL import Image
+from pydantic import ValidationError
+from api.exceptions import TooManyPanelsException
+from api.models.common import PlotData, SimulationGenerationInput, SimulationGridInput
+from api.models.enums import SimulationPlotEngine
+from api.services.simulation_img import (
+    decimate_plot_data,
+    extract_plot_data,
+    extract_simulation_panels,
+    generate_simulation_grid,
+    generate_simulation_plots,
+    grid_shape,
+)
+from api.settings import settings
+from tests.utils import load_json_stream
+
+
+@patch(
+    "api.services.simulation_img.stream_file_content",
+    side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+)
+def test_generate_simulation_plots_with_matplotlib_engine(fetch_file_content, monkeypatch, access_token):
+    """
+    Tests whether the matplotlib engine returns an image with the requested size
+    """
+    monkeypatch.setattr(settings, "simulation_plot_engine", SimulationPlotEngine.MATPLOTLIB)
+
+    response = generate_simulation_plots(
+        access_token,
+        SimulationGenerationInput(content_url="http://example.com/config", target="simulation", w=300, h=200),
+    )
+
+    image = Image.open(BytesIO(response))
+    assert image.format == "PNG"
+    assert image.size == (300, 200)
+
+
+@patch(
+    "api.services.simulation_img.stream_file_content",
+    side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+)
+def test_generate_simulation_plots_with_matplotlib_engine_uses_plotly_default_size(
+    fetch_file_content, monkeypatch, access_token
+):
+    """
+    Tests whether the matplotlib engine falls back to the plotly default size
+    """
+    monkeypatch.setattr(settings, "simulation_plot_engine", SimulationPlotEngine.MATPLOTLIB)
+
+    response = generate_simulation_plots(
+        access_token, SimulationGenerationInput(content_url="http://example.com/config", target="stimulus")
+    )
+
+    assert Image.open(BytesIO(response)).size == (700, 500)
+
+
+def test_plot_data_is_parsed_into_float_arrays():
+    """
+    Tests whether the series are validated into contiguous float64 arrays of the same length
+    """
+    plot_data = PlotData(x=[0, 1, 2, 3], y=[1.5, None, 2.5], name="trace")
+
+    assert plot_data.x.dtype == np.float64
+    assert plot_data.x.flags["C_CONTIGUOUS"]
+    assert len(plot_data.x) == len(plot_data.y) == 3
+    assert np.isnan(plot_data.y[1])
+
+
+def test_plot_data_rejects_malformed_series():
+    """
+    Tests whether series that are not one-dimensional sequences of numbers are rejected
+    """
+    with pytest.raises(ValidationError):
+        PlotData(x=[[0, 1], [2, 3]], y=[0, 1], name="trace")
+
+    with pytest.raises(ValidationError):
+        PlotData(x=["a", "b"], y=[0, 1], name="trace")
+
+
+def test_extract_plot_data_stops_after_target_section():
+    """
+    Tests whether only the first simulation location is read, without parsing the rest of the stream
+    """
+    stream = BytesIO(
+        b'{"simulation": {"soma[0]_0.5": [{"x": [0, 1], "y": [2, 3], "name": "soma"}], '
+        b'"dend[0]_0.5": [{"x": [0, 1], "y": [4, 5], "name": "dend"}]}, "stimulus": [this is not json'
+    )
+
+    data = extract_plot_data(stream, "simulation")
+
+    assert [pd.name for pd in data] == ["soma"]
+    np.testing.assert_array_equal(data[0].y, [2, 3])
+
+
+def test_extract_plot_data_raises_if_target_section_is_malformed():
+    """
+    Tests whether a malformed target section raises a ValueError
+    """
+    with pytest.raises(ValueError):
+        extract_plot_data(BytesIO(b'{"stimulus": [{"x": [0, 1], "y": '), "stimulus")
+
+
+def test_decimate_plot_data_bounds_points_per_series():
+    """
+    Tests whether every series is reduced to the maximum number of points, keeping its peaks
+    """
+    x = np.arange(100000.0)
+    y = np.zeros_like(x)
+    y[4242] = 50.0
+    data = [PlotData(x=x, y=y, name="long"), PlotData(x=[0, 1], y=[1, 2], name="short")]
+
+    decimated = decimate_plot_data(data, 400)
+
+    assert len(decimated[0].x) <= 400
+    assert decimated[0].y.max() == 50.0
+    assert decimated[0].name == "long"
+    np.testing.assert_array_equal(decimated[1].y, [1, 2])
+
+
+@patch(
+    "api.services.simulation_img.stream_file_content",
+    side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+)
+def test_generate_simulation_grid_with_matplotlib_engine(fetch_file_content, monkeypatch, access_token):
+    """
+    Tests whether the grid has the default panel size times the grid shape
+    """
+    monkeypatch.setattr(settings, "simulation_plot_engine", SimulationPlotEngine.MATPLOTLIB)
+
+    response = generate_simulation_grid(access_token, SimulationGridInput(content_url="http://example.com/config"))
+
+    # stimulus + one location on a single row
+    assert Image.open(BytesIO(response)).size == (700, 250)
+
+
+def test_extract_simulation_panels_builds_only_the_selected_locations():
+    """
+    Tests whether the panels are the stimulus then the requested locations in their order, the others skipped
+    """
+    stream = BytesIO(
+        b'{"simulation": {"a": [{"x": [0, 1], "y": [2, 3], "name": "a"}], "b": [{"x": [0], "y": [1], "name": "b"}], '
+        b'"c": [{"x": [0, 1], "y": [4, 5], "name": "c"}], "empty": []}, '
+        b'"stimulus": [{"x": [0, 1], "y": [6, 7], "name": "IV"}]}'
+    )
+
+    panels = extract_simulation_panels(stream, ["c", "unknown", "empty", "a"], True, 10)
+
+    assert [title for title, _ in panels] == ["stimulus", "c", "a"]
+    np.testing.assert_array_equal(panels[1][1][0].y, [4, 5])
+
+
+def test_extract_simulation_panels_stops_above_the_limit():
+    """
+    Tests whether a grid with more panels than the limit is rejected without reading the rest of the stream
+    """
+    stream = BytesIO(
+        b'{"simulation": {"a": [{"x": [0], "y": [1], "name": "a"}], "b": [{"x": [0], "y": [1], "name": "b"}], '
+        b'"c": [this is not json'
+    )
+
+    with pytest.raises(TooManyPanelsException):
+        extract_simulation_panels(stream, None, False, 1)
+
+
+@patch(
+    "api.services.simulation_img.stream_file_content",
+    side_effect=load_json_stream("./tests/fixtures/data/simulation_config.json"),
+)
+def test_generate_simulation_grid_clamps_default_size(fetch_file_content, monkeypatch, access_token):
+    """
+    Tests whether the default size of a tall grid is clamped
+    """
+    monkeypatch.setattr(settings, "simulation_plot_engine", SimulationPlotEngine.MATPLOTLIB)
+    monkeypatch.setattr("api.services.simulation_img.GRID_MAX_HEIGHT", 400)
+
+    config = SimulationGridInput(content_url="http://example.com/config", columns=1)
+    response = generate_simulation_grid(access_token, config)
+
+    assert Image.open(BytesIO(response)).size == (350, 400)
+
+
+def test_grid_shape():
+    """
+    Tests whether grids are as square as possible unless the number of columns is given
+    """
+    assert grid_shape(1, None) == (1, 1)
+    assert grid_shape(5, None) == (2, 3)
+    assert grid_shape(5, 1) == (5, 1)
+    assert grid_shape(2, 4) == (1, 2)
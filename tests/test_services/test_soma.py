@@ -0,0 +1,199 @@
+"""
+Unit test module for testing the soma reconstruction service
+"""
+
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+import pytest
+from api.exceptions import DeadlineExceededException
+from api.services import soma
+from api.services.soma import BlenderWorkerPool, purge_work_directories, run_nmv_script, work_directory
+from api.utils.cancellation import CancellationToken, cancellation_scope
+
+
+def test_nmv_script_failure_is_raised():
+    """
+    Tests whether a failing script raises like subprocess.run(check=True)
+    """
+    with pytest.raises(subprocess.CalledProcessError):
+        run_nmv_script([sys.executable, "-c", "raise SystemExit(3)"])
+
+
+def test_nmv_script_receives_environment(tmp_path):
+    """
+    Tests whether the script sees the environment of the API updated with the given variables
+    """
+    output_file = tmp_path / "environment"
+    script = (
+        f"import os; open({output_file.as_posix()!r}, 'w')"
+        ".write(os.environ['NMV_SOMA_QUALITY'] + os.environ['PATH'])"
+    )
+    run_nmv_script([sys.executable, "-c", script], environment={"NMV_SOMA_QUALITY": "preview"})
+    assert output_file.read_text() == "preview" + os.environ["PATH"]
+
+
+def test_nmv_script_output_is_logged(caplog):
+    """
+    Tests whether the output of the script and of its children is logged line by line
+    """
+    script = "import subprocess; print('Loading morphology', flush=True); subprocess.run(['echo', 'Blender done'])"
+    with caplog.at_level("INFO"):
+        run_nmv_script([sys.executable, "-c", script])
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(message.startswith("NMV[") and message.endswith("]: Loading morphology") for message in messages)
+    assert any(message.endswith("]: Blender done") for message in messages)
+
+
+def test_work_directories_are_isolated_and_deleted(tmp_path, monkeypatch):
+    """
+    Tests whether every reconstruction gets its own working directory, deleted on exit
+    """
+    monkeypatch.setattr(soma, "WORK_DIRECTORY", tmp_path / "work")
+    with work_directory() as first, work_directory() as second:
+        assert first != second
+        (first / "morphology.swc").write_bytes(b"swc")
+    assert not first.exists()
+    assert not second.exists()
+
+
+def test_abandoned_work_directories_are_purged(tmp_path, monkeypatch):
+    """
+    Tests whether only the working directories older than the maximum age are purged
+    """
+    monkeypatch.setattr(soma, "WORK_DIRECTORY", tmp_path / "work")
+    assert purge_work_directories(max_age=60) == 0
+    abandoned = tmp_path / "work" / "abandoned"
+    abandoned.mkdir(parents=True)
+    os.utime(abandoned, (time.time() - 120, time.time() - 120))
+    running = tmp_path / "work" / "running"
+    running.mkdir()
+
+    assert purge_work_directories(max_age=60) == 1
+    assert not abandoned.exists()
+    assert running.exists()
+
+
+def test_nmv_script_is_terminated_when_request_is_cancelled(tmp_path):
+    """
+    Tests whether the script and its children are terminated as soon as the request is cancelled
+    """
+    pid_file = tmp_path / "child.pid"
+    script = (
+        "import subprocess, sys; child = subprocess.Popen(['sleep', '30']);"
+        "open(sys.argv[1], 'w').write(str(child.pid)); child.wait()"
+    )
+    token = CancellationToken(timeout=1)
+
+    started = time.monotonic()
+    with cancellation_scope(token), pytest.raises(DeadlineExceededException):
+        run_nmv_script([sys.executable, "-c", script, str(pid_file)])
+    assert time.monotonic() - started < 5
+
+    # The child of the script got the signal too, it may take a moment to exit
+    child_status = Path(f"/proc/{pid_file.read_text()}/stat")
+    for _ in range(20):
+        if not child_status.exists() or child_status.read_text().split()[2] == "Z":
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("The child process of the script is still running")
+
+
+def test_nmv_script_runs_with_lane_niceness(tmp_path):
+    """
+    Tests whether the script runs with the niceness of the soma lane
+    """
+    niceness_file = tmp_path / "niceness"
+    script = "import os, sys, time; time.sleep(0.2); open(sys.argv[1], 'w').write(str(os.nice(0)))"
+
+    run_nmv_script([sys.executable, "-c", script, str(niceness_file)], niceness=10)
+    assert int(niceness_file.read_text()) == os.nice(0) + 10
+
+
+FAKE_BLENDER_SERVER = """
+import json, os, sys, time
+from pathlib import Path
+
+with os.fdopen(int(os.environ["NMV_RESULT_FD"]), "w", buffering=1) as results:
+    results.write(json.dumps({"ready": True}) + "\\n")
+    for line in sys.stdin:
+        job = json.loads(line)
+        swc_path = Path(job["morphology_file"])
+        if swc_path.stem == "hang":
+            time.sleep(30)
+        error = "Traceback: soft body simulation failed" if swc_path.stem == "fail" else None
+        if error is None:
+            mesh = Path(job["output_directory"]) / "meshes" / f"SOMA_MESH_{swc_path.stem}.glb"
+            mesh.write_text(str(os.getpid()))
+        results.write(json.dumps({"id": job["id"], "ok": error is None, "error": error}) + "\\n")
+"""
+
+
+@pytest.fixture
+def blender_server(tmp_path):
+    """
+    Command starting a fake resident Blender speaking the protocol of the NMV server script
+    """
+    script = tmp_path / "server.py"
+    script.write_text(FAKE_BLENDER_SERVER)
+    return [sys.executable, script.as_posix()]
+
+
+def reconstruct_in_pool(pool, output_directory, stem):
+    """
+    Reconstructs a fake soma in the pool and returns the process id of the Blender that did it
+    """
+    (output_directory / "meshes").mkdir(parents=True, exist_ok=True)
+    pool.run(output_directory / f"{stem}.swc", output_directory)
+    return int((output_directory / "meshes" / f"SOMA_MESH_{stem}.glb").read_text())
+
+
+def test_blender_pool_reuses_resident_process(blender_server, tmp_path):
+    """
+    Tests whether successive reconstructions run in the same Blender process until it is recycled
+    """
+    pool = BlenderWorkerPool(size=1, max_jobs=2, startup_timeout=10, command=blender_server)
+    pool.start()
+    try:
+        first = reconstruct_in_pool(pool, tmp_path, "first")
+        second = reconstruct_in_pool(pool, tmp_path, "second")
+        third = reconstruct_in_pool(pool, tmp_path, "third")
+    finally:
+        pool.stop()
+
+    assert first == second
+    assert third != first
+
+
+def test_blender_pool_raises_failure_of_job(blender_server, tmp_path):
+    """
+    Tests whether a reconstruction that failed in Blender raises its error
+    """
+    pool = BlenderWorkerPool(size=1, max_jobs=10, startup_timeout=10, command=blender_server)
+    pool.start()
+    try:
+        with pytest.raises(RuntimeError, match="soft body simulation failed"):
+            reconstruct_in_pool(pool, tmp_path, "fail")
+        assert reconstruct_in_pool(pool, tmp_path, "next")
+    finally:
+        pool.stop()
+
+
+def test_blender_pool_replaces_process_of_cancelled_job(blender_server, tmp_path):
+    """
+    Tests whether the Blender running a cancelled job is killed and replaced
+    """
+    pool = BlenderWorkerPool(size=1, max_jobs=10, startup_timeout=10, command=blender_server)
+    pool.start()
+    try:
+        first = reconstruct_in_pool(pool, tmp_path, "first")
+        started = time.monotonic()
+        with cancellation_scope(CancellationToken(timeout=0.3)), pytest.raises(DeadlineExceededException):
+            reconstruct_in_pool(pool, tmp_path, "hang")
+        assert time.monotonic() - started < 5
+        assert reconstruct_in_pool(pool, tmp_path, "next") != first
+    finally:
+        pool.stop()
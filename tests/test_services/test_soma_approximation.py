@@ -0,0 +1,70 @@
+"""
+Unit test module for testing the Blender-free approximation of the soma
+"""
+
+import numpy as np
+import pytest
+from api.exceptions import InvalidSomaException
+from api.models.enums import SomaApproximationFormat
+from api.services.soma_approximation import approximate_soma_mesh, read_soma_spheres, render_soma_approximation
+from tests.utils import load_content
+
+SWC_CONTENT = b"""# index type x y z radius parent
+1 1 0 0 0 2 -1
+2 1 1 0 0 2 1
+3 3 3 0 0 0.5 1
+4 3 6 0 0 0.5 3
+5 2 0 -4 0 0.5 2
+"""
+
+
+def test_soma_spheres_are_soma_points_and_neurite_roots():
+    """
+    Tests whether the spheres are the soma points and the first point of each neurite
+    """
+    spheres = read_soma_spheres(SWC_CONTENT)
+    np.testing.assert_array_equal(spheres, [[0, 0, 0, 2], [1, 0, 0, 2], [3, 0, 0, 0.5], [0, -4, 0, 0.5]])
+
+
+@pytest.mark.parametrize("content", [b"1 3 0 0 0 1 -1\n", b"not a swc file\n"])
+def test_invalid_soma_is_rejected(content):
+    """
+    Tests whether a SWC content without soma or malformed is rejected with a 422
+    """
+    with pytest.raises(InvalidSomaException) as exc_info:
+        read_soma_spheres(content)
+    assert exc_info.value.status_code == 422
+
+
+def test_mesh_is_closed_outward_and_encloses_spheres():
+    """
+    Tests whether the mesh is a closed outward oriented surface reaching the extents of the spheres
+    """
+    positions, normals, triangles = approximate_soma_mesh(read_soma_spheres(SWC_CONTENT))
+
+    edges = np.sort(np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]]), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    assert (counts == 2).all()
+    corners = positions[triangles]
+    volume = np.einsum("ij,ij->i", corners[:, 0], np.cross(corners[:, 1], corners[:, 2])).sum() / 6
+    assert volume > 0
+    np.testing.assert_allclose(np.linalg.norm(normals, axis=1), 1)
+    # The vertices lie outside of the spheres, close to them
+    assert 3.5 <= positions[:, 0].max() < 3.7
+    assert -4.7 < positions[:, 1].min() <= -4.5
+
+
+@pytest.mark.parametrize(
+    "output_format, magic", [(SomaApproximationFormat.GLB, b"glTF"), (SomaApproximationFormat.PNG, b"\x89PNG")]
+)
+def test_render_soma_approximation(output_format, magic, tmp_path):
+    """
+    Tests whether the approximation is rendered from a content or a spooled file
+    """
+    content = load_content("./tests/fixtures/data/morphology.swc")
+    swc_path = tmp_path / "morphology.swc"
+    swc_path.write_bytes(content)
+
+    result = render_soma_approximation(content, output_format)
+    assert result.startswith(magic)
+    assert render_soma_approximation(swc_path.as_posix(), output_format) == result
@@ -0,0 +1,282 @@
+"""
+Unit test module for testing the soma reconstruction jobs
+"""
+
+import threading
+import time
+import pytest
+from api.exceptions import QueueFullException, SomaMeshNotFoundException
+from api.models.enums import JobStatus, SomaQuality
+from api.models.soma import SomaExportOptions
+from api.services.disk_cache import DiskCache
+from api.services.soma_jobs import SWC_FILE_NAME, SomaJobStore, SomaJobWorkers
+from api.utils.cancellation import current_cancellation
+
+SWC_CONTENT = b"1 1 0 0 0 5 -1\n"
+
+
+@pytest.fixture
+def store(tmp_path):
+    """
+    Empty job store in a temporary directory
+    """
+    return SomaJobStore(tmp_path / "jobs", ttl=60, max_pending=2)
+
+
+def fake_runner(swc_path, output_directory, niceness, quality, export):
+    """
+    Writes a mesh next to the SWC file instead of running Blender
+    """
+    # pylint: disable=unused-argument
+    mesh_path = output_directory / "meshes" / f"SOMA_MESH_{swc_path.stem}.glb"
+    mesh_path.parent.mkdir()
+    mesh_path.write_bytes(swc_path.read_bytes())
+    return mesh_path
+
+
+def wait_until_finished(store, job_id, submitter=None):
+    """
+    Waits for a job (of a submitter) to reach a final state
+    """
+    for _ in range(100):
+        job = store.get(job_id, submitter)
+        if job.status.finished:
+            return job
+        time.sleep(0.05)
+    pytest.fail("The job did not finish")
+
+
+def test_submitted_job_stores_swc_content(store):
+    """
+    Tests whether a submitted job is pending with its SWC file
+    """
+    job, created = store.submit(SWC_CONTENT)
+
+    assert created
+    assert job.status == JobStatus.PENDING
+    assert (store.job_directory(job.id) / SWC_FILE_NAME).read_bytes() == SWC_CONTENT
+    assert store.get(job.id) == job
+
+
+def test_jobs_are_deduplicated_by_content(store):
+    """
+    Tests whether the job of a SWC content is reused, unless it failed
+    """
+    job, _ = store.submit(SWC_CONTENT)
+    same_job, created = store.submit(SWC_CONTENT)
+    assert not created
+    assert same_job.id == job.id
+
+    other_job, created = store.submit(SWC_CONTENT + b"2 1 0 0 1 1 1\n")
+    assert created
+    assert other_job.id != job.id
+
+    store.fail(store.claim(lease=60), "Blender crashed")
+    retried_job, created = store.submit(SWC_CONTENT)
+    assert created
+    assert retried_job.id != job.id
+
+
+def test_jobs_are_deduplicated_by_quality(store):
+    """
+    Tests whether the jobs of a SWC content with different quality presets are different jobs
+    """
+    job, _ = store.submit(SWC_CONTENT)
+    preview_job, created = store.submit(SWC_CONTENT, SomaQuality.PREVIEW)
+    assert created
+    assert preview_job.id != job.id
+    assert job.quality == SomaQuality.STANDARD
+    assert store.get(preview_job.id).quality == SomaQuality.PREVIEW
+
+
+def test_jobs_are_deduplicated_by_export_options(store):
+    """
+    Tests whether the jobs of a SWC content with different export options are different jobs
+    """
+    job, _ = store.submit(SWC_CONTENT)
+    export = SomaExportOptions(max_triangles=500, draco_compression_level=7)
+    small_job, created = store.submit(SWC_CONTENT, export=export)
+    assert created
+    assert small_job.id != job.id
+    assert store.get(small_job.id).export == export
+    same_job, created = store.submit(SWC_CONTENT, export=export.model_copy())
+    assert not created
+    assert same_job.id == small_job.id
+
+
+def test_jobs_are_deduplicated_by_submitter(store):
+    """
+    Tests whether the jobs of a SWC content submitted by different users are different jobs, only seen by them
+    """
+    job, _ = store.submit(SWC_CONTENT, submitter="test")
+    other_job, created = store.submit(SWC_CONTENT, submitter="other")
+    assert created
+    assert other_job.id != job.id
+    assert store.get(job.id, "test") == job
+    assert store.get(job.id, "other") is None
+    assert store.get(job.id) is None
+
+
+def test_submission_is_rejected_if_too_many_jobs_are_pending(store):
+    """
+    Tests whether new jobs are rejected with a 429 once the pending jobs reached the limit
+    """
+    store.submit(b"1")
+    store.submit(b"2")
+    with pytest.raises(QueueFullException):
+        store.submit(b"3")
+
+
+def test_jobs_are_claimed_in_submission_order_and_reclaimed_after_lease(store):
+    """
+    Tests whether the oldest pending job is claimed, and a running job is claimed again once its lease expired
+    """
+    first, _ = store.submit(b"1")
+    second, _ = store.submit(b"2")
+
+    assert store.claim(lease=0.1).id == first.id
+    assert store.claim(lease=60).id == second.id
+    assert store.claim(lease=60) is None
+
+    time.sleep(0.15)
+    reclaimed = store.claim(lease=60)
+    assert reclaimed.id == first.id
+    assert reclaimed.status == JobStatus.RUNNING
+
+
+def test_jobs_fail_after_max_attempts(tmp_path):
+    """
+    Tests whether a job whose lease expired on its last attempt is failed instead of claimed again
+    """
+    store = SomaJobStore(tmp_path / "jobs", ttl=60, max_pending=2, max_attempts=2)
+    job, _ = store.submit(SWC_CONTENT)
+
+    assert store.claim(lease=0.05).attempts == 1
+    time.sleep(0.1)
+    assert store.claim(lease=0.05).attempts == 2
+    time.sleep(0.1)
+    assert store.claim(lease=60) is None
+
+    job = store.get(job.id)
+    assert job.status == JobStatus.FAILED
+    assert job.error == "The reconstruction did not finish after 2 attempts"
+
+
+def test_stale_claims_do_not_finish_jobs(store):
+    """
+    Tests whether the result of a claim whose lease expired is dropped once the job was claimed again
+    """
+    store.submit(SWC_CONTENT)
+    stale = store.claim(lease=0.05)
+    time.sleep(0.1)
+    current = store.claim(lease=60)
+
+    assert not store.fail(stale, "Timed out")
+    assert store.get(current.id).status == JobStatus.RUNNING
+    assert store.complete(current, store.job_directory(current.id) / "mesh.glb")
+    assert not store.fail(current, "Finished twice")
+    assert store.get(current.id).status == JobStatus.SUCCEEDED
+
+
+def test_expired_jobs_are_purged_with_their_files(tmp_path):
+    """
+    Tests whether finished jobs are hidden once expired and deleted with their files
+    """
+    store = SomaJobStore(tmp_path / "jobs", ttl=0.1, max_pending=2)
+    job, _ = store.submit(SWC_CONTENT)
+    store.complete(store.claim(lease=60), store.job_directory(job.id) / "mesh.glb")
+    assert store.get(job.id).status == JobStatus.SUCCEEDED
+
+    time.sleep(0.15)
+    assert store.get(job.id) is None
+    assert store.purge_expired() == 1
+    assert not store.job_directory(job.id).exists()
+
+
+def test_workers_run_pending_jobs(store):
+    """
+    Tests whether the workers reconstruct the soma of the pending jobs
+    """
+    workers = SomaJobWorkers(store, workers=1, job_timeout=10, runner=fake_runner)
+    workers.start()
+    try:
+        job, _ = store.submit(SWC_CONTENT)
+        workers.wake_up()
+        job = wait_until_finished(store, job.id)
+    finally:
+        workers.stop()
+
+    assert job.status == JobStatus.SUCCEEDED
+    assert job.mesh_path.endswith("SOMA_MESH_morphology.glb")
+
+
+def test_workers_reuse_cached_meshes(store, tmp_path):
+    """
+    Tests whether a job whose mesh is cached does not run a reconstruction
+    """
+    calls = []
+
+    def counting_runner(swc_path, output_directory, niceness, quality, export):
+        calls.append(quality)
+        return fake_runner(swc_path, output_directory, niceness, quality, export)
+
+    workers = SomaJobWorkers(
+        store,
+        workers=1,
+        job_timeout=10,
+        runner=counting_runner,
+        cache=DiskCache(tmp_path / "cache", 1024, suffix=".glb"),
+    )
+    workers.start()
+    try:
+        # The job of another user is not deduplicated
+        for submitter in ("test", "other"):
+            job, _ = store.submit(SWC_CONTENT, submitter=submitter)
+            workers.wake_up()
+            job = wait_until_finished(store, job.id, submitter)
+            assert job.status == JobStatus.SUCCEEDED
+    finally:
+        workers.stop()
+
+    assert calls == [SomaQuality.STANDARD]
+
+
+def test_workers_record_failures(store):
+    """
+    Tests whether a failed reconstruction is recorded with its error
+    """
+
+    def failing_runner(*_):
+        raise SomaMeshNotFoundException
+
+    workers = SomaJobWorkers(store, workers=1, job_timeout=10, runner=failing_runner)
+    workers.start()
+    try:
+        job, _ = store.submit(SWC_CONTENT)
+        job = wait_until_finished(store, job.id)
+    finally:
+        workers.stop()
+
+    assert job.status == JobStatus.FAILED
+    assert job.error == "OBJ file not found after processing."
+
+
+def test_stopped_workers_put_running_jobs_back_to_pending(store):
+    """
+    Tests whether the job of a stopping worker is cancelled and left for another worker
+    """
+    started = threading.Event()
+
+    def blocking_runner(*_):
+        started.set()
+        while True:
+            current_cancellation().raise_if_cancelled()
+            time.sleep(0.01)
+
+    workers = SomaJobWorkers(store, workers=1, job_timeout=10, runner=blocking_runner)
+    workers.start()
+    job, _ = store.submit(SWC_CONTENT)
+    assert started.wait(5)
+    workers.stop()
+
+    assert store.get(job.id).status == JobStatus.PENDING
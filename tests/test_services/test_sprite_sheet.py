@@ -0,0 +1,95 @@
+"""
+Unit test module for testing the sprite sheets of thumbnails
+"""
+
+import io
+import json
+import pytest
+from PIL import Image
+from api.exceptions import SpriteSheetTooLargeException
+from api.models.common import BatchItem
+from api.services.batch import BatchResult
+from api.services.sprite_sheet import compose_sprite_sheet, encode_sprite_sheet, sheet_shape, sprite_item
+
+
+def png(width: int, height: int, color: str) -> bytes:
+    """
+    Returns a PNG image of a color
+    """
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def item(index: int) -> BatchItem:
+    """
+    Returns a morphology-image item
+    """
+    return BatchItem(type="morphology-image", content_url=f"http://example.com/{index}")
+
+
+def test_cells_are_rendered_at_their_size():
+    """
+    Tests whether the thumbnails are rendered at a resolution covering their cell
+    """
+    assert sprite_item(item(0), 64, 48).dpi == 10
+    assert sprite_item(item(0), 320, 240).dpi == 50
+
+    simulation = BatchItem(type="simulation-plot", content_url="http://example.com/s", target="stimulus", w=700)
+    assert (sprite_item(simulation, 100, 80).w, sprite_item(simulation, 100, 80).h) == (100, 80)
+
+
+def test_thumbnails_are_fitted_in_their_cell_row_by_row():
+    """
+    Tests whether every thumbnail is scaled down and centered in its cell, and failed cells are transparent
+    """
+    results = [
+        BatchResult(0, item(0), 200, image=png(200, 100, "red")),
+        BatchResult(2, item(2), 200, image=png(10, 10, "blue")),
+        BatchResult(1, item(1), 404, detail="The resource is not found"),
+    ]
+    image, sprite_map = compose_sprite_sheet(results, cell_width=40, cell_height=40, columns=2)
+
+    sheet = Image.open(io.BytesIO(image))
+    assert sheet.size == (80, 80) == (sprite_map["width"], sprite_map["height"])
+    assert [(cell["index"], cell["x"], cell["y"], cell["status"]) for cell in sprite_map["cells"]] == [
+        (0, 0, 0, 200),
+        (1, 40, 0, 404),
+        (2, 0, 40, 200),
+    ]
+    # 200x100 scaled down to 40x20, centered vertically
+    assert sheet.getpixel((20, 5)) == (0, 0, 0, 0)
+    assert sheet.getpixel((20, 20)) == (255, 0, 0, 255)
+    # Failed cell
+    assert sheet.getpixel((60, 20)) == (0, 0, 0, 0)
+    # 10x10 is not scaled up
+    assert sheet.getpixel((20, 60)) == (0, 0, 255, 255)
+    assert sheet.getpixel((10, 50)) == (0, 0, 0, 0)
+
+
+def test_sprite_sheet_is_encoded_as_form_data():
+    """
+    Tests whether the map and the image are the fields of a multipart/form-data body
+    """
+    body, media_type = encode_sprite_sheet(b"png", {"cells": []})
+    boundary = media_type.split("boundary=")[1].encode()
+
+    parts = body.split(b"--" + boundary)
+    assert parts[-1] == b"--\r\n"
+    map_headers, map_body = parts[1].split(b"\r\n\r\n", 1)
+    assert b'name="map"' in map_headers
+    assert json.loads(map_body) == {"cells": []}
+    image_headers, image_body = parts[2].split(b"\r\n\r\n", 1)
+    assert b'name="image"; filename="sprite-sheet.png"' in image_headers
+    assert image_body == b"png\r\n"
+
+
+def test_sheets_larger_than_the_limit_are_rejected():
+    """
+    Tests whether a sheet wider or higher than 8192 pixels is rejected
+    """
+    assert sheet_shape(200, 512, 512) == (14, 15)
+    with pytest.raises(SpriteSheetTooLargeException):
+        sheet_shape(20, 512, 128, columns=20)
+    with pytest.raises(SpriteSheetTooLargeException):
+        sheet_shape(200, 128, 512, columns=1)
@@ -0,0 +1,28 @@
+"""
+Unit test module for testing the garbage collection of the storage
+"""
+
+from api.services.storage import StorageCollector
+
+
+def test_collect_runs_every_task_despite_failures():
+    """
+    Tests whether a failing task does not prevent the others from running
+    """
+
+    def failing_task():
+        raise OSError("Disk error")
+
+    collector = StorageCollector(interval=60, tasks={"failing": failing_task, "meshes": lambda: 3})
+    assert collector.collect() == {"meshes": 3}
+
+
+def test_collector_thread_collects_on_start():
+    """
+    Tests whether the collection thread collects right away, and stops
+    """
+    calls = []
+    collector = StorageCollector(interval=60, tasks={"items": lambda: calls.append(1) or 0})
+    collector.start()
+    collector.stop()
+    assert calls == [1]
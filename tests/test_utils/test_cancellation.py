@@ -0,0 +1,74 @@
+"""
+Unit test module for testing the cancellation of the work of a request
+"""
+
+import asyncio
+import time
+import anyio
+import pytest
+from api.exceptions import DeadlineExceededException, RequestCancelledException
+from api.utils.cancellation import CancellationToken, cancel_after, cancellation_scope, current_cancellation
+
+
+def test_token_without_timeout_never_expires():
+    """
+    Tests whether a token without timeout is only cancelled explicitly
+    """
+    token = CancellationToken()
+
+    assert not token.cancelled
+    assert token.remaining(15) == 15
+    token.raise_if_cancelled()
+
+
+def test_token_expires_at_deadline():
+    """
+    Tests whether a token is cancelled with a 504 once its deadline passed
+    """
+    token = CancellationToken(timeout=0.05)
+    assert token.remaining(15) <= 0.05
+
+    time.sleep(0.06)
+    assert token.expired
+    assert token.remaining(15) == 0
+    with pytest.raises(DeadlineExceededException):
+        token.raise_if_cancelled()
+
+
+def test_cancelled_token_raises_cancellation():
+    """
+    Tests whether a token cancelled on disconnect raises the cancellation of the request
+    """
+    token = CancellationToken(timeout=60)
+    token.cancel()
+
+    assert token.disconnected
+    with pytest.raises(RequestCancelledException):
+        token.raise_if_cancelled()
+
+
+def test_cancellation_scope_sets_current_token():
+    """
+    Tests whether the token of the scope is the current one only inside the scope
+    """
+    token = CancellationToken()
+
+    with cancellation_scope(token):
+        assert current_cancellation() is token
+    assert current_cancellation() is not token
+
+
+def test_cancel_after_interrupts_waits_at_deadline():
+    """
+    Tests whether the work in the scope is interrupted at its deadline, with a current token expiring then
+    """
+
+    async def run():
+        async with cancel_after(0.1) as token:
+            assert current_cancellation() is token
+            await anyio.sleep(5)
+
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceededException):
+        asyncio.run(run())
+    assert time.monotonic() - started < 1
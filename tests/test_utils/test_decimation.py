@@ -0,0 +1,59 @@
+"""
+Unit tests related to testing the decimation and series utils
+"""
+
+import numpy as np
+from api.utils.decimation import minmax_decimate
+from api.utils.series import Series, decode_series, encode_series
+
+
+def test_minmax_decimate_keeps_short_series_untouched():
+    """
+    Tests whether minmax_decimate() returns the series as is if it is short enough
+    """
+    x = np.arange(10.0)
+    y = np.sin(x)
+
+    decimated_x, decimated_y = minmax_decimate(x, y, 100)
+
+    assert decimated_x is x
+    assert decimated_y is y
+
+
+def test_minmax_decimate_bounds_points_and_keeps_peaks():
+    """
+    Tests whether minmax_decimate() returns at most max_points and keeps the extrema and the range
+    """
+    x = np.arange(100001.0)
+    y = np.zeros_like(x)
+    y[12345] = 80.0
+    y[54321] = -70.0
+
+    decimated_x, decimated_y = minmax_decimate(x, y, 500)
+
+    assert len(decimated_y) <= 500
+    assert decimated_y.max() == 80.0
+    assert decimated_y.min() == -70.0
+    assert decimated_x[0] == x[0]
+    assert decimated_x[-1] == x[-1]
+    assert np.all(np.diff(decimated_x) > 0)
+
+
+def test_encode_series_roundtrip():
+    """
+    Tests whether a payload generated by encode_series() is decoded to the same series
+    """
+    series = [
+        Series("trace", np.arange(5.0), np.arange(5.0) * 2, x_unit="ms", y_unit="mV", rate=4000.0),
+        Series("other", np.arange(3.0), np.arange(3.0) * -1),
+    ]
+
+    decoded = decode_series(encode_series(series))
+
+    assert [s.name for s in decoded] == ["trace", "other"]
+    assert decoded[0].x_unit == "ms"
+    assert decoded[0].y_unit == "mV"
+    assert decoded[0].rate == 4000.0
+    np.testing.assert_array_equal(decoded[0].y, [0, 2, 4, 6, 8])
+    np.testing.assert_array_equal(decoded[1].y, [0, -1, -2])
+    assert decoded[1].x.dtype == np.dtype("<f4")
@@ -0,0 +1,44 @@
+"""
+Unit test module for testing the GLB encoding of the meshes
+"""
+
+import json
+import struct
+import numpy as np
+from api.utils.glb import encode_glb
+
+
+def decode_glb(glb):
+    """
+    Returns the JSON document and the binary chunk of a GLB file
+    """
+    magic, version, length = struct.unpack_from("<4sII", glb)
+    assert (magic, version, length) == (b"glTF", 2, len(glb))
+    json_length, json_type = struct.unpack_from("<I4s", glb, 12)
+    assert json_type == b"JSON"
+    document = json.loads(glb[20 : 20 + json_length])
+    binary_length, binary_type = struct.unpack_from("<I4s", glb, 20 + json_length)
+    assert binary_type == b"BIN\0"
+    return document, glb[28 + json_length : 28 + json_length + binary_length]
+
+
+def test_encoded_mesh_is_readable():
+    """
+    Tests whether the arrays of the mesh are read back from the GLB file
+    """
+    positions = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=float)
+    normals = np.array([[0, 0, 1]] * 3, dtype=float)
+    triangles = np.array([[0, 1, 2]])
+
+    glb = encode_glb(positions, normals, triangles)
+    assert len(glb) % 4 == 0
+    document, binary = decode_glb(glb)
+
+    accessors = document["accessors"]
+    assert accessors[0]["min"] == [0, 0, 0] and accessors[0]["max"] == [1, 1, 0]
+    views = document["bufferViews"]
+    assert all(view["byteOffset"] % 4 == 0 for view in views)
+    read_positions = np.frombuffer(binary, "<f4", 9, views[0]["byteOffset"]).reshape(3, 3)
+    read_indices = np.frombuffer(binary, "<u2", 3, views[2]["byteOffset"])
+    np.testing.assert_array_equal(read_positions, positions)
+    np.testing.assert_array_equal(read_indices, [0, 1, 2])
@@ -0,0 +1,71 @@
+"""
+Unit test module for testing the streaming of the uploaded files
+"""
+
+import hashlib
+import io
+import pytest
+from api.exceptions import InvalidUploadException, PayloadTooLargeException
+from api.utils.upload import MultipartFileWriter
+
+BOUNDARY = "test-boundary"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def multipart_body(*parts):
+    """
+    Returns a multipart body of (field name, file name, content) parts
+    """
+    body = b""
+    for name, filename, content in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+        body += f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n".encode() + content + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def stream(body, max_bytes=1024, chunk_size=7):
+    """
+    Feeds a body in small chunks to a writer, and returns the writer and what it wrote
+    """
+    destination = io.BytesIO()
+    writer = MultipartFileWriter(CONTENT_TYPE, "file", destination, max_bytes)
+    for start in range(0, len(body), chunk_size):
+        writer.write(body[start : start + chunk_size])
+    writer.finalize()
+    return writer, destination.getvalue()
+
+
+def test_file_is_written_across_chunks():
+    """
+    Tests whether only the file of the field is written, whatever the chunks of the body
+    """
+    content = b"1 1 0 0 0 5 -1\n" * 10
+    body = multipart_body(("comment", None, b"ignored"), ("file", "morphology.swc", content))
+    for chunk_size in [1, 7, len(body)]:
+        writer, written = stream(body, chunk_size=chunk_size)
+        assert written == content
+        assert writer.digest.digest() == hashlib.sha256(content).digest()
+
+
+def test_file_above_limit_is_rejected():
+    """
+    Tests whether a file larger than the limit is rejected while it is streamed
+    """
+    with pytest.raises(PayloadTooLargeException):
+        stream(multipart_body(("file", "morphology.swc", b"x" * 100)), max_bytes=50)
+
+
+def test_body_without_file_is_rejected():
+    """
+    Tests whether a body without a file in the field is rejected
+    """
+    with pytest.raises(InvalidUploadException):
+        stream(multipart_body(("file", None, b"not a file")))
+
+
+def test_non_multipart_body_is_rejected():
+    """
+    Tests whether a body that is not multipart/form-data is rejected
+    """
+    with pytest.raises(InvalidUploadException):
+        MultipartFileWriter("application/json", "file", io.BytesIO(), 1024)
@@ -2,6 +2,7 @@
 Utils module for unit tests
 """
 
+import io
 import json
 from typing import Literal, Optional, Union
 
@@ -56,3 +57,14 @@ def load_json_file(filepath: str, not_include: Optional[Literal["stimulus", "sim
         raise FileNotFoundError(f"JSON file not found: {filepath}")
     except json.JSONDecodeError as e:
         raise json.JSONDecodeError(f"Invalid JSON format in file: {filepath} ({str(e)})")
+
+
+def load_json_stream(filepath: str, not_include: Optional[Literal["stimulus", "simulation"]] = None):
+    """
+    Mocks nexus.stream_file_content() for the JSON file at the specified path.
+
+    Returns:
+        A function returning a new binary stream over the file content on every call.
+    """
+    content = load_json_file(filepath, not_include)
+    return lambda *args, **kwargs: io.BytesIO(content)